@@ -0,0 +1,276 @@
+"""
+このファイルは、大規模なコーパス向けの近似最近傍探索（IVF-PQ）のインデックスと、それを使うベクターストアを定義したファイルです。
+- IVF: ベクトルをk-meansでクラスタに分け、検索時はクエリに近いクラスタ（nprobe個）の中だけを調べる
+- PQ: ベクトルを部分空間ごとに256種類の代表値の番号（1バイト）で表し、表引きで類似度を近似計算する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import math
+import numpy as np
+import constants as ct
+from vector_index import NumpyVectorStore, top_k_indices
+
+
+############################################################
+# 変数定義
+############################################################
+# 距離計算をまとめて行う際の1回あたりの行数（一時配列のメモリ使用量を抑えるため）
+ASSIGN_BATCH_SIZE = 16384
+# PQの各部分空間の代表値の数（コードを1バイトで表すため256）
+PQ_CENTROID_COUNT = 256
+
+
+############################################################
+# 関数定義
+############################################################
+
+def assign_to_centroids(vectors, centroids):
+    """
+    各ベクトルを、ユークリッド距離が最も近い代表値に割り当てる
+
+    Args:
+        vectors: ベクトルの行列
+        centroids: 代表値の行列
+
+    Returns:
+        ベクトルごとの代表値の番号の配列
+    """
+    # 「|x - c|^2 = |x|^2 - 2x・c + |c|^2」のうち、比較に影響する「x・c - |c|^2 / 2」が最大の代表値を選ぶ
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start:start + ASSIGN_BATCH_SIZE]
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T - half_norms, axis=1)
+    return assignments
+
+
+def train_kmeans(vectors, cluster_count, iterations, rng):
+    """
+    k-meansによる代表値の学習
+
+    Args:
+        vectors: 学習用のベクトルの行列
+        cluster_count: 代表値の数
+        iterations: 繰り返し回数
+        rng: 乱数生成器
+
+    Returns:
+        代表値の行列
+    """
+    cluster_count = min(cluster_count, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), cluster_count, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=cluster_count)
+
+        # クラスタ番号順に並べ替え、クラスタごとの区間の合計で新しい代表値を求める（「np.add.at」より高速）
+        order = np.argsort(assignments, kind="stable")
+        empty = counts == 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(vectors[order], starts, axis=0) / counts[~empty, None]
+
+        # 空になったクラスタは、ランダムなベクトルで代表値を作り直す
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+
+    return centroids
+
+
+def resolve_subspace_count(dimension, requested):
+    """
+    次元数を割り切れる部分空間の数のうち、指定値以下で最大のものを取得
+
+    Args:
+        dimension: ベクトルの次元数
+        requested: 指定された部分空間の数
+
+    Returns:
+        部分空間の数
+    """
+    for count in range(min(requested, dimension), 0, -1):
+        if dimension % count == 0:
+            return count
+    return 1
+
+
+############################################################
+# クラス定義
+############################################################
+
+class IvfPqIndex:
+    """
+    IVF-PQによる近似最近傍探索のインデックス（内積による類似度）
+    """
+
+    def __init__(self, nlist=None, subspaces=ct.ANN_PQ_SUBSPACES, train_sample_size=ct.ANN_TRAIN_SAMPLE_SIZE,
+                 iterations=ct.ANN_KMEANS_ITERATIONS, seed=0):
+        """
+        Args:
+            nlist: クラスタ数（Noneの場合、件数に応じて自動で決定）
+            subspaces: PQの部分空間の数（次元数を割り切れる値に調整される）
+            train_sample_size: k-meansの学習に使う最大件数
+            iterations: k-meansの繰り返し回数
+            seed: 乱数のシード
+        """
+        self.nlist = nlist
+        self.subspaces = subspaces
+        self.train_sample_size = train_sample_size
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.list_offsets = None
+        self.list_ids = None
+        self.list_codes = None
+
+    def build(self, vectors):
+        """
+        クラスタとPQの代表値を学習し、全ベクトルをインデックスに登録
+
+        Args:
+            vectors: 正規化済みのベクトルの行列
+        """
+        rng = np.random.default_rng(self.seed)
+        count, dimension = vectors.shape
+        sample = vectors[rng.choice(count, min(count, self.train_sample_size), replace=False)]
+
+        # クラスタの学習と割り当て（既定では件数の平方根の4倍程度のクラスタ数）
+        nlist = self.nlist or max(1, min(int(4 * math.sqrt(count)), len(sample) // 39))
+        self.centroids = train_kmeans(sample, nlist, self.iterations, rng)
+        assignments = assign_to_centroids(vectors, self.centroids)
+
+        # クラスタの代表値からの差分（残差）を、部分空間ごとにPQで符号化
+        subspaces = resolve_subspace_count(dimension, self.subspaces)
+        sub_dimension = dimension // subspaces
+        sample_residuals = sample - self.centroids[assign_to_centroids(sample, self.centroids)]
+
+        self.codebooks = np.empty((subspaces, min(PQ_CENTROID_COUNT, len(sample)), sub_dimension), dtype=np.float32)
+        for j in range(subspaces):
+            self.codebooks[j] = train_kmeans(
+                np.ascontiguousarray(sample_residuals[:, j * sub_dimension:(j + 1) * sub_dimension]),
+                self.codebooks.shape[1], self.iterations, rng
+            )
+
+        # 残差の行列は元の行列と同じ大きさになるため、一定件数ずつ求めて符号化する
+        codes = np.empty((count, subspaces), dtype=np.uint8)
+        for start in range(0, count, ASSIGN_BATCH_SIZE):
+            rows = slice(start, start + ASSIGN_BATCH_SIZE)
+            residuals = vectors[rows] - self.centroids[assignments[rows]]
+            for j in range(subspaces):
+                codes[rows, j] = assign_to_centroids(
+                    np.ascontiguousarray(residuals[:, j * sub_dimension:(j + 1) * sub_dimension]), self.codebooks[j]
+                )
+
+        # クラスタごとに連続した領域にまとめる（検索時はクラスタ単位でスライスするだけで済むようにする）
+        order = np.argsort(assignments, kind="stable")
+        self.list_ids = order.astype(np.int32)
+        self.list_codes = np.ascontiguousarray(codes[order])
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))])
+
+    def search(self, query_vector, k, nprobe=ct.ANN_NPROBE, rerank_vectors=None, rerank_factor=ct.ANN_RERANK_FACTOR):
+        """
+        近似最近傍探索
+
+        Args:
+            query_vector: 正規化済みの検索ベクトル
+            k: 取得件数
+            nprobe: 調べるクラスタの数（大きいほど精度が上がり、遅くなる）
+            rerank_vectors: 元のベクトルの行列（指定した場合、近似スコアの上位候補を元のベクトルで再計算）
+            rerank_factor: 再計算する候補数（k の何倍か）
+
+        Returns:
+            類似度の高い順の行番号と類似度
+        """
+        # クエリに近いクラスタの選択
+        coarse_scores = self.centroids @ query_vector
+        probes = top_k_indices(coarse_scores, nprobe)
+
+        # 部分空間ごとに「クエリ・各代表値」の内積の表を作成（候補ごとの類似度は表引きの合計で近似できる）
+        subspaces, _, sub_dimension = self.codebooks.shape
+        table = np.einsum("mkd,md->mk", self.codebooks, query_vector.reshape(subspaces, sub_dimension))
+
+        # 選択したクラスタに属する候補の集約
+        slices = [slice(self.list_offsets[p], self.list_offsets[p + 1]) for p in probes]
+        ids = np.concatenate([self.list_ids[s] for s in slices])
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        codes = np.concatenate([self.list_codes[s] for s in slices])
+        base_scores = np.repeat(coarse_scores[probes], [s.stop - s.start for s in slices])
+
+        # 類似度の近似値 = クエリ・クラスタ代表値の内積 + クエリ・残差の内積（表引き）
+        scores = base_scores + table[np.arange(subspaces), codes].sum(axis=1)
+
+        if rerank_vectors is None:
+            top = top_k_indices(scores, k)
+            return ids[top].astype(np.int64), scores[top]
+
+        # 近似スコアの上位候補のみ、元のベクトルで類似度を再計算して並べ替え
+        shortlist = ids[top_k_indices(scores, k * rerank_factor)]
+        exact_scores = rerank_vectors[shortlist] @ query_vector
+        top = top_k_indices(exact_scores, k)
+        return shortlist[top].astype(np.int64), exact_scores[top]
+
+    def memory_usage(self):
+        """
+        インデックスのメモリ使用量
+
+        Returns:
+            配列ごとのバイト数の辞書
+        """
+        return {
+            "centroids": int(self.centroids.nbytes),
+            "codebooks": int(self.codebooks.nbytes),
+            "codes": int(self.list_codes.nbytes),
+            "ids": int(self.list_ids.nbytes + self.list_offsets.nbytes),
+        }
+
+
+class AnnVectorStore(NumpyVectorStore):
+    """
+    件数が多い場合にIVF-PQの近似最近傍探索で検索するベクターストア
+    - 件数が少ない場合や、メタデータで絞り込んだ検索では、NumpyVectorStoreと同じ厳密検索を行う
+    """
+
+    def __init__(self, embedding, nlist=None, nprobe=ct.ANN_NPROBE, subspaces=ct.ANN_PQ_SUBSPACES,
+                 rerank_factor=ct.ANN_RERANK_FACTOR, min_index_size=ct.ANN_MIN_INDEX_SIZE):
+        """
+        Args:
+            embedding: 埋め込みモデル
+            nlist: クラスタ数（Noneの場合、件数に応じて自動で決定）
+            nprobe: 検索時に調べるクラスタの数
+            subspaces: PQの部分空間の数
+            rerank_factor: 元のベクトルで再計算する候補数（k の何倍か）
+            min_index_size: 近似最近傍探索のインデックスを作成する最小件数
+        """
+        super().__init__(embedding)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.subspaces = subspaces
+        self.rerank_factor = rerank_factor
+        self.min_index_size = min_index_size
+        self._index = None
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        super().add_vectors(vectors, texts, metadatas, ids)
+
+        # 追加後の全件でインデックスを作り直す（件数が少ない間は厳密検索で十分なため作成しない）
+        if len(self) >= self.min_index_size:
+            self._index = IvfPqIndex(nlist=self.nlist, subspaces=self.subspaces)
+            self._index.build(self._matrix)
+
+    def memory_usage(self):
+        usage = super().memory_usage()
+        if self._index is not None:
+            usage["ann_index"] = self._index.memory_usage()
+        return usage
+
+    def _search(self, query_vector, k, candidates):
+        # 絞り込み済みの候補は件数に比例するコストで厳密検索する
+        if self._index is None or candidates is not None:
+            return super()._search(query_vector, k, candidates)
+        return self._index.search(
+            query_vector, k, nprobe=self.nprobe, rerank_vectors=self._matrix, rerank_factor=self.rerank_factor
+        )
@@ -0,0 +1,318 @@
+"""
+このファイルは、Streamlitの画面を介さずに検索・回答を取得するためのHTTP API（JSON形式）を定義したファイルです。
+- POST /search: 検索のみを行い、検索結果のドキュメントの出典・ページ番号・本文を返す（LLMは呼び出さない）
+- POST /answer: 利用目的のモード（社内文書検索・社内問い合わせ）に応じたLLMの回答と、その出典を返す
+- GET /health: インデックスの準備状況と、サーキットブレーカー・LLMスケジューラーの状態を返す
+- GET /admin/usage: 消費トークン数・料金の累計を返す（ヘッダー「X-Admin-Token」に管理者用トークンが必要）
+インデックスは画面と同じく、プロセス内で共有するもの（「initialize.py」の「get_shared_index」）を使います。
+
+実行方法（リポジトリのルートで実行）:
+    python api_server.py
+    uvicorn api_server:app --host 127.0.0.1 --port 8000
+環境変数「API_SERVER_ENABLED」を「true」にしてStreamlitを起動した場合は、画面と同じプロセス内でも起動し、
+画面で作成済みのインデックスをそのまま使います。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, Header, HTTPException, Request
+from langchain_core.messages import HumanMessage, AIMessage
+import openai
+from pydantic import BaseModel, Field
+import uvicorn
+import constants as ct
+import async_pipeline
+import circuit_breaker
+import embedding_cache
+import initialize
+import llm_scheduler
+import log_utils
+import request_coalescing
+import search_scope
+import usage_tracker
+
+
+############################################################
+# 変数定義
+############################################################
+# 画面と同じプロセス内で起動したAPIサーバーのスレッド
+_server_thread = None
+_server_thread_lock = threading.Lock()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ChatTurn(BaseModel):
+    """
+    会話履歴の1件分（「user」: ユーザーの入力、「assistant」: LLMの回答）
+    """
+    role: str = Field(pattern="^(user|assistant)$")
+    content: str
+
+
+class SearchRequest(BaseModel):
+    """
+    検索のリクエスト
+    """
+    query: str = Field(min_length=1, max_length=ct.API_MAX_QUERY_LENGTH)
+    # 検索範囲の名前（GET /health の「search_scopes」のいずれか、省略時は顧客名の自動検出のみ）
+    scope: Optional[str] = None
+
+
+class AnswerRequest(BaseModel):
+    """
+    回答のリクエスト
+    """
+    question: str = Field(min_length=1, max_length=ct.API_MAX_QUERY_LENGTH)
+    mode: str = "doc_search"
+    scope: Optional[str] = None
+    chat_history: List[ChatTurn] = []
+    # LLMへのリクエストをクライアントごとに公平に処理するための識別子（省略時は接続元のアドレス）
+    client_id: Optional[str] = None
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_index():
+    """
+    プロセス内で共有するインデックスの取得（作成中・作成失敗の場合はエラー）
+
+    Returns:
+        Retriever・検索範囲の一覧・インデックスのバージョンなどの辞書
+    """
+    index = initialize.get_shared_index(create=False)
+    if index is None or index.get("retriever") is None:
+        raise HTTPException(status_code=503, detail="Index is not ready")
+    return index
+
+
+def get_search_filter(index, scope, query):
+    """
+    検索範囲の絞り込み条件を取得（画面と同じく、指定がなければ入力内容に含まれる顧客名から検出）
+
+    Args:
+        index: インデックス
+        scope: 検索範囲の名前
+        query: 検索クエリ・質問
+
+    Returns:
+        絞り込み条件（絞り込まない場合はNone）
+    """
+    try:
+        return search_scope.resolve_search_filter(index.get("search_scopes", {}), scope, query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def serialize_documents(docs):
+    """
+    検索結果のドキュメントをJSONで返す形式に変換
+
+    Args:
+        docs: ドキュメントのリスト
+
+    Returns:
+        出典・ページ番号（1ベース）・本文の辞書のリスト
+    """
+    results = []
+    for doc in docs:
+        result = {"source": doc.metadata.get("source"), "content": doc.page_content}
+        if "page" in doc.metadata:
+            result["page"] = doc.metadata["page"] + 1
+            result["page_end"] = doc.metadata.get("page_end", doc.metadata["page"]) + 1
+        results.append(result)
+    return results
+
+
+def to_chat_history(turns):
+    """
+    リクエストの会話履歴を、LLMとのやりとり用の会話ログに変換（画面と同じく直近の一定件数のみ）
+
+    Args:
+        turns: リクエストの会話履歴
+
+    Returns:
+        LLMとのやりとり用の会話ログ
+    """
+    messages = [HumanMessage(content=turn.content) if turn.role == "user" else AIMessage(content=turn.content)
+                for turn in turns]
+    return messages[-ct.SESSION_MEMORY_CHAT_HISTORY_LIMIT:]
+
+
+def to_backend_http_error(e):
+    """
+    LLM・埋め込みモデルの呼び出しのエラーを、クライアントに返すHTTPエラーに変換
+    （混雑・障害・通信エラーなど時間をおけば解消し得るものは503、認証・設定の誤りなどは502）
+
+    Args:
+        e: 発生したエラー
+
+    Returns:
+        HTTPエラー
+    """
+    logging.getLogger(ct.LOGGER_NAME).warning({"backend_error": repr(e)})
+    if isinstance(e, (circuit_breaker.CircuitOpenError, llm_scheduler.LlmSchedulerError)):
+        return HTTPException(status_code=503, detail=str(e))
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return HTTPException(status_code=503, detail=f"LLM backend is unavailable ({type(e).__name__})")
+    # APIキーの未設定・認証エラーなどは、内部の情報を含めないよう種類のみ返す
+    return HTTPException(status_code=502, detail=f"LLM backend error ({type(e).__name__})")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    APIサーバーの起動時にログ出力の設定とインデックスの作成を行う（画面で作成済みの場合はそのまま使う）
+    """
+    initialize.initialize_logger()
+    # インデックスの作成中も、ヘルスチェックには応答できるようにする
+    task = asyncio.create_task(asyncio.to_thread(initialize.get_shared_index))
+    yield
+    task.cancel()
+
+
+############################################################
+# アプリケーションの定義
+############################################################
+app = FastAPI(title=ct.APP_NAME, lifespan=lifespan)
+
+
+@app.middleware("http")
+async def bind_request_context(request: Request, call_next):
+    """
+    リクエストごとに、ログに付与するセッションID（クライアントのアドレス）とリクエストIDを設定
+    """
+    log_utils.bind_session_id(f"api:{request.client.host if request.client else '-'}")
+    log_utils.new_request_id()
+    return await call_next(request)
+
+
+@app.get("/health")
+async def health():
+    """
+    ヘルスチェック
+    """
+    index = initialize.get_shared_index(create=False)
+    ready = index is not None and index.get("retriever") is not None
+    return {
+        "status": "ok" if ready else "starting",
+        "index_version": index.get("index_version") if ready else None,
+        "search_scopes": sorted(index.get("search_scopes", {})) if ready else [],
+        "circuit_breakers": circuit_breaker.get_all_stats(),
+        "llm_scheduler": llm_scheduler.get_scheduler().stats(),
+    }
+
+
+@app.post("/search")
+async def search(body: SearchRequest):
+    """
+    検索（LLMは呼び出さず、検索結果のドキュメントのみを返す）
+    """
+    index = get_index()
+    search_filter = get_search_filter(index, body.scope, body.query)
+    retriever = initialize.get_shared_scoped_retriever(index, search_filter)
+    try:
+        docs = await async_pipeline.aretrieve(retriever, body.query, index.get("degraded_retriever"))
+    except (circuit_breaker.CircuitOpenError, openai.OpenAIError) as e:
+        raise to_backend_http_error(e)
+    return {"query": body.query, "search_filter": search_filter, "documents": serialize_documents(docs)}
+
+
+@app.post("/answer")
+async def answer(body: AnswerRequest, request: Request):
+    """
+    回答（検索結果をもとにLLMから回答を取得）
+    """
+    if body.mode not in ct.API_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode: {body.mode} (expected one of {list(ct.API_MODES)})")
+    index = get_index()
+    search_filter = get_search_filter(index, body.scope, body.question)
+    client_id = body.client_id or f"api:{request.client.host if request.client else '-'}"
+
+    usage = {}
+    coroutine = async_pipeline.answer_question(
+        body.question,
+        to_chat_history(body.chat_history),
+        ct.API_MODES[body.mode],
+        initialize.get_shared_scoped_retriever(index, search_filter),
+        client_id,
+        search_filter=search_filter,
+        index_version=index.get("index_version"),
+        degraded_retriever=index.get("degraded_retriever"),
+        usage=usage
+    )
+    try:
+        # チャットモデルの接続と実行中の同じ質問を画面と共有するため、共有のイベントループで実行
+        llm_response, shared = await async_pipeline.run_on_loop(coroutine)
+    except (circuit_breaker.CircuitOpenError, llm_scheduler.LlmSchedulerError, openai.OpenAIError) as e:
+        # LLMが障害中・混雑している場合は時間をおいて再度リクエストしてもらい、それ以外のLLMのエラーは502で返す
+        raise to_backend_http_error(e)
+    if shared:
+        logging.getLogger(ct.LOGGER_NAME).info({"coalesced_request": request_coalescing.get_group().stats()})
+
+    return {
+        "question": body.question,
+        "mode": body.mode,
+        "answer": llm_response["answer"],
+        "search_filter": search_filter,
+        "sources": serialize_documents(llm_response["context"]),
+        "usage": usage,
+    }
+
+
+@app.get("/admin/usage")
+async def admin_usage(x_admin_token: Optional[str] = Header(default=None, alias=ct.USAGE_ADMIN_HEADER)):
+    """
+    管理者向けの利用量の集計（プロセス全体・モードごと・消費トークン数の多いセッションの累計）
+    """
+    if not usage_tracker.is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token is required")
+    return {
+        **usage_tracker.get_tracker().summary(),
+        "query_embedding_cache": embedding_cache.get_cache().stats(),
+        "coalescing": request_coalescing.get_group().stats(),
+    }
+
+
+def create_server(host=ct.API_HOST, port=ct.API_PORT):
+    """
+    APIサーバーの作成（HTTP/1.1の持続的接続で、同じクライアントからの連続したリクエストを受け付ける）
+
+    Args:
+        host: 待ち受けるアドレス
+        port: 待ち受けるポート番号
+
+    Returns:
+        APIサーバー
+    """
+    config = uvicorn.Config(app, host=host, port=port, timeout_keep_alive=ct.API_KEEP_ALIVE_SECONDS, log_level="warning")
+    return uvicorn.Server(config)
+
+
+def start_in_background():
+    """
+    画面と同じプロセス内で、APIサーバーを別スレッドで起動（起動済みの場合は何もしない）
+    """
+    global _server_thread
+    with _server_thread_lock:
+        if _server_thread is None:
+            host = os.getenv("API_HOST", ct.API_HOST)
+            port = int(os.getenv("API_PORT", ct.API_PORT))
+            _server_thread = threading.Thread(target=create_server(host, port).run, name="api-server", daemon=True)
+            _server_thread.start()
+            logging.getLogger(ct.LOGGER_NAME).info({"api_server": f"http://{host}:{port}"})
+
+
+if __name__ == "__main__":
+    create_server(os.getenv("API_HOST", ct.API_HOST), int(os.getenv("API_PORT", ct.API_PORT))).run()
@@ -0,0 +1,106 @@
+"""
+このファイルは、APIサーバーがLLMのエラーをHTTPのエラーとして返すことを確認するテストです。
+インデックスとチャットモデルは差し替え、OpenAIへの接続は行いません。
+
+実行方法（リポジトリのルートで実行）:
+    python -m pytest -q api_server_test.py
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import httpx
+import openai
+import pytest
+from fastapi.testclient import TestClient
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.retrievers import BaseRetriever
+import api_server
+import async_pipeline
+import circuit_breaker
+import initialize
+import llm_scheduler
+
+
+############################################################
+# クラス定義
+############################################################
+
+class StaticRetriever(BaseRetriever):
+    """
+    常に同じドキュメントを返すRetriever
+    """
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [Document(page_content="テスト用のドキュメント", metadata={"source": "test.txt"})]
+
+
+class FailingChatModel(BaseChatModel):
+    """
+    呼び出すと指定のエラーを発生させるチャットモデル
+    """
+    error: Exception
+
+    @property
+    def _llm_type(self) -> str:
+        return "failing"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise self.error
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise self.error
+
+
+############################################################
+# 関数定義
+############################################################
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    インデックス・チャットモデル・サーキットブレーカーをテストごとに差し替えたクライアント
+    """
+    index = {"retriever": StaticRetriever(), "search_scopes": {}, "index_version": "test"}
+    monkeypatch.setattr(initialize, "get_shared_index", lambda create=True: index)
+    monkeypatch.setattr(async_pipeline, "_chat_model", None)
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    return TestClient(api_server.app)
+
+
+def post_answer(client, question):
+    return client.post("/answer", json={"question": question, "client_id": "api-test"})
+
+
+def test_answer_without_api_key_returns_502(client, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+
+    response = post_answer(client, "APIキーがない場合の質問")
+
+    assert response.status_code == 502
+    assert response.json()["detail"] == "LLM backend error (OpenAIError)"
+
+
+def test_answer_with_auth_error_returns_502(client, monkeypatch):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    error = openai.AuthenticationError("invalid key", response=httpx.Response(401, request=request), body=None)
+    monkeypatch.setattr(async_pipeline, "get_chat_model", lambda: FailingChatModel(error=error))
+
+    response = post_answer(client, "認証エラーの場合の質問")
+
+    assert response.status_code == 502
+    assert response.json()["detail"] == "LLM backend error (AuthenticationError)"
+
+
+def test_answer_with_connection_error_returns_503(client, monkeypatch):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    error = openai.APIConnectionError(request=request)
+    monkeypatch.setattr(async_pipeline, "get_chat_model", lambda: FailingChatModel(error=error))
+    # 再実行の待ち時間を省くため、スケジューラーでの再実行は行わない
+    monkeypatch.setattr(llm_scheduler.get_scheduler(), "max_retries", 0)
+
+    response = post_answer(client, "接続エラーの場合の質問")
+
+    assert response.status_code == 503
+    assert response.json()["detail"] == "LLM backend is unavailable (APIConnectionError)"
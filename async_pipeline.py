@@ -0,0 +1,313 @@
+"""
+このファイルは、質問の言い換え・検索・回答生成を、プロセス内で共有する1つのイベントループ上で非同期に実行する機能を定義したファイルです。
+- LLMの応答待ちの間はスレッドを占有しないため、多数のセッションのリクエストを同時に処理できる
+- 統合検索では、ベクトル検索とキーワード検索を並行して実行する
+- 同じセッションから新しいメッセージが送られた場合や、セッションが終了した場合は、実行中の処理をキャンセルする
+Streamlitのスクリプト（同期処理）からは「run_sync」を通して呼び出します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+from langchain_openai import ChatOpenAI
+from langchain.chains.combine_documents import create_stuff_documents_chain
+import constants as ct
+import circuit_breaker
+import llm_scheduler
+import log_utils
+import request_coalescing
+import usage_tracker
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するイベントループと、それを実行するスレッド
+_loop = None
+_loop_lock = threading.Lock()
+# プロセス内で共有するチャットモデル（HTTPクライアントの接続を全セッションで使い回す）
+_chat_model = None
+_chat_model_lock = threading.Lock()
+# セッションごとの実行中の処理（同じセッションから新しいリクエストが来た場合にキャンセルする）
+_session_futures = {}
+_session_futures_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_loop():
+    """
+    プロセス内で共有するイベントループの取得（未作成の場合は、専用のスレッドで実行を開始）
+
+    Returns:
+        イベントループ
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-pipeline", daemon=True).start()
+        return _loop
+
+
+def get_chat_model():
+    """
+    プロセス内で共有するチャットモデルの取得（未作成の場合は作成）
+    （再実行はLLMスケジューラーで行うため、クライアント側の再実行は行わない）
+
+    Returns:
+        チャットモデル
+    """
+    global _chat_model
+    with _chat_model_lock:
+        if _chat_model is None:
+            _chat_model = ChatOpenAI(
+                model_name=ct.MODEL, temperature=ct.TEMPERATURE, max_retries=0, timeout=ct.LLM_REQUEST_TIMEOUT_SECONDS
+            )
+        return _chat_model
+
+
+def run_sync(coroutine, session_id, on_wait=None):
+    """
+    共有のイベントループでコルーチンを実行し、完了まで待って結果を返す（Streamlitのスクリプトから呼び出す用）
+    - 同じセッションの実行中の処理は、新しい処理の開始時にキャンセルする
+    - 待っている間に呼び出し元が中断された場合（再実行・セッション終了）は、実行中の処理をキャンセルする
+
+    Args:
+        coroutine: 実行するコルーチン
+        session_id: リクエスト元のセッションID
+        on_wait: 待っている間、一定間隔で呼び出す関数
+            （Streamlitの要素を更新する関数を渡すと、再実行・セッション終了の要求がその時点で反映される）
+
+    Returns:
+        コルーチンの戻り値
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    future = asyncio.run_coroutine_threadsafe(with_log_context(coroutine), get_loop())
+
+    with _session_futures_lock:
+        previous = _session_futures.get(session_id)
+        _session_futures[session_id] = future
+    if previous is not None and not previous.done():
+        previous.cancel()
+        logger.info({"async_pipeline": "cancelled", "reason": "new_request"})
+
+    try:
+        while True:
+            done, _ = concurrent.futures.wait([future], timeout=ct.ASYNC_BRIDGE_POLL_SECONDS)
+            if done:
+                return future.result()
+            if on_wait is not None:
+                on_wait()
+    finally:
+        if not future.done():
+            future.cancel()
+            logger.info({"async_pipeline": "cancelled", "reason": "caller_interrupted"})
+        with _session_futures_lock:
+            if _session_futures.get(session_id) is future:
+                del _session_futures[session_id]
+
+
+async def run_on_loop(coroutine):
+    """
+    共有のイベントループでコルーチンを実行し、完了を待つ（HTTP APIなど、別のイベントループ上の処理から呼び出す用）
+    （チャットモデルの接続や実行中の処理の共有は、共有のイベントループ上でのみ行えるため）
+    - 呼び出し元がキャンセルされた場合は、実行中の処理もキャンセルする
+
+    Args:
+        coroutine: 実行するコルーチン
+
+    Returns:
+        コルーチンの戻り値
+    """
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(with_log_context(coroutine), get_loop()))
+
+
+def with_log_context(coroutine):
+    """
+    呼び出し元のログ用のセッションID・リクエストIDを引き継いでコルーチンを実行するコルーチンを作成
+    （共有のイベントループのスレッドでは、呼び出し元のコンテキスト変数を参照できないため、呼び出し元のスレッドで値を取得しておく）
+
+    Args:
+        coroutine: 実行するコルーチン
+
+    Returns:
+        コルーチン
+    """
+    session_id, request_id = log_utils.session_id_var.get(), log_utils.request_id_var.get()
+
+    async def run():
+        # タスクごとにコンテキストがコピーされるため、設定した値は他のタスクに影響しない
+        log_utils.session_id_var.set(session_id)
+        log_utils.request_id_var.set(request_id)
+        return await coroutine
+
+    return run()
+
+
+def create_question_generator_prompt():
+    """
+    会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのプロンプトテンプレートを作成
+
+    Returns:
+        プロンプトテンプレート
+    """
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ]
+    )
+
+
+def create_question_answer_prompt(mode):
+    """
+    LLMから回答を取得する用のプロンプトテンプレートを作成
+
+    Args:
+        mode: 利用目的のモード
+
+    Returns:
+        プロンプトテンプレート
+    """
+    # モードによってLLMから回答を取得する用のプロンプトを変更
+    if mode == ct.ANSWER_MODE_1:
+        # モードが「社内文書検索」の場合のプロンプト
+        question_answer_template = ct.SYSTEM_PROMPT_DOC_SEARCH
+    else:
+        # モードが「社内問い合わせ」の場合のプロンプト
+        question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", question_answer_template),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ]
+    )
+
+
+def get_elapsed_ms(start):
+    """
+    経過時間（ミリ秒）の取得
+
+    Args:
+        start: 開始時点の「time.perf_counter()」の値
+
+    Returns:
+        経過時間（ミリ秒、小数第1位まで）
+    """
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+async def aretrieve(retriever, query, degraded_retriever=None):
+    """
+    Retrieverでの非同期の検索（埋め込みモデルが障害中で呼び出しを遮断した場合は、キーワード検索に切り替える）
+
+    Args:
+        retriever: Retriever
+        query: 検索クエリ
+        degraded_retriever: 障害時に切り替えるRetriever
+
+    Returns:
+        検索結果のドキュメントのリスト
+    """
+    try:
+        return await retriever.ainvoke(query)
+    except circuit_breaker.CircuitOpenError as e:
+        if degraded_retriever is None:
+            raise
+        logging.getLogger(ct.LOGGER_NAME).warning({"degraded_retrieval": str(e)})
+        return await degraded_retriever.ainvoke(query)
+
+
+async def answer_question(chat_message, chat_history, mode, retriever, session_id, search_filter=None,
+                          index_version=None, degraded_retriever=None, timings=None, usage=None):
+    """
+    質問の言い換え・検索・回答生成の非同期実行
+    （消費トークン数は、完了・失敗・キャンセルのいずれの場合もセッションの累計に記録し、ログに出力する）
+
+    Args:
+        chat_message: ユーザー入力値
+        chat_history: LLMとのやりとり用の会話ログ
+        mode: 利用目的のモード
+        retriever: 検索に使うRetriever（検索範囲の絞り込み済み）
+        session_id: リクエスト元のセッションID
+        search_filter: 検索範囲の絞り込み条件
+        index_version: インデックスのバージョン
+        degraded_retriever: 埋め込みモデルの障害時に切り替えるRetriever
+        timings: 処理段階ごとの所要時間（ミリ秒）を記録する辞書（言い換え・検索・回答生成・他のセッションの結果待ち）
+        usage: 消費トークン数・料金を記録する辞書（「usage_tracker.build_request_usage」の戻り値の内容）
+
+    Returns:
+        LLMからの回答（入力内容・会話ログ・検索結果・回答の辞書）と、他のセッションの処理結果を受け取ったかどうかの組
+    """
+    # 全セッションで共有するスケジューラーを通して実行し、レート制限時の再実行もスケジューラーで行う
+    llm = llm_scheduler.ScheduledChatModel(llm=get_chat_model(), session_id=session_id)
+
+    timings = {} if timings is None else timings
+    usage = {} if usage is None else usage
+    # 処理段階ごとの消費トークン数の集計
+    stage_usages = {"rewrite": usage_tracker.TokenUsageCallback(), "answer": usage_tracker.TokenUsageCallback()}
+    docs = None
+    saved_usage = None
+
+    try:
+        # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得（会話履歴がない場合は入力内容をそのまま使う）
+        start = time.perf_counter()
+        if chat_history:
+            question_generator_chain = create_question_generator_prompt() | llm | StrOutputParser()
+            standalone_question = await question_generator_chain.ainvoke(
+                {"input": chat_message, "chat_history": chat_history},
+                config={"callbacks": [stage_usages["rewrite"]]}
+            )
+        else:
+            standalone_question = chat_message
+        timings["rewrite"] = get_elapsed_ms(start)
+
+        # LLMから回答を取得する用のChainを作成
+        question_answer_chain = create_stuff_documents_chain(llm, create_question_answer_prompt(mode))
+
+        async def retrieve_and_answer():
+            # 独立した入力テキストで検索し、検索結果をもとにLLMから回答を取得
+            # （結果を受け取ったセッションが節約できたトークン数を記録できるよう、回答生成の消費トークン数も返す）
+            start = time.perf_counter()
+            docs = await aretrieve(retriever, standalone_question, degraded_retriever)
+            timings["retrieve"] = get_elapsed_ms(start)
+            start = time.perf_counter()
+            answer = await question_answer_chain.ainvoke(
+                {"input": chat_message, "chat_history": chat_history, "context": docs},
+                config={"callbacks": [stage_usages["answer"]]}
+            )
+            timings["answer"] = get_elapsed_ms(start)
+            return docs, answer, stage_usages["answer"].totals()
+
+        # 他のセッションで同じ質問を処理中の場合は、新たに検索・回答生成を行わずにその結果を受け取る
+        request_key = request_coalescing.build_request_key(
+            mode, standalone_question, index_version, search_filter, chat_message, chat_history
+        )
+        start = time.perf_counter()
+        (docs, answer, answer_usage), shared = await request_coalescing.get_group().ado(request_key, retrieve_and_answer)
+        if shared:
+            timings["coalesced_wait"] = get_elapsed_ms(start)
+            saved_usage = answer_usage
+    finally:
+        usage.update(usage_tracker.build_request_usage(stage_usages, docs, chat_history, saved_usage))
+        session_usage = usage_tracker.get_tracker().record(session_id, mode, usage)
+        logging.getLogger(ct.LOGGER_NAME).info({
+            "token_usage": usage,
+            "session_usage": {key: session_usage[key] for key in ("requests", "total_tokens", "cost_usd")},
+        })
+
+    # 入力内容・会話ログは、他のセッションの処理結果を受け取った場合もこのリクエストのものを返す
+    llm_response = {"input": chat_message, "chat_history": chat_history, "context": docs, "answer": answer}
+    return llm_response, shared
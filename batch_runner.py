@@ -0,0 +1,264 @@
+"""
+このファイルは、ファイルに記載した多数の質問を、画面と同じ検索・回答生成の処理で一括して実行するコマンドです。
+- 複数の質問を並行して実行する（LLMへのリクエストはLLMスケジューラーのレート制限の範囲内で実行される）
+- 質問ごとの回答・出典・処理段階ごとの所要時間・消費トークン数を、完了した順にJSONL形式で出力する
+- 中断した場合も、同じ出力先を指定して再実行すると、完了済みの質問を飛ばして続きから実行する（失敗した質問は再実行）
+
+質問のファイルの形式:
+    .txt   1行に1つの質問（空行と「#」で始まる行は無視）
+    .jsonl 1行に1つの「{"question": 質問, "id": 識別子, "mode": モード, "scope": 検索範囲}」（question以外は省略可）
+    .csv   「question」列（「id」「mode」「scope」列は省略可）
+モードは「doc_search」（社内文書検索）または「inquiry」（社内問い合わせ）、検索範囲は画面の検索範囲の名前で指定します。
+
+実行方法（リポジトリのルートで実行）:
+    python batch_runner.py questions.txt --output answers.jsonl
+    python batch_runner.py questions.jsonl --output answers.jsonl --concurrency 8 --mode inquiry
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+import constants as ct
+import async_pipeline
+import initialize
+import log_utils
+import search_scope
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_questions(path, default_mode):
+    """
+    質問のファイルの読み込み（識別子が指定されていない質問は、質問・モード・検索範囲から識別子を作成）
+
+    Args:
+        path: 質問のファイルのパス
+        default_mode: モードが指定されていない質問に使うモード
+
+    Returns:
+        識別子・質問・モード・検索範囲の辞書のリスト（同じ識別子の質問は最初の1件のみ）
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if extension == ".jsonl":
+            items = [json.loads(line) for line in f if line.strip()]
+        elif extension == ".csv":
+            items = list(csv.DictReader(f))
+        else:
+            items = [{"question": line.strip()} for line in f if line.strip() and not line.startswith("#")]
+
+    questions = {}
+    for item in items:
+        mode = item.get("mode") or default_mode
+        if ct.API_MODES.get(mode, mode) not in ct.API_MODES.values():
+            raise ValueError(f"Unknown mode: {mode} (expected one of {list(ct.API_MODES)})")
+        question = {"question": item["question"], "mode": mode, "scope": item.get("scope") or None}
+        question_id = str(item.get("id") or get_question_id(question))
+        questions.setdefault(question_id, {"id": question_id, **question})
+    return list(questions.values())
+
+
+def get_question_id(question):
+    """
+    質問・モード・検索範囲から識別子を作成（質問のファイルを編集しても、同じ質問には同じ識別子を割り当てる）
+
+    Args:
+        question: 質問・モード・検索範囲の辞書
+
+    Returns:
+        識別子
+    """
+    key = f"{question['question']}\0{question['mode']}\0{question['scope'] or ''}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def load_completed_ids(output_path):
+    """
+    出力先のファイルから、回答を取得済みの質問の識別子を取得
+    （同じ識別子の結果が複数ある場合は最後のものを使い、中断により途中までしか書き込まれていない行は無視）
+
+    Args:
+        output_path: 出力先のファイルのパス
+
+    Returns:
+        回答を取得済みの質問の識別子の集合
+    """
+    latest = {}
+    if not os.path.exists(output_path):
+        return set()
+    # 途中で切れた行は、マルチバイト文字の途中で終わっている場合もあるため、行ごとにデコードする
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            latest[record["id"]] = record
+    return {question_id for question_id, record in latest.items() if "error" not in record}
+
+
+def ensure_trailing_newline(output_path):
+    """
+    出力先のファイルの最終行が、中断により途中までしか書き込まれていない場合は改行を追加
+    （追記する結果が途中の行とつながらないようにするため、バイト単位で確認する）
+
+    Args:
+        output_path: 出力先のファイルのパス
+    """
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return
+    with open(output_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def serialize_sources(docs):
+    """
+    検索結果のドキュメントを、出力する出典の形式に変換
+
+    Args:
+        docs: ドキュメントのリスト
+
+    Returns:
+        出典・ページ番号（1ベース）の辞書のリスト
+    """
+    sources = []
+    for doc in docs:
+        source = {"source": doc.metadata.get("source")}
+        if "page" in doc.metadata:
+            source["page"] = doc.metadata["page"] + 1
+            source["page_end"] = doc.metadata.get("page_end", doc.metadata["page"]) + 1
+        sources.append(source)
+    return sources
+
+
+async def run_question(item, index, session_id, semaphore):
+    """
+    1つの質問の実行
+
+    Args:
+        item: 識別子・質問・モード・検索範囲の辞書
+        index: 共有のインデックス
+        session_id: LLMスケジューラーで使うセッションID
+        semaphore: 同時に実行する質問数を制限するセマフォ
+
+    Returns:
+        出力する結果の辞書
+    """
+    async with semaphore:
+        start = time.perf_counter()
+        record = {"id": item["id"], "question": item["question"], "mode": item["mode"], "scope": item["scope"]}
+        timings = {}
+        usage = {}
+        try:
+            search_filter = search_scope.resolve_search_filter(
+                index.get("search_scopes", {}), item["scope"], item["question"]
+            )
+            coroutine = async_pipeline.answer_question(
+                item["question"],
+                [],
+                ct.API_MODES.get(item["mode"], item["mode"]),
+                initialize.get_shared_scoped_retriever(index, search_filter),
+                session_id,
+                search_filter=search_filter,
+                index_version=index.get("index_version"),
+                degraded_retriever=index.get("degraded_retriever"),
+                timings=timings,
+                usage=usage
+            )
+            llm_response, shared = await async_pipeline.run_on_loop(coroutine)
+            record.update({
+                "answer": llm_response["answer"],
+                "sources": serialize_sources(llm_response["context"]),
+                "search_filter": search_filter,
+                "coalesced": shared,
+            })
+        except Exception as e:
+            record["error"] = repr(e)
+        timings["total"] = async_pipeline.get_elapsed_ms(start)
+        record.update({"timings_ms": timings, "tokens": usage})
+        return record
+
+
+async def run_batch(questions, index, output_path, concurrency):
+    """
+    質問の並行実行（完了した順に、結果を1行ずつ出力先のファイルに追記）
+
+    Args:
+        questions: 実行する質問のリスト
+        index: 共有のインデックス
+        output_path: 出力先のファイルのパス
+        concurrency: 同時に実行する質問数
+
+    Returns:
+        成功・失敗した質問数と、消費トークン数・料金の合計の辞書
+    """
+    session_id = f"batch:{os.getpid()}"
+    log_utils.bind_session_id(session_id)
+    semaphore = asyncio.Semaphore(concurrency)
+    summary = {"succeeded": 0, "failed": 0, "total_tokens": 0, "cost_usd": 0.0}
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    ensure_trailing_newline(output_path)
+    with open(output_path, "a", encoding="utf-8") as f:
+        tasks = [asyncio.create_task(run_question(item, index, session_id, semaphore)) for item in questions]
+        for number, task in enumerate(asyncio.as_completed(tasks), start=1):
+            record = await task
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+            status = "error" if "error" in record else "ok"
+            summary["failed" if "error" in record else "succeeded"] += 1
+            # 検索範囲の指定誤りなど、LLMを呼び出す前に失敗した質問には消費トークン数の記録がない
+            summary["total_tokens"] += record["tokens"].get("total_tokens", 0)
+            summary["cost_usd"] = round(summary["cost_usd"] + (record["tokens"].get("cost_usd") or 0), 6)
+            print(f"[{number}/{len(questions)}] {record['id']} {status} {record['timings_ms']['total']:.0f}ms")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="質問の一括実行（結果をJSONL形式で出力）")
+    parser.add_argument("questions", help="質問のファイル（.txt / .jsonl / .csv）")
+    parser.add_argument("--output", required=True, help="結果の出力先（JSONL形式、既存の場合は続きから実行）")
+    parser.add_argument("--concurrency", type=int, default=ct.BATCH_CONCURRENCY, help="同時に実行する質問数")
+    parser.add_argument("--mode", default="doc_search", help="モードが指定されていない質問に使うモード")
+    parser.add_argument("--restart", action="store_true", help="完了済みの質問も含めて最初から実行")
+    args = parser.parse_args()
+
+    initialize.initialize_logger()
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    questions = load_questions(args.questions, args.mode)
+    completed_ids = set() if args.restart else load_completed_ids(args.output)
+    pending = [item for item in questions if item["id"] not in completed_ids]
+    print(f"質問数: {len(questions)}（完了済み: {len(questions) - len(pending)}、実行対象: {len(pending)}）")
+    if not pending:
+        return
+
+    index = initialize.get_shared_index()
+    start = time.perf_counter()
+    summary = asyncio.run(run_batch(pending, index, args.output, args.concurrency))
+    summary.update({
+        "questions": len(questions),
+        "skipped": len(questions) - len(pending),
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+    })
+    logger.info({"batch_run": summary})
+    print(f"完了しました: {json.dumps(summary, ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    main()
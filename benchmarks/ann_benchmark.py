@@ -0,0 +1,214 @@
+"""
+このファイルは、近似最近傍探索（IVF-PQ）のインデックスについて、厳密検索（全件の内積計算）と比べた
+再現率（recall@k）と検索レイテンシ・作成時間・メモリ使用量を計測するベンチマークです。
+
+実際の埋め込みと同様にまとまり（クラスタ）を持つ分布となるよう、乱数で作成した中心点の周りに
+ノイズを加えたベクトルを使います。ネットワークには接続しません。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/ann_benchmark.py
+    python benchmarks/ann_benchmark.py --sizes 10000,100000 --nprobes 1,8,32 --rerank-factors 0,16,64
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import json
+import os
+import platform
+import time
+from datetime import datetime, timezone
+import numpy as np
+import constants as ct
+from ann_index import IvfPqIndex
+from vector_index import top_k_indices
+from benchmarks.retrieval_benchmark import BENCHMARK_DIR, percentiles
+
+
+############################################################
+# 設定関連
+############################################################
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARK_DIR, "results", "ann.json")
+# 本番の埋め込みモデル（paraphrase-MiniLM-L3-v2）と同じ次元数
+DEFAULT_DIMENSION = 384
+# データ作成時に一度に生成する件数（100万件でも一時配列が大きくなりすぎないようにする）
+GENERATE_BATCH_SIZE = 65536
+# 正解（厳密検索の上位k件）を求める際に、一度に計算するクエリ数
+EXACT_BATCH_SIZE = 16
+
+
+############################################################
+# 関数定義
+############################################################
+
+def make_dataset(size, dimension, query_count, cluster_count, noise, seed):
+    """
+    クラスタを持つ正規化済みの乱数ベクトルと、検索ベクトルの作成
+
+    Args:
+        size: ベクトル数
+        dimension: ベクトルの次元数
+        query_count: 検索ベクトル数
+        cluster_count: 中心点の数
+        noise: 中心点に加えるノイズの大きさ（中心点の大きさに対する比率）
+        seed: 乱数のシード
+
+    Returns:
+        ベクトルの行列と、検索ベクトルの行列
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((cluster_count, dimension)).astype(np.float32)
+
+    vectors = np.empty((size, dimension), dtype=np.float32)
+    for start in range(0, size, GENERATE_BATCH_SIZE):
+        batch_size = min(GENERATE_BATCH_SIZE, size - start)
+        batch = centers[rng.integers(0, cluster_count, batch_size)]
+        batch += noise * rng.standard_normal((batch_size, dimension), dtype=np.float32)
+        vectors[start:start + batch_size] = batch / np.linalg.norm(batch, axis=1, keepdims=True)
+
+    # 検索ベクトルは登録済みのベクトルにノイズを加えたもの（実際の検索と同様に、近傍が存在する状態にする）
+    queries = vectors[rng.integers(0, size, query_count)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(dimension)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    return vectors, queries
+
+
+def exact_search(vectors, queries, k):
+    """
+    全件の内積計算による厳密検索（正解と、比較用のレイテンシを取得）
+
+    Args:
+        vectors: ベクトルの行列
+        queries: 検索ベクトルの行列
+        k: 取得件数
+
+    Returns:
+        検索ベクトルごとの上位k件の行番号のリストと、1件ずつ検索した場合のレイテンシのリスト
+    """
+    truth = []
+    for start in range(0, len(queries), EXACT_BATCH_SIZE):
+        scores = queries[start:start + EXACT_BATCH_SIZE] @ vectors.T
+        truth.extend(top_k_indices(row, k) for row in scores)
+
+    # レイテンシはアプリでの検索と同じく、1件ずつ計算した場合を計測
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        top_k_indices(vectors @ query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return truth, latencies
+
+
+def measure_index(index, vectors, queries, truth, k, nprobe, rerank_factor):
+    """
+    1つの設定（nprobe・再計算する候補数）について、再現率と検索レイテンシを計測
+
+    Args:
+        index: 作成済みのインデックス
+        vectors: ベクトルの行列（再計算に使用）
+        queries: 検索ベクトルの行列
+        truth: 検索ベクトルごとの正解の行番号
+        k: 取得件数
+        nprobe: 調べるクラスタの数
+        rerank_factor: 元のベクトルで再計算する候補数（k の何倍か、0の場合は再計算なし）
+
+    Returns:
+        計測結果の辞書
+    """
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        indices, _ = index.search(
+            query, k, nprobe=nprobe,
+            rerank_vectors=vectors if rerank_factor else None, rerank_factor=rerank_factor
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(set(indices.tolist()) & set(expected.tolist())) / k)
+
+    return {
+        "nprobe": nprobe,
+        "rerank_factor": rerank_factor,
+        f"recall_at_{k}": round(float(np.mean(recalls)), 4),
+        "query_latency_ms": percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近似最近傍探索（IVF-PQ）と厳密検索の比較ベンチマーク")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="ベクトル数（カンマ区切り）")
+    parser.add_argument("--dimension", type=int, default=DEFAULT_DIMENSION, help="ベクトルの次元数")
+    parser.add_argument("--queries", type=int, default=200, help="検索ベクトル数")
+    parser.add_argument("--k", type=int, default=10, help="取得件数")
+    parser.add_argument("--nprobes", default="1,4,8,16,32", help="調べるクラスタの数（カンマ区切り）")
+    parser.add_argument("--rerank-factors", default="0,16,64", help="再計算する候補数の倍率（カンマ区切り、0は再計算なし）")
+    parser.add_argument("--nlist", type=int, default=None, help="クラスタ数（省略時は件数に応じて自動で決定）")
+    parser.add_argument("--subspaces", type=int, default=ct.ANN_PQ_SUBSPACES, help="PQの部分空間の数")
+    parser.add_argument("--clusters", type=int, default=1000, help="データ作成時の中心点の数")
+    parser.add_argument("--noise", type=float, default=0.6, help="データ作成時のノイズの大きさ")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="JSONレポートの出力先")
+    args = parser.parse_args()
+
+    nprobes = [int(value) for value in args.nprobes.split(",")]
+    rerank_factors = [int(value) for value in args.rerank_factors.split(",")]
+    runs = []
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        vectors, queries = make_dataset(size, args.dimension, args.queries, args.clusters, args.noise, args.seed)
+        truth, exact_latencies = exact_search(vectors, queries, args.k)
+
+        start = time.perf_counter()
+        index = IvfPqIndex(nlist=args.nlist, subspaces=args.subspaces, seed=args.seed)
+        index.build(vectors)
+        build_time_ms = (time.perf_counter() - start) * 1000
+
+        run = {
+            "size": size,
+            "nlist": len(index.centroids),
+            "build_time_ms": round(build_time_ms, 3),
+            "memory": {"vectors_bytes": int(vectors.nbytes), "index_bytes": index.memory_usage()},
+            "exact_query_latency_ms": percentiles(exact_latencies),
+            "settings": [],
+        }
+        print(
+            f"size={size:<8} nlist={run['nlist']:<5} build={build_time_ms:.1f}ms "
+            f"exact_p50={run['exact_query_latency_ms']['p50']:.3f}ms"
+        )
+
+        for nprobe in nprobes:
+            for rerank_factor in rerank_factors:
+                result = measure_index(index, vectors, queries, truth, args.k, nprobe, rerank_factor)
+                run["settings"].append(result)
+                print(
+                    f"  nprobe={nprobe:<3} rerank={rerank_factor:<3} "
+                    f"recall@{args.k}={result[f'recall_at_{args.k}']:.3f} "
+                    f"p50={result['query_latency_ms']['p50']:.3f}ms p95={result['query_latency_ms']['p95']:.3f}ms"
+                )
+
+        runs.append(run)
+        del vectors, index
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "numpy": np.__version__},
+        "settings": {
+            "dimension": args.dimension, "queries": args.queries, "k": args.k, "subspaces": args.subspaces,
+            "clusters": args.clusters, "noise": args.noise, "seed": args.seed,
+        },
+        "runs": runs,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"レポートを出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
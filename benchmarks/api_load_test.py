@@ -0,0 +1,166 @@
+"""
+このファイルは、HTTP API（api_server.py）に同時にリクエストを送り、スループットとレイテンシを計測する負荷試験です。
+
+ゴールデンクエリ（golden_queries.json）の検索クエリを順に使い、同時接続数ごとに指定件数のリクエストを送ります。
+各接続は持続的接続（keep-alive）で使い回すため、接続の確立にかかる時間は最初の1回のみ含まれます。
+APIサーバーは事前に起動しておきます（python api_server.py）。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/api_load_test.py
+    python benchmarks/api_load_test.py --endpoint answer --concurrency 1,4,8 --requests 50
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import time
+from datetime import datetime, timezone
+import httpx
+import constants as ct
+from benchmarks.retrieval_benchmark import BENCHMARK_DIR, DEFAULT_QUERIES_PATH, load_golden_queries, percentiles
+
+
+############################################################
+# 設定関連
+############################################################
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARK_DIR, "results", "api_load.json")
+DEFAULT_BASE_URL = f"http://{ct.API_HOST}:{ct.API_PORT}"
+# APIサーバーのインデックス作成を待つ最大時間（秒）
+READY_TIMEOUT_SECONDS = 300
+
+
+############################################################
+# 関数定義
+############################################################
+
+def build_payload(endpoint, query):
+    """
+    リクエストの本文の作成
+
+    Args:
+        endpoint: 計測対象のエンドポイント（「search」または「answer」）
+        query: 検索クエリ
+
+    Returns:
+        リクエストの本文
+    """
+    if endpoint == "search":
+        return {"query": query}
+    return {"question": query, "mode": "doc_search"}
+
+
+async def wait_until_ready(client):
+    """
+    APIサーバーのインデックスの作成完了を待つ
+
+    Args:
+        client: HTTPクライアント
+    """
+    deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+    while True:
+        try:
+            response = await client.get("/health")
+            if response.json().get("status") == "ok":
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"API server was not ready within {READY_TIMEOUT_SECONDS} seconds")
+        await asyncio.sleep(1)
+
+
+async def run_load(base_url, endpoint, queries, concurrency, request_count, timeout):
+    """
+    同時接続数を固定して指定件数のリクエストを送り、結果を集計
+
+    Args:
+        base_url: APIサーバーのURL
+        endpoint: 計測対象のエンドポイント
+        queries: 検索クエリのリスト
+        concurrency: 同時接続数
+        request_count: 送るリクエストの総数
+        timeout: 1リクエストあたりのタイムアウト（秒）
+
+    Returns:
+        スループット・レイテンシのパーセンタイル・ステータスコードごとの件数の辞書
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        await wait_until_ready(client)
+
+        # 全ワーカーで共有するカウンター（送ったリクエスト数）
+        counter = itertools.count()
+        latencies = []
+        statuses = {}
+
+        async def worker():
+            while (number := next(counter)) < request_count:
+                payload = build_payload(endpoint, queries[number % len(queries)])
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"/{endpoint}", json=payload)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": request_count,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(request_count / elapsed, 3),
+        "success_rate": round(statuses.get("200", 0) / request_count, 4),
+        "statuses": statuses,
+        "latency_ms": percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP APIの負荷試験（スループット・レイテンシの計測）")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL, help="APIサーバーのURL")
+    parser.add_argument("--endpoint", default="search", choices=["search", "answer"], help="計測対象のエンドポイント")
+    parser.add_argument("--concurrency", default="1,4,16", help="同時接続数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="同時接続数ごとに送るリクエストの総数")
+    parser.add_argument("--timeout", type=float, default=120, help="1リクエストあたりのタイムアウト（秒）")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH, help="ゴールデンクエリのファイル")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="JSONレポートの出力先")
+    args = parser.parse_args()
+
+    queries = [item["query"] for item in load_golden_queries(args.queries)]
+    runs = []
+    for concurrency in [int(value) for value in args.concurrency.split(",")]:
+        run = asyncio.run(run_load(args.base_url, args.endpoint, queries, concurrency, args.requests, args.timeout))
+        runs.append(run)
+        print(
+            f"concurrency={concurrency} throughput={run['throughput_rps']:.1f}req/s "
+            f"success={run['success_rate']:.1%} p50={run['latency_ms']['p50']:.1f}ms p95={run['latency_ms']['p95']:.1f}ms"
+        )
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "httpx": httpx.__version__},
+        "settings": {"base_url": args.base_url, "endpoint": args.endpoint, "requests": args.requests, "timeout": args.timeout},
+        "runs": runs,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"レポートを出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+このファイルは、複数のチャットセッションを同時に模擬し、アプリまたはHTTP APIのスループット・レイテンシ・エラー率を計測する負荷試験です。
+
+各セッションはゴールデンクエリ（golden_queries.json）の質問を順に送り、会話履歴を引き継ぎながら指定回数のやりとりを行います。
+- target=api: HTTP API（api_server.py）の POST /answer に、持続的接続（keep-alive）でリクエストを送る
+- target=app: Streamlitのアプリ（main.py）にブラウザと同じWebSocketのプロトコルで接続し、チャット入力の送信から
+  スクリプトの実行完了（回答の表示）までを計測する
+「--start-fake-openai」を指定すると、OpenAI互換の代替サーバー（fake_openai_server.py）を同じプロセスで起動し、
+「--start-api」「--start-app」で起動するAPI・アプリの接続先をそのサーバーに切り替えるため、
+OpenAIの利用枠を消費せずに実行できます。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/chat_load_test.py --target app --start-fake-openai --start-app --sessions 8 --turns 3
+    python benchmarks/chat_load_test.py --target api --start-fake-openai --start-api --sessions 32 --error-rate-429 0.05
+    python benchmarks/chat_load_test.py --target api --base-url http://127.0.0.1:8000 --sessions 16
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+import aiohttp
+import httpx
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ClientState_pb2 import ClientState
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState, WidgetStates
+import constants as ct
+from benchmarks import fake_openai_server
+from benchmarks.api_load_test import wait_until_ready
+from benchmarks.retrieval_benchmark import BENCHMARK_DIR, DEFAULT_QUERIES_PATH, load_golden_queries, percentiles
+
+
+############################################################
+# 設定関連
+############################################################
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARK_DIR, "results", "chat_load.json")
+# target=app で実行するStreamlitのアプリ
+APP_SCRIPT_PATH = "main.py"
+# アプリの起動と、初回表示（インデックスの作成）を待つ最大時間（秒）
+APP_READY_TIMEOUT_SECONDS = 300
+# スクリプトの実行が完了したとみなす状態（再実行のための中断・フラグメントのみの実行は含めない）
+APP_FINISHED_STATUSES = (ForwardMsg.FINISHED_SUCCESSFULLY, ForwardMsg.FINISHED_WITH_COMPILE_ERROR)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_question(queries, session_number, turn):
+    """
+    セッション・やりとりの回数に応じた質問の取得（セッションごとに異なる質問から始める）
+
+    Args:
+        queries: 質問のリスト
+        session_number: セッションの番号
+        turn: やりとりの回数
+
+    Returns:
+        質問
+    """
+    return queries[(session_number * 7 + turn) % len(queries)]
+
+
+async def run_api_session(client, session_number, queries, turns, think_time, results):
+    """
+    HTTP APIに対する1セッション分のやりとり
+
+    Args:
+        client: HTTPクライアント
+        session_number: セッションの番号
+        queries: 質問のリスト
+        turns: やりとりの回数
+        think_time: やりとりの間の待ち時間（秒）
+        results: レイテンシ（ミリ秒）と結果の種類の組を追加するリスト
+    """
+    chat_history = []
+    for turn in range(turns):
+        question = get_question(queries, session_number, turn)
+        payload = {"question": question, "chat_history": chat_history, "client_id": f"load-{session_number}"}
+        start = time.perf_counter()
+        try:
+            response = await client.post("/answer", json=payload)
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        results.append(((time.perf_counter() - start) * 1000, status))
+
+        if status == "200":
+            chat_history += [{"role": "user", "content": question},
+                             {"role": "assistant", "content": response.json()["answer"]}]
+        await asyncio.sleep(think_time)
+
+
+async def run_api_load(base_url, sessions, queries, turns, think_time, timeout):
+    """
+    HTTP APIに対して、複数のセッションを同時に実行
+
+    Args:
+        base_url: APIサーバーのURL
+        sessions: 同時に実行するセッション数
+        queries: 質問のリスト
+        turns: 1セッションあたりのやりとりの回数
+        think_time: やりとりの間の待ち時間（秒）
+        timeout: 1リクエストあたりのタイムアウト（秒）
+
+    Returns:
+        レイテンシ（ミリ秒）と結果の種類の組のリストと、全体の所要時間（秒）の組
+    """
+    results = []
+    limits = httpx.Limits(max_connections=sessions, max_keepalive_connections=sessions)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        await wait_until_ready(client)
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_api_session(client, number, queries, turns, think_time, results) for number in range(sessions)
+        ])
+    return results, time.perf_counter() - start
+
+
+async def run_app_script(ws, query_string, widget_states=None):
+    """
+    Streamlitのアプリのスクリプトを1回実行し、完了を待つ（ブラウザと同じWebSocketのプロトコルで、再実行を要求する）
+
+    Args:
+        ws: アプリとのWebSocket接続
+        query_string: URLのクエリ文字列（アプリが設定したセッションIDを引き継ぐ）
+        widget_states: 送信するウィジェットの状態のリスト（チャット入力の送信など）
+
+    Returns:
+        チャット入力欄のID・画面に表示されたエラーの件数・クエリ文字列の辞書
+    """
+    client_state = ClientState(query_string=query_string, widget_states=WidgetStates(widgets=widget_states or []))
+    await ws.send_bytes(BackMsg(rerun_script=client_state).SerializeToString())
+
+    state = {"chat_input_id": None, "errors": 0, "query_string": query_string}
+    async for message in ws:
+        if message.type != aiohttp.WSMsgType.BINARY:
+            raise ConnectionError(f"Unexpected websocket message: {message.type}")
+        forward_msg = ForwardMsg()
+        forward_msg.ParseFromString(message.data)
+        msg_type = forward_msg.WhichOneof("type")
+
+        if msg_type == "delta" and forward_msg.delta.WhichOneof("type") == "new_element":
+            element = forward_msg.delta.new_element
+            element_type = element.WhichOneof("type")
+            if element_type == "chat_input":
+                state["chat_input_id"] = element.chat_input.id
+            elif element_type == "exception" or (element_type == "alert" and element.alert.format == Alert.ERROR):
+                state["errors"] += 1
+        elif msg_type == "page_info_changed":
+            state["query_string"] = forward_msg.page_info_changed.query_string
+        elif msg_type == "script_finished" and forward_msg.script_finished in APP_FINISHED_STATUSES:
+            return state
+    raise ConnectionError("Websocket closed before the script finished")
+
+
+async def run_app_session(http, url, session_number, queries, turns, think_time, timeout, results):
+    """
+    Streamlitのアプリに対する1セッション分のやりとり（画面の初回表示は計測に含めない）
+
+    Args:
+        http: HTTPセッション
+        url: アプリのWebSocketのURL
+        session_number: セッションの番号
+        queries: 質問のリスト
+        turns: やりとりの回数
+        think_time: やりとりの間の待ち時間（秒）
+        timeout: 1回のやりとりあたりのタイムアウト（秒）
+        results: レイテンシ（ミリ秒）と結果の種類の組を追加するリスト
+    """
+    async with http.ws_connect(url, protocols=["streamlit"], max_msg_size=0) as ws:
+        state = await asyncio.wait_for(run_app_script(ws, ""), timeout)
+        for turn in range(turns):
+            chat_input = WidgetState(id=state["chat_input_id"])
+            chat_input.string_trigger_value.data = get_question(queries, session_number, turn)
+            start = time.perf_counter()
+            try:
+                state = await asyncio.wait_for(run_app_script(ws, state["query_string"], [chat_input]), timeout)
+                # 画面にエラーが表示された場合（回答の取得に失敗した場合など）はエラーとして数える
+                status = "error" if state["errors"] else "ok"
+            except (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError) as e:
+                results.append(((time.perf_counter() - start) * 1000, type(e).__name__))
+                return
+            results.append(((time.perf_counter() - start) * 1000, status))
+            await asyncio.sleep(think_time)
+
+
+async def run_app_load(app_url, sessions, queries, turns, think_time, timeout):
+    """
+    Streamlitのアプリに対して、複数のセッションを同時に実行
+    （インデックスの作成を計測に含めないよう、事前に1セッション分の初回表示を行う）
+
+    Args:
+        app_url: アプリのURL
+        sessions: 同時に実行するセッション数
+        queries: 質問のリスト
+        turns: 1セッションあたりのやりとりの回数
+        think_time: やりとりの間の待ち時間（秒）
+        timeout: 1回のやりとりあたりのタイムアウト（秒）
+
+    Returns:
+        レイテンシ（ミリ秒）と結果の種類の組のリストと、全体の所要時間（秒）の組
+    """
+    url = f"{app_url.rstrip('/')}/_stcore/stream"
+    results = []
+    async with aiohttp.ClientSession() as http:
+        async with http.ws_connect(url, protocols=["streamlit"], max_msg_size=0) as ws:
+            await asyncio.wait_for(run_app_script(ws, ""), APP_READY_TIMEOUT_SECONDS)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_app_session(http, url, number, queries, turns, think_time, timeout, results) for number in range(sessions)
+        ])
+    return results, time.perf_counter() - start
+
+
+def start_app(port):
+    """
+    Streamlitのアプリを別プロセスで起動し、接続を受け付けられるようになるまで待つ
+    （環境変数は引き継ぐため、OpenAI互換の代替サーバーへの接続先も引き継がれる）
+
+    Args:
+        port: 待ち受けるポート番号
+
+    Returns:
+        アプリのプロセス
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP_SCRIPT_PATH,
+         "--server.headless", "true", "--server.port", str(port), "--browser.gatherUsageStats", "false"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + APP_READY_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/_stcore/health").status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Streamlit app was not ready within {APP_READY_TIMEOUT_SECONDS} seconds")
+
+
+def summarize(results, elapsed):
+    """
+    計測結果の集計
+
+    Args:
+        results: レイテンシ（ミリ秒）と結果の種類の組のリスト
+        elapsed: 全体の所要時間（秒）
+
+    Returns:
+        スループット・エラー率・レイテンシのパーセンタイル・結果の種類ごとの件数の辞書
+    """
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    succeeded = statuses.get("200", 0) + statuses.get("ok", 0)
+    successful_latencies = [latency for latency, status in results if status in ("200", "ok")]
+
+    return {
+        "turns": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_tps": round(len(results) / elapsed, 3),
+        "error_rate": round(1 - succeeded / len(results), 4) if results else 0.0,
+        "statuses": statuses,
+        "latency_ms": percentiles([latency for latency, _ in results]) if results else None,
+        "successful_latency_ms": percentiles(successful_latencies) if successful_latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数のチャットセッションを模擬する負荷試験")
+    parser.add_argument("--target", default="api", choices=["api", "app"], help="計測対象（HTTP API または Streamlitのアプリ）")
+    parser.add_argument("--base-url", default=f"http://{ct.API_HOST}:{ct.API_PORT}", help="target=api のAPIサーバーのURL")
+    parser.add_argument("--sessions", type=int, default=8, help="同時に実行するセッション数")
+    parser.add_argument("--turns", type=int, default=3, help="1セッションあたりのやりとりの回数")
+    parser.add_argument("--think-time-ms", type=float, default=0, help="やりとりの間の待ち時間（ミリ秒）")
+    parser.add_argument("--timeout", type=float, default=180, help="1回のやりとりあたりのタイムアウト（秒）")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH, help="ゴールデンクエリのファイル")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="JSONレポートの出力先")
+    parser.add_argument("--start-fake-openai", action="store_true", help="OpenAI互換の代替サーバーを同じプロセスで起動して使う")
+    parser.add_argument("--fake-openai-port", type=int, default=fake_openai_server.DEFAULT_PORT, help="代替サーバーのポート番号")
+    parser.add_argument("--start-api", action="store_true", help="target=api のAPIサーバーを同じプロセスで起動する")
+    parser.add_argument("--app-url", default="http://127.0.0.1:8501", help="target=app のアプリのURL")
+    parser.add_argument("--start-app", action="store_true", help="target=app のアプリを別プロセスで起動する")
+    fake_openai_server.add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    backend = None
+    if args.start_fake_openai:
+        backend = fake_openai_server.create_backend(args)
+        fake_openai_server.start_in_background(backend, port=args.fake_openai_port)
+        # 本物のOpenAIに接続しないよう、APIキーもダミーの値に置き換える
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.fake_openai_port}/v1"
+        os.environ["OPENAI_API_KEY"] = "fake-openai-key"
+    if args.target == "api" and args.start_api:
+        import api_server
+        os.environ.setdefault("API_PORT", args.base_url.rsplit(":", 1)[-1].split("/")[0])
+        api_server.start_in_background()
+
+    app_process = None
+    if args.target == "app" and args.start_app:
+        app_process = start_app(int(args.app_url.rsplit(":", 1)[-1].split("/")[0]))
+
+    queries = [item["query"] for item in load_golden_queries(args.queries)]
+    think_time = args.think_time_ms / 1000
+    try:
+        if args.target == "api":
+            coroutine = run_api_load(args.base_url, args.sessions, queries, args.turns, think_time, args.timeout)
+        else:
+            coroutine = run_app_load(args.app_url, args.sessions, queries, args.turns, think_time, args.timeout)
+        results, elapsed = asyncio.run(coroutine)
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+    summary = summarize(results, elapsed)
+    print(
+        f"target={args.target} sessions={args.sessions} throughput={summary['throughput_tps']:.2f}turns/s "
+        f"errors={summary['error_rate']:.1%} p50={summary['latency_ms']['p50']:.0f}ms p95={summary['latency_ms']['p95']:.0f}ms"
+    )
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "settings": {
+            "target": args.target, "sessions": args.sessions, "turns": args.turns, "think_time_ms": args.think_time_ms,
+            "fake_openai": {
+                "latency": args.latency, "embedding_latency": args.embedding_latency,
+                "error_rate_429": args.error_rate_429, "error_rate_500": args.error_rate_500, "seed": args.seed,
+            } if backend is not None else None,
+        },
+        "summary": summary,
+        "fake_openai_stats": backend.stats() if backend is not None else None,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"レポートを出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
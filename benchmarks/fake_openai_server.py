@@ -0,0 +1,408 @@
+"""
+このファイルは、負荷試験をOpenAIの利用枠を消費せずに行うための、OpenAI互換のAPIサーバー（代替実装）です。
+- POST /v1/chat/completions: 最後のユーザー入力をもとにした決定的な回答を返す（ストリーミングにも対応）
+- POST /v1/embeddings: 文字N-gramのハッシュによる決定的なベクトルを返す（benchmarks/offline_models.py と同じ方式）
+- GET /v1/models, GET /stats: モデル一覧と、受け付けたリクエスト数・注入したエラー数
+応答の遅延は分布（固定・一様・対数正規・指数）で指定でき、429（レート制限）・500のエラーを指定の割合で注入できます。
+遅延とエラーの注入は乱数のシードを固定すると再現でき、回答とベクトルは入力が同じであれば常に同じになります。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/fake_openai_server.py --port 8090 --latency lognormal:800:0.5 --error-rate-429 0.05
+アプリ・HTTP APIからは、環境変数で接続先を切り替えて使います:
+    OPENAI_BASE_URL=http://127.0.0.1:8090/v1 OPENAI_API_KEY=dummy streamlit run main.py
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from uuid import uuid4
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+from benchmarks.offline_models import HashingEmbeddings
+
+
+############################################################
+# 設定関連
+############################################################
+DEFAULT_PORT = 8090
+# 回答の末尾に付け足す文（指定の長さの回答を作るために繰り返す）
+FILLER_TEXT = "これは負荷試験用の模擬回答です。"
+# 埋め込みのトークンID列を文字列に変換する際に使う文字の範囲（CJK統合漢字拡張A）
+TOKEN_CHAR_BASE = 0x3400
+TOKEN_CHAR_RANGE = 0x19C0
+
+
+############################################################
+# 関数定義
+############################################################
+
+def parse_latency(spec):
+    """
+    遅延の分布の指定を解析し、遅延（秒）を1つ取り出す関数を作成
+
+    Args:
+        spec: 「fixed:ミリ秒」「uniform:最小:最大」「lognormal:中央値:シグマ」「exponential:平均」のいずれか
+
+    Returns:
+        乱数生成器を受け取り、遅延（秒）を返す関数
+    """
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    if kind == "fixed":
+        return lambda rng: values[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        # 中央値がvalues[0]ミリ秒になるよう、対数の平均を設定
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def get_message_text(message):
+    """
+    チャットのメッセージから本文のテキストを取得（複数の要素に分かれている場合は連結）
+
+    Args:
+        message: メッセージ
+
+    Returns:
+        本文のテキスト
+    """
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def to_embedding_text(item):
+    """
+    埋め込みの入力をテキストに変換（トークンID列で送られた場合は、IDごとに1文字を割り当てる）
+
+    Args:
+        item: 文字列、またはトークンIDのリスト
+
+    Returns:
+        テキスト
+    """
+    if isinstance(item, str):
+        return item
+    return "".join(chr(TOKEN_CHAR_BASE + token % TOKEN_CHAR_RANGE) for token in item)
+
+
+def create_app(backend):
+    """
+    OpenAI互換のAPIサーバーのアプリケーションの作成
+
+    Args:
+        backend: 応答の内容・遅延・エラーの注入を決める代替実装
+
+    Returns:
+        アプリケーション
+    """
+    app = FastAPI(title="Fake OpenAI API")
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": backend.model, "object": "model", "owned_by": "fake"}]}
+
+    @app.get("/stats")
+    async def stats():
+        return backend.stats()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        error = await backend.begin("chat")
+        if error is not None:
+            return error
+
+        content = backend.build_answer(body.get("messages", []))
+        prompt_tokens = sum(len(get_message_text(message)) for message in body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                 "total_tokens": prompt_tokens + len(content)}
+        backend.add_tokens(usage)
+        completion_id = f"chatcmpl-{uuid4().hex}"
+        model = body.get("model", backend.model)
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        return StreamingResponse(
+            backend.stream_answer(completion_id, model, content, usage if include_usage else None),
+            media_type="text/event-stream"
+        )
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        error = await backend.begin("embeddings")
+        if error is not None:
+            return error
+
+        inputs = body.get("input", [])
+        # 文字列1件、トークンID列1件の場合もリストとして扱う
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        texts = [to_embedding_text(item) for item in inputs]
+        vectors = backend.embeddings.embed_documents(texts)
+        tokens = sum(len(text) for text in texts)
+        backend.add_tokens({"prompt_tokens": tokens, "completion_tokens": 0, "total_tokens": tokens})
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)],
+            "model": body.get("model", backend.embedding_model),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    return app
+
+
+def create_server(backend, host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    OpenAI互換のAPIサーバーの作成
+
+    Args:
+        backend: 応答の内容・遅延・エラーの注入を決める代替実装
+        host: 待ち受けるアドレス
+        port: 待ち受けるポート番号
+
+    Returns:
+        APIサーバー
+    """
+    config = uvicorn.Config(create_app(backend), host=host, port=port, log_level="warning")
+    return uvicorn.Server(config)
+
+
+def start_in_background(backend, host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    OpenAI互換のAPIサーバーを別スレッドで起動し、接続を受け付けられるようになるまで待つ（負荷試験と同じプロセスで使う用）
+
+    Args:
+        backend: 応答の内容・遅延・エラーの注入を決める代替実装
+        host: 待ち受けるアドレス
+        port: 待ち受けるポート番号
+
+    Returns:
+        APIサーバー（「should_exit」をTrueにすると停止する）
+    """
+    server = create_server(backend, host, port)
+    threading.Thread(target=server.run, name="fake-openai", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def add_backend_arguments(parser):
+    """
+    代替実装の設定を指定するコマンドライン引数の追加（負荷試験から同じプロセスで起動する場合にも使う）
+
+    Args:
+        parser: 引数のパーサー
+    """
+    parser.add_argument("--latency", default="lognormal:800:0.4", help="チャットの応答の遅延の分布（ミリ秒）")
+    parser.add_argument("--embedding-latency", default="fixed:20", help="埋め込みの応答の遅延の分布（ミリ秒）")
+    parser.add_argument("--stream-chunk-chars", type=int, default=4, help="ストリーミングで1回に送る文字数")
+    parser.add_argument("--stream-chunk-delay-ms", type=float, default=20, help="ストリーミングで1回送るごとの遅延（ミリ秒）")
+    parser.add_argument("--answer-chars", type=int, default=200, help="回答の最小文字数（足りない分は定型文で埋める）")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="429（レート制限）を返す割合")
+    parser.add_argument("--error-rate-500", type=float, default=0.0, help="500を返す割合")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429で返す「retry-after」（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="遅延・エラー注入の乱数のシード")
+
+
+def create_backend(args):
+    """
+    コマンドライン引数から代替実装を作成
+
+    Args:
+        args: 解析済みの引数
+
+    Returns:
+        代替実装
+    """
+    return FakeOpenAIBackend(
+        latency=args.latency,
+        embedding_latency=args.embedding_latency,
+        stream_chunk_chars=args.stream_chunk_chars,
+        stream_chunk_delay=args.stream_chunk_delay_ms / 1000,
+        answer_chars=args.answer_chars,
+        error_rate_429=args.error_rate_429,
+        error_rate_500=args.error_rate_500,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="負荷試験用のOpenAI互換APIサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="待ち受けるポート番号")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"OPENAI_BASE_URL=http://{args.host}:{args.port}/v1")
+    create_server(create_backend(args), args.host, args.port).run()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class FakeOpenAIBackend:
+    """
+    OpenAI互換のAPIサーバーの応答の内容・遅延・エラーの注入を決める代替実装
+    """
+
+    def __init__(self, latency="fixed:0", embedding_latency="fixed:0", stream_chunk_chars=4, stream_chunk_delay=0.0,
+                 answer_chars=0, error_rate_429=0.0, error_rate_500=0.0, retry_after=1.0, seed=0,
+                 model="gpt-4o-mini", embedding_model="text-embedding-3-small"):
+        """
+        Args:
+            latency: チャットの応答の遅延の分布（「parse_latency」の形式、ミリ秒）
+            embedding_latency: 埋め込みの応答の遅延の分布
+            stream_chunk_chars: ストリーミングで1回に送る文字数
+            stream_chunk_delay: ストリーミングで1回送るごとの遅延（秒）
+            answer_chars: 回答の最小文字数
+            error_rate_429: 429（レート制限）を返す割合
+            error_rate_500: 500を返す割合
+            retry_after: 429で返す「retry-after」（秒）
+            seed: 遅延・エラー注入の乱数のシード
+            model: モデル一覧で返すチャットのモデル名
+            embedding_model: 埋め込みのモデル名
+        """
+        self.latency = {"chat": parse_latency(latency), "embeddings": parse_latency(embedding_latency)}
+        self.stream_chunk_chars = stream_chunk_chars
+        self.stream_chunk_delay = stream_chunk_delay
+        self.answer_chars = answer_chars
+        self.error_rate_429 = error_rate_429
+        self.error_rate_500 = error_rate_500
+        self.retry_after = retry_after
+        self.model = model
+        self.embedding_model = embedding_model
+        self.embeddings = HashingEmbeddings(dimension=1536)
+        self.rng = random.Random(seed)
+        self.counts = {"chat": 0, "embeddings": 0, "errors_429": 0, "errors_500": 0, "total_tokens": 0}
+
+    async def begin(self, kind):
+        """
+        リクエストの受け付け（遅延を待ち、エラーを注入する場合はエラーの応答を返す）
+
+        Args:
+            kind: リクエストの種類（「chat」または「embeddings」）
+
+        Returns:
+            エラーの応答（エラーを注入しない場合はNone）
+        """
+        self.counts[kind] += 1
+        delay = self.latency[kind](self.rng)
+        draw = self.rng.random()
+        await asyncio.sleep(delay)
+
+        if draw < self.error_rate_429:
+            self.counts["errors_429"] += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after": str(self.retry_after)},
+                content={"error": {"message": "Rate limit reached (injected)", "type": "requests",
+                                   "code": "rate_limit_exceeded"}},
+            )
+        if draw < self.error_rate_429 + self.error_rate_500:
+            self.counts["errors_500"] += 1
+            return JSONResponse(
+                status_code=500,
+                content={"error": {"message": "Internal server error (injected)", "type": "server_error"}},
+            )
+        return None
+
+    def build_answer(self, messages):
+        """
+        決定的な回答の作成（最後のユーザー入力を含め、指定の文字数まで定型文で埋める）
+
+        Args:
+            messages: チャットのメッセージのリスト
+
+        Returns:
+            回答
+        """
+        user_messages = [get_message_text(message) for message in messages if message.get("role") == "user"]
+        question = user_messages[-1] if user_messages else ""
+        # 同じ入力には同じ回答を返すよう、入力のハッシュを回答に含める
+        digest = hashlib.blake2b(json.dumps(messages, ensure_ascii=False).encode("utf-8"), digest_size=4).hexdigest()
+        answer = f"{question}（模擬回答 {digest}）"
+        while len(answer) < self.answer_chars:
+            answer += FILLER_TEXT
+        return answer
+
+    async def stream_answer(self, completion_id, model, content, usage=None):
+        """
+        回答のストリーミング（Server-Sent Events形式で、一定の文字数ずつ遅延をはさんで送る）
+
+        Args:
+            completion_id: 回答のID
+            model: モデル名
+            content: 回答
+            usage: 最後に送る消費トークン数（Noneの場合は送らない）
+        """
+        def chunk(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for start in range(0, len(content), self.stream_chunk_chars):
+            await asyncio.sleep(self.stream_chunk_delay)
+            yield chunk({"content": content[start:start + self.stream_chunk_chars]})
+        yield chunk({}, finish_reason="stop")
+        if usage is not None:
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(payload)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def add_tokens(self, usage):
+        """
+        消費トークン数の加算
+
+        Args:
+            usage: 消費トークン数の辞書
+        """
+        self.counts["total_tokens"] += usage["total_tokens"]
+
+    def stats(self):
+        """
+        受け付けたリクエスト数・注入したエラー数の取得
+
+        Returns:
+            リクエストの種類ごとの件数・エラー数・消費トークン数の辞書
+        """
+        return dict(self.counts)
+
+
+if __name__ == "__main__":
+    main()
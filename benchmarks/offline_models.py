@@ -0,0 +1,86 @@
+"""
+このファイルは、ベンチマークをオフラインで再現性をもって実行するための、埋め込みモデルとLLMの代替実装を定義したファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hashlib
+import math
+from typing import List
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+############################################################
+# クラス定義
+############################################################
+
+class HashingEmbeddings(Embeddings):
+    """
+    文字N-gramをハッシュで固定次元に写像する決定的な埋め込みモデル
+    （同じ入力には常に同じベクトルを返し、ネットワークやモデルファイルを必要としない）
+    """
+
+    def __init__(self, dimension=384, ngram_range=(1, 3)):
+        """
+        Args:
+            dimension: ベクトルの次元数
+            ngram_range: 特徴量に使う文字N-gramの最小・最大長
+        """
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+
+    def _embed(self, text):
+        """
+        1件のテキストの埋め込み
+
+        Args:
+            text: 埋め込み対象のテキスト
+
+        Returns:
+            L2正規化済みのベクトル
+        """
+        vector = [0.0] * self.dimension
+        # 日本語は単語区切りがないため、空白を除いた文字列から文字N-gramを作成
+        normalized = "".join(text.lower().split())
+
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(normalized) - n + 1):
+                digest = hashlib.blake2b(normalized[i:i + n].encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                # 下位ビットで次元を、最上位ビットで符号を決める（ハッシュ衝突の偏りを打ち消すため）
+                index = value % self.dimension
+                sign = 1.0 if value >> 63 else -1.0
+                vector[index] += sign
+
+        # 「normalize_embeddings: True」の本番モデルと同様に、単位ベクトルにして返す
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm == 0:
+            return vector
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class EchoChatModel(BaseChatModel):
+    """
+    最後のユーザー入力をそのまま返す決定的なチャットモデル
+    （質問の書き換えでは元の質問がそのまま使われ、回答生成ではプロンプト構築までの処理時間が計測される）
+    """
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        # 最後のユーザー入力を回答として返す
+        human_messages = [message for message in messages if isinstance(message, HumanMessage)]
+        content = human_messages[-1].content if human_messages else ""
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-chat-model"
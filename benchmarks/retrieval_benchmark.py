@@ -0,0 +1,400 @@
+"""
+このファイルは、同梱のデータ（data/配下）に対する検索精度と検索速度を計測するベンチマークです。
+
+ゴールデンクエリ（golden_queries.json）ごとに、検索方式（vector / keyword / hybrid）とチャンク分割設定の組み合わせで
+recall@k・MRR・レイテンシのパーセンタイルを計測し、比較可能なJSONレポートを出力します。
+埋め込みモデルとLLMは決定的な代替実装を使うため、ネットワークに接続せずに実行できます。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/retrieval_benchmark.py
+    python benchmarks/retrieval_benchmark.py --chunk-strategy flat --chunk-configs 500:50,300:30 --backends vector,hybrid --repeat 5
+    python benchmarks/retrieval_benchmark.py --chunk-strategy parent_child --chunk-configs 120:20,80:10
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+from langchain_community.vectorstores import Chroma
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+import constants as ct
+import initialize
+import document_store
+from benchmarks.offline_models import HashingEmbeddings, EchoChatModel
+
+
+############################################################
+# 設定関連
+############################################################
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_QUERIES_PATH = os.path.join(BENCHMARK_DIR, "golden_queries.json")
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARK_DIR, "results", "retrieval.json")
+DEFAULT_CHUNK_CONFIGS = f"{ct.CHUNK_SIZE}:{ct.CHUNK_OVERLAP},300:30,1000:100"
+# 親子チャンクの場合の既定値（チャンク分割設定は子チャンクに適用するため、親チャンクの最大文字数より小さくする）
+DEFAULT_CHILD_CHUNK_CONFIGS = f"{ct.CHILD_CHUNK_SIZE}:{ct.CHILD_CHUNK_OVERLAP},80:10,200:30"
+DEFAULT_BACKENDS = "vector,keyword,hybrid"
+DEFAULT_KS = "1,3,5,10"
+
+# 質問の書き換え処理も計測対象とするための、固定の会話履歴
+BENCHMARK_CHAT_HISTORY = [
+    HumanMessage(content="社内の資料について質問させてください。"),
+    AIMessage(content="承知しました。"),
+]
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_golden_queries(path):
+    """
+    ゴールデンクエリの読み込み
+
+    Args:
+        path: ゴールデンクエリのJSONファイルのパス
+
+    Returns:
+        ゴールデンクエリのリスト
+    """
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_retrievers(docs_all, chunk_size, chunk_overlap, backends, embeddings, k, vector_store, chunk_strategy="flat"):
+    """
+    指定のチャンク分割設定で、各検索方式のRetrieverを作成
+
+    Args:
+        docs_all: チャンク分割前のドキュメントのリスト
+        chunk_size: チャンクの最大文字数
+        chunk_overlap: チャンク間の重複文字数
+        backends: 作成する検索方式のリスト
+        embeddings: 埋め込みモデル
+        k: 検索で取得するドキュメント数
+        vector_store: ベクトル検索に使うベクターストアの種類（「chroma」「numpy」「ann」「quantized」のいずれか）
+        chunk_strategy: チャンク分割方式（「flat」または「parent_child」、「parent_child」の場合はチャンク分割設定を子チャンクに適用）
+
+    Returns:
+        チャンク数（埋め込み対象のチャンク数）、検索方式ごとのRetriever、検索方式ごとの作成時間（ミリ秒）
+    """
+    if chunk_strategy == "parent_child":
+        parent_docs, splitted_docs = initialize.split_parent_child_documents(
+            docs_all, child_chunk_size=chunk_size, child_chunk_overlap=chunk_overlap
+        )
+    else:
+        parent_docs = None
+        splitted_docs = initialize.split_documents(docs_all, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    initialize.sanitize_metadata(splitted_docs)
+    # アプリと同じく、ベクトル検索・キーワード検索でチャンクストアを共有する
+    chunk_store = document_store.DocumentStore.from_documents(splitted_docs)
+    parent_store = document_store.DocumentStore.from_documents(parent_docs) if parent_docs is not None else None
+
+    retrievers = {}
+    build_time_ms = {}
+
+    # ベクトル検索（ハイブリッド検索でも使うため、どちらかが指定されていれば作成）
+    if "vector" in backends or "hybrid" in backends:
+        start = time.perf_counter()
+        if vector_store == "chroma":
+            # 同一プロセス内のChromaクライアントは既定のコレクションを共有するため、設定ごとに別名のコレクションを作成
+            db = Chroma.from_documents(splitted_docs, embedding=embeddings, collection_name=f"benchmark-{uuid4().hex}")
+        else:
+            db = initialize.create_vectorstore(chunk_store, embeddings, store_type=vector_store)
+        retrievers["vector"] = initialize.create_vector_retriever(db, parent_store, k=k)
+        build_time_ms["vector"] = (time.perf_counter() - start) * 1000
+
+    # キーワード検索
+    if "keyword" in backends or "hybrid" in backends:
+        start = time.perf_counter()
+        retrievers["keyword"] = initialize.create_simple_keyword_retriever(
+            parent_store if parent_store is not None else chunk_store
+        )
+        build_time_ms["keyword"] = (time.perf_counter() - start) * 1000
+
+    # ハイブリッド検索
+    if "hybrid" in backends:
+        start = time.perf_counter()
+        retrievers["hybrid"] = initialize.create_hybrid_retriever([retrievers["vector"], retrievers["keyword"]], k=k)
+        build_time_ms["hybrid"] = build_time_ms["vector"] + build_time_ms["keyword"] + (time.perf_counter() - start) * 1000
+
+    retrievers = {name: retriever for name, retriever in retrievers.items() if name in backends}
+    return len(splitted_docs), retrievers, build_time_ms
+
+
+def build_answer_chain(retriever):
+    """
+    「get_llm_response」と同じ構成のChainを、代替LLMで作成
+
+    Args:
+        retriever: 検索に使うRetriever
+
+    Returns:
+        「RAG x 会話履歴の記憶機能」のChain
+    """
+    llm = EchoChatModel()
+    question_generator_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ]
+    )
+    question_answer_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", ct.SYSTEM_PROMPT_INQUIRY),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ]
+    )
+    history_aware_retriever = create_history_aware_retriever(llm, retriever, question_generator_prompt)
+    question_answer_chain = create_stuff_documents_chain(llm, question_answer_prompt)
+    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
+
+
+def first_relevant_rank(sources, relevant):
+    """
+    検索結果の中で、最初に正解のファイルが現れた順位を取得
+
+    Args:
+        sources: 検索結果のファイルパスのリスト（順位順）
+        relevant: 正解ファイルのパスに含まれる文字列のリスト
+
+    Returns:
+        1始まりの順位（正解が含まれない場合はNone）
+    """
+    for rank, source in enumerate(sources, start=1):
+        if any(pattern in source for pattern in relevant):
+            return rank
+    return None
+
+
+def recall_at_k(sources, relevant, k):
+    """
+    上位k件に含まれる正解の割合を算出
+
+    Args:
+        sources: 検索結果のファイルパスのリスト（順位順）
+        relevant: 正解ファイルのパスに含まれる文字列のリスト
+        k: 評価対象とする上位件数
+
+    Returns:
+        recall@k
+    """
+    top_sources = sources[:k]
+    hits = sum(1 for pattern in relevant if any(pattern in source for source in top_sources))
+    return hits / len(relevant)
+
+
+def percentiles(values):
+    """
+    レイテンシのパーセンタイルを算出
+
+    Args:
+        values: 計測値（ミリ秒）のリスト
+
+    Returns:
+        平均・p50・p95・p99・最大値の辞書
+    """
+    ordered = sorted(values)
+
+    def pick(p):
+        # 線形補間によるパーセンタイル
+        position = (len(ordered) - 1) * p
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+    return {
+        "mean": round(statistics.fmean(ordered), 3),
+        "p50": round(pick(0.50), 3),
+        "p95": round(pick(0.95), 3),
+        "p99": round(pick(0.99), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def summarize(per_query, ks):
+    """
+    クエリごとの評価結果を集計
+
+    Args:
+        per_query: クエリごとの評価結果のリスト
+        ks: recall@kを算出するkのリスト
+
+    Returns:
+        recall@kとMRRの辞書
+    """
+    summary = {}
+    for k in ks:
+        summary[f"recall@{k}"] = round(statistics.fmean(q["recall"][str(k)] for q in per_query), 4)
+    summary["mrr"] = round(statistics.fmean(1 / q["rank"] if q["rank"] else 0.0 for q in per_query), 4)
+    return summary
+
+
+def evaluate_backend(retriever, queries, ks, repeat, measure_answer):
+    """
+    1つの検索方式に対して、全ゴールデンクエリの精度と速度を計測
+
+    Args:
+        retriever: 計測対象のRetriever
+        queries: ゴールデンクエリのリスト
+        ks: recall@kを算出するkのリスト
+        repeat: レイテンシ計測の繰り返し回数
+        measure_answer: 代替LLMを使った回答生成までの処理時間も計測するかどうか
+
+    Returns:
+        計測結果の辞書
+    """
+    per_query = []
+    latencies = []
+    answer_latencies = []
+    context_chars = []
+    answer_chain = build_answer_chain(retriever) if measure_answer else None
+
+    for query in queries:
+        # 1回目の検索結果を精度評価に使い、全回の処理時間をレイテンシとして記録
+        for i in range(repeat):
+            start = time.perf_counter()
+            docs = retriever.invoke(query["query"])
+            latencies.append((time.perf_counter() - start) * 1000)
+            if i == 0:
+                sources = [doc.metadata.get("source", "") for doc in docs]
+
+        if answer_chain is not None:
+            start = time.perf_counter()
+            response = answer_chain.invoke({"input": query["query"], "chat_history": BENCHMARK_CHAT_HISTORY})
+            answer_latencies.append((time.perf_counter() - start) * 1000)
+            context_chars.append(sum(len(doc.page_content) for doc in response["context"]))
+
+        per_query.append({
+            "id": query["id"],
+            "category": query["category"],
+            "rank": first_relevant_rank(sources, query["relevant"]),
+            "recall": {str(k): recall_at_k(sources, query["relevant"], k) for k in ks},
+            "retrieved": sources[:max(ks)],
+        })
+
+    # カテゴリ別（社員名簿・議事録ルール・顧客別議事録など）の集計
+    by_category = {}
+    for category in sorted({q["category"] for q in per_query}):
+        by_category[category] = summarize([q for q in per_query if q["category"] == category], ks)
+
+    result = summarize(per_query, ks)
+    result["latency_ms"] = percentiles(latencies)
+    if answer_latencies:
+        result["answer_latency_ms"] = percentiles(answer_latencies)
+        result["mean_context_chars"] = round(statistics.fmean(context_chars), 1)
+    result["by_category"] = by_category
+    result["queries"] = per_query
+    return result
+
+
+def parse_chunk_configs(value):
+    """
+    「500:50,300:30」形式のチャンク分割設定を解析
+
+    Args:
+        value: コマンドライン引数の文字列
+
+    Returns:
+        （チャンクの最大文字数, 重複文字数）のリスト
+    """
+    configs = []
+    for item in value.split(","):
+        chunk_size, chunk_overlap = item.split(":")
+        configs.append((int(chunk_size), int(chunk_overlap)))
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同梱データに対する検索精度・検索速度のベンチマーク")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH, help="ゴールデンクエリのJSONファイル")
+    parser.add_argument("--chunk-configs", default=None, help="チャンク分割設定（「サイズ:重複」をカンマ区切り、「parent_child」の場合は子チャンクの設定）")
+    parser.add_argument("--backends", default=DEFAULT_BACKENDS, help="計測する検索方式（カンマ区切り）")
+    parser.add_argument("--vector-store", default=ct.VECTOR_STORE_TYPE, choices=["chroma", "numpy", "ann", "quantized"], help="ベクトル検索に使うベクターストア")
+    parser.add_argument("--chunk-strategy", default=ct.CHUNK_STRATEGY, choices=["flat", "parent_child"], help="チャンク分割方式")
+    parser.add_argument("--ks", default=DEFAULT_KS, help="recall@kを算出するk（カンマ区切り）")
+    parser.add_argument("--repeat", type=int, default=3, help="レイテンシ計測の繰り返し回数")
+    parser.add_argument("--no-answer", action="store_true", help="代替LLMを使った回答生成の計測を省略する")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="JSONレポートの出力先")
+    args = parser.parse_args()
+
+    if args.chunk_configs is None:
+        args.chunk_configs = DEFAULT_CHILD_CHUNK_CONFIGS if args.chunk_strategy == "parent_child" else DEFAULT_CHUNK_CONFIGS
+    chunk_configs = parse_chunk_configs(args.chunk_configs)
+    if args.chunk_strategy == "parent_child":
+        # 子チャンクが親チャンク以上の大きさの場合、子チャンクが親チャンクと同じになり、設定を比較する意味がない
+        too_large = [size for size, _ in chunk_configs if size >= ct.PARENT_CHUNK_SIZE]
+        if too_large:
+            parser.error(f"child chunk size must be smaller than PARENT_CHUNK_SIZE ({ct.PARENT_CHUNK_SIZE}): {too_large}")
+
+    queries = load_golden_queries(args.queries)
+    backends = args.backends.split(",")
+    ks = [int(k) for k in args.ks.split(",")]
+    embeddings = HashingEmbeddings()
+
+    # データソースの読み込み（Webページはオフライン実行のため対象外）
+    start = time.perf_counter()
+    docs_all = initialize.prepare_documents(include_web=False)
+    load_time_ms = (time.perf_counter() - start) * 1000
+    print(f"ドキュメント読み込み: {len(docs_all)}件 ({load_time_ms:.1f} ms)")
+
+    runs = []
+    for chunk_size, chunk_overlap in chunk_configs:
+        chunk_count, retrievers, build_time_ms = build_retrievers(
+            docs_all, chunk_size, chunk_overlap, backends, embeddings, max(ks), args.vector_store, args.chunk_strategy
+        )
+        run = {
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "chunks": chunk_count,
+            "build_time_ms": {name: round(value, 3) for name, value in build_time_ms.items()},
+            "backends": {},
+        }
+        for name, retriever in retrievers.items():
+            result = evaluate_backend(retriever, queries, ks, args.repeat, not args.no_answer)
+            run["backends"][name] = result
+            print(
+                f"chunk={chunk_size}:{chunk_overlap} backend={name:<8} "
+                f"recall@{max(ks)}={result[f'recall@{max(ks)}']:.3f} mrr={result['mrr']:.3f} "
+                f"p50={result['latency_ms']['p50']:.2f}ms p95={result['latency_ms']['p95']:.2f}ms"
+            )
+        runs.append(run)
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "settings": {
+            "queries": os.path.relpath(args.queries),
+            "query_count": len(queries),
+            "ks": ks,
+            "repeat": args.repeat,
+            "embedding": f"hashing-{embeddings.dimension}",
+            "vector_store": args.vector_store,
+            "chunk_strategy": args.chunk_strategy,
+            "llm": "echo" if not args.no_answer else None,
+        },
+        "corpus": {"documents": len(docs_all), "load_time_ms": round(load_time_ms, 3)},
+        "runs": runs,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"レポートを出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+このファイルは、ベクターストア（Chroma / NumPy / 近似最近傍探索 / 量子化）の作成時間・検索レイテンシ・メモリ使用量を比較するベンチマークです。
+
+埋め込みの計算時間を除いてベクターストア自体のコストを比較するため、乱数で作成した正規化済みベクトルを
+事前計算済みの埋め込みとして使います。ネットワークには接続しません。
+
+実行方法（リポジトリのルートで実行）:
+    python benchmarks/vector_store_benchmark.py
+    python benchmarks/vector_store_benchmark.py --sizes 1000,10000 --stores numpy --queries 500
+    python benchmarks/vector_store_benchmark.py --stores numpy,quantized,quantized-float16
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import sys
+sys.path.append('.')
+import argparse
+import gc
+import json
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from uuid import uuid4
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import Chroma
+from vector_index import NumpyVectorStore
+from ann_index import AnnVectorStore
+from quantized_index import QuantizedVectorStore
+from benchmarks.retrieval_benchmark import BENCHMARK_DIR, percentiles
+
+
+############################################################
+# 設定関連
+############################################################
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARK_DIR, "results", "vector_store.json")
+# 本番の埋め込みモデル（paraphrase-MiniLM-L3-v2）と同じ次元数
+DEFAULT_DIMENSION = 384
+# 絞り込み検索の計測に使う、メタデータ「source」の値の種類数
+SOURCE_COUNT = 50
+# 量子化ベクターストアの行列ファイルの保存先（アプリ本体のファイルと混ざらないよう分ける）
+QUANTIZED_STORAGE_DIR = os.path.join(BENCHMARK_DIR, "results", "vector_store")
+
+
+############################################################
+# クラス定義
+############################################################
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    テキストに対応する事前計算済みのベクトルを返す埋め込みモデル
+    """
+
+    def __init__(self, vectors_by_text):
+        self.vectors_by_text = vectors_by_text
+
+    def embed_documents(self, texts):
+        return [self.vectors_by_text[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors_by_text[text]
+
+
+############################################################
+# 関数定義
+############################################################
+
+def make_dataset(size, dimension, query_count, seed):
+    """
+    正規化済みの乱数ベクトルによるデータセットの作成
+
+    Args:
+        size: ドキュメント数
+        dimension: ベクトルの次元数
+        query_count: 検索クエリ数
+        seed: 乱数のシード
+
+    Returns:
+        テキスト、メタデータ、クエリ、埋め込みモデル
+    """
+    rng = np.random.default_rng(seed)
+    doc_vectors = rng.standard_normal((size, dimension)).astype(np.float32)
+    doc_vectors /= np.linalg.norm(doc_vectors, axis=1, keepdims=True)
+
+    # クエリはドキュメントのベクトルにノイズを加えたもの（実際の検索と同様に、近傍が存在する状態にする）
+    base = doc_vectors[rng.integers(0, size, query_count)]
+    query_vectors = base + 0.5 * rng.standard_normal((query_count, dimension)).astype(np.float32) / np.sqrt(dimension)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+
+    texts = [f"doc-{i}" for i in range(size)]
+    metadatas = [{"source": f"file-{i % SOURCE_COUNT}"} for i in range(size)]
+    queries = [f"query-{j}" for j in range(query_count)]
+
+    vectors_by_text = {text: vector.tolist() for text, vector in zip(texts, doc_vectors)}
+    vectors_by_text.update({query: vector.tolist() for query, vector in zip(queries, query_vectors)})
+
+    return texts, metadatas, queries, PrecomputedEmbeddings(vectors_by_text)
+
+
+def current_rss_bytes():
+    """
+    現在のプロセスの常駐メモリ量（Linux以外では取得できないためNone）
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def build_store(store_type, texts, metadatas, embeddings):
+    """
+    ベクターストアの作成
+
+    Args:
+        store_type: ベクターストアの種類（「chroma」「numpy」「ann」「quantized」「quantized-float16」のいずれか）
+        texts: テキストのリスト
+        metadatas: メタデータのリスト
+        embeddings: 埋め込みモデル
+
+    Returns:
+        ベクターストア
+    """
+    if store_type == "numpy":
+        return NumpyVectorStore.from_texts(texts, embeddings, metadatas=metadatas)
+    if store_type == "ann":
+        return AnnVectorStore.from_texts(texts, embeddings, metadatas=metadatas)
+    if store_type.startswith("quantized"):
+        dtype = "float16" if store_type.endswith("float16") else "int8"
+        return QuantizedVectorStore.from_texts(
+            texts, embeddings, metadatas=metadatas, dtype=dtype, storage_dir=QUANTIZED_STORAGE_DIR
+        )
+    # 同一プロセス内のChromaクライアントは既定のコレクションを共有するため、計測ごとに別名のコレクションを作成
+    return Chroma.from_texts(texts, embeddings, metadatas=metadatas, collection_name=f"benchmark-{uuid4().hex}")
+
+
+def measure_store(store_type, texts, metadatas, queries, embeddings, k):
+    """
+    1種類のベクターストアについて、作成時間・メモリ使用量・検索レイテンシを計測
+
+    Args:
+        store_type: ベクターストアの種類
+        texts: テキストのリスト
+        metadatas: メタデータのリスト
+        queries: 検索クエリのリスト
+        embeddings: 埋め込みモデル
+        k: 取得件数
+
+    Returns:
+        計測結果の辞書と、クエリごとの検索結果（テキストのリスト）
+    """
+    gc.collect()
+    rss_before = current_rss_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = build_store(store_type, texts, metadatas, embeddings)
+    build_time_ms = (time.perf_counter() - start) * 1000
+    traced_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = current_rss_bytes()
+
+    # 絞り込みなしの検索
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        docs = store.similarity_search(query, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([doc.page_content for doc in docs])
+
+    # メタデータで全体の1/SOURCE_COUNTに絞り込んだ検索
+    filtered_latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        store.similarity_search(query, k=k, filter={"source": "file-0"})
+        filtered_latencies.append((time.perf_counter() - start) * 1000)
+
+    result = {
+        "build_time_ms": round(build_time_ms, 3),
+        "memory": {
+            "tracemalloc_bytes": traced_bytes,
+            "rss_delta_bytes": rss_after - rss_before if rss_before is not None else None,
+        },
+        "query_latency_ms": percentiles(latencies),
+        "filtered_query_latency_ms": percentiles(filtered_latencies),
+    }
+    if store_type != "chroma":
+        result["memory"]["index_bytes"] = store.memory_usage()
+
+    del store
+    return result, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクターストア（Chroma / NumPy / 近似最近傍探索 / 量子化）の比較ベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="ドキュメント数（カンマ区切り）")
+    parser.add_argument("--stores", default="chroma,numpy", help="計測するベクターストア（カンマ区切り）")
+    parser.add_argument("--dimension", type=int, default=DEFAULT_DIMENSION, help="ベクトルの次元数")
+    parser.add_argument("--queries", type=int, default=200, help="検索クエリ数")
+    parser.add_argument("--k", type=int, default=10, help="取得件数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH, help="JSONレポートの出力先")
+    args = parser.parse_args()
+
+    stores = args.stores.split(",")
+    runs = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        texts, metadatas, queries, embeddings = make_dataset(size, args.dimension, args.queries, args.seed)
+        run = {"size": size, "stores": {}}
+        results_by_store = {}
+
+        for store_type in stores:
+            result, results_by_store[store_type] = measure_store(store_type, texts, metadatas, queries, embeddings, args.k)
+            run["stores"][store_type] = result
+            print(
+                f"size={size:<8} store={store_type:<17} build={result['build_time_ms']:.1f}ms "
+                f"p50={result['query_latency_ms']['p50']:.3f}ms p95={result['query_latency_ms']['p95']:.3f}ms "
+                f"filtered_p50={result['filtered_query_latency_ms']['p50']:.3f}ms"
+            )
+
+        # NumPy（全件の厳密検索）の結果を正解として、その他のベクターストアの結果の一致率を算出
+        if "numpy" in results_by_store:
+            for store_type, approx_results in results_by_store.items():
+                if store_type == "numpy":
+                    continue
+                overlaps = [
+                    len(set(exact) & set(approx)) / max(len(exact), 1)
+                    for exact, approx in zip(results_by_store["numpy"], approx_results)
+                ]
+                run[f"{store_type}_recall_vs_exact"] = round(float(np.mean(overlaps)), 4)
+
+        runs.append(run)
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "numpy": np.__version__},
+        "settings": {"dimension": args.dimension, "queries": args.queries, "k": args.k, "seed": args.seed},
+        "runs": runs,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"レポートを出力しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
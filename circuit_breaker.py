@@ -0,0 +1,250 @@
+"""
+このファイルは、外部のバックエンド（OpenAIのLLM・埋め込みモデル、HuggingFaceの埋め込みモデル）ごとのサーキットブレーカーを定義したファイルです。
+連続して失敗したバックエンドへの呼び出しを一定時間遮断し、タイムアウトを待たずに即座に代替処理へ切り替えます。
+遮断の状態はプロセス内の全セッションで共有し、一定時間後に1件だけ試しに呼び出して（半開状態）復旧を確認します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import logging
+import threading
+import time
+from typing import List
+from langchain_core.embeddings import Embeddings
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するバックエンドごとのサーキットブレーカー
+_breakers = {}
+_breakers_lock = threading.Lock()
+# サーキットブレーカーの状態
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_breaker(name, is_failure=None):
+    """
+    プロセス内で共有するバックエンドのサーキットブレーカーの取得（未作成の場合は作成）
+
+    Args:
+        name: バックエンド名（「constants.py」の「CIRCUIT_BREAKERS」のキー）
+        is_failure: 作成時に設定する、エラーをバックエンドの障害とみなすかどうかを判定する関数
+
+    Returns:
+        サーキットブレーカー
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            failure_threshold, reset_timeout = ct.CIRCUIT_BREAKERS[name]
+            _breakers[name] = CircuitBreaker(name, failure_threshold, reset_timeout, is_failure)
+        return _breakers[name]
+
+
+def get_all_stats():
+    """
+    作成済みの全サーキットブレーカーの状態の取得
+
+    Returns:
+        「バックエンド名: 状態」の辞書
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+############################################################
+# クラス定義
+############################################################
+
+class CircuitOpenError(RuntimeError):
+    """
+    サーキットブレーカーが遮断中のため、バックエンドを呼び出さなかった場合のエラー
+    """
+
+
+class CircuitBreaker:
+    """
+    連続失敗回数がしきい値に達したバックエンドへの呼び出しを、一定時間遮断するサーキットブレーカー
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout, is_failure=None):
+        """
+        Args:
+            name: バックエンド名
+            failure_threshold: 遮断を始める連続失敗回数
+            reset_timeout: 遮断を続ける時間（秒、経過後に1件だけ試しに呼び出す）
+            is_failure: 発生したエラーをバックエンドの障害とみなすかどうかを判定する関数（省略時はすべてのエラー）
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda error: True)
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def call(self, func):
+        """
+        遮断中でなければバックエンドを呼び出し、結果に応じて状態を更新
+
+        Args:
+            func: バックエンドを呼び出す関数
+
+        Returns:
+            関数の戻り値
+        """
+        self._before_call()
+        try:
+            result = func()
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+
+    async def acall(self, func):
+        """
+        「call」の非同期版
+
+        Args:
+            func: バックエンドを呼び出すコルーチンを返す関数
+
+        Returns:
+            コルーチンの戻り値
+        """
+        self._before_call()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # 呼び出し元の都合で中断した場合は、成功・失敗のどちらにも数えない
+            with self._lock:
+                self._probing = False
+            raise
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+
+    def is_open(self):
+        """
+        呼び出しを遮断中かどうかの判定（試しの呼び出しの枠は確保しない）
+
+        Returns:
+            遮断時間の経過前、または試しの呼び出しの結果待ちの場合はTrue
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self._opened_at < self.reset_timeout
+            return self.state == HALF_OPEN and self._probing
+
+    def reject_if_open(self):
+        """
+        遮断中の場合は、呼び出しの準備（実行待ちなど）を始める前にエラーとする
+        """
+        if self.is_open():
+            with self._lock:
+                self.rejected += 1
+            raise CircuitOpenError(f"Circuit for '{self.name}' is {self.state}; skipping the call")
+
+    def stats(self):
+        """
+        サーキットブレーカーの状態の取得
+
+        Returns:
+            状態・連続失敗回数・遮断した呼び出し数の辞書
+        """
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+    def _before_call(self):
+        """
+        呼び出し可否の判定（遮断中の場合はエラー、遮断時間の経過後は1件だけ試しの呼び出しを許可）
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(f"Circuit for '{self.name}' is {self.state}; skipping the call")
+
+    def _on_success(self):
+        """
+        呼び出し成功時の状態更新（遮断を解除し、連続失敗回数をリセット）
+        """
+        with self._lock:
+            if self.state != CLOSED:
+                logging.getLogger(ct.LOGGER_NAME).info({"circuit_breaker": self.name, "state": CLOSED})
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def _on_failure(self, error):
+        """
+        呼び出し失敗時の状態更新（試しの呼び出しの失敗、または連続失敗回数がしきい値に達した場合は遮断）
+
+        Args:
+            error: 発生したエラー
+        """
+        with self._lock:
+            probing = self._probing
+            self._probing = False
+            if not self.is_failure(error):
+                # 入力内容の誤りなど、バックエンドの障害ではないエラーは数えない（試しの呼び出しの場合は応答があったため復旧とみなす）
+                if probing:
+                    self.state = CLOSED
+                    self.failures = 0
+                return
+            self.failures += 1
+            if probing or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                logging.getLogger(ct.LOGGER_NAME).warning(
+                    {"circuit_breaker": self.name, "state": OPEN, "failures": self.failures, "error": repr(error)}
+                )
+
+
+class ProtectedEmbeddings(Embeddings):
+    """
+    サーキットブレーカーを通して呼び出す埋め込みモデルのラッパー
+    """
+
+    def __init__(self, embeddings, breaker):
+        """
+        Args:
+            embeddings: 埋め込みモデル
+            breaker: サーキットブレーカー
+        """
+        self.embeddings = embeddings
+        self.breaker = breaker
+        # 埋め込みキャッシュのキーに、元の埋め込みモデル名が使われるようにする
+        self.model = getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.breaker.call(lambda: self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.breaker.call(lambda: self.embeddings.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.breaker.acall(lambda: self.embeddings.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.breaker.acall(lambda: self.embeddings.aembed_query(text))
@@ -9,6 +9,8 @@ import streamlit as st
 import pandas as pd
 import utils
 import constants as ct
+import session_store
+import usage_tracker
 
 
 ############################################################
@@ -46,6 +48,43 @@ def display_select_mode():
     st.code("人事部に所属している従業員情報を一覧化して", language=None)
 
 
+def display_search_scope():
+    """
+    検索範囲（カテゴリ・顧客・ファイル形式など）のセレクトボックスを表示（サイドバー用）
+    """
+    scopes = st.session_state.get("search_scopes", {})
+    st.selectbox(
+        label=ct.SEARCH_SCOPE_LABEL,
+        options=[ct.SEARCH_SCOPE_ALL, *scopes],
+        key="search_scope"
+    )
+    if ct.AUTO_DETECT_CUSTOMER_SCOPE:
+        st.caption(f"「{ct.SEARCH_SCOPE_ALL}」の場合、入力内容に顧客名が含まれていれば、その顧客の文書に絞り込んで検索します。")
+
+
+def display_usage_summary():
+    """
+    消費トークン数・料金の集計を表示（サイドバー用、URLのクエリパラメータ「usage」に管理者用トークンを指定した場合のみ）
+    """
+    if not usage_tracker.is_admin_token(st.query_params.get(ct.USAGE_QUERY_PARAM)):
+        return
+
+    tracker = usage_tracker.get_tracker()
+    session_usage = tracker.get_session(st.session_state.session_id)
+    with st.expander("利用状況（管理者向け）"):
+        st.markdown("#### このセッション")
+        st.metric("消費トークン数", f"{session_usage['total_tokens']:,}")
+        if session_usage["cost_usd"] is not None:
+            st.metric("料金（米ドル）", f"{session_usage['cost_usd']:.4f}")
+        st.caption(
+            f"リクエスト数: {session_usage['requests']}、入力のうち"
+            f"検索結果: {session_usage['context_tokens']:,}、会話履歴: {session_usage['history_tokens']:,}（見積もり）、"
+            f"他のセッションの結果の共有による節約: {session_usage['saved_tokens']:,}"
+        )
+        st.markdown("#### 全体")
+        st.json(tracker.summary(), expanded=False)
+
+
 def display_initial_ai_message():
     """
     AIメッセージの初期表示（メインエリア用）
@@ -65,73 +104,156 @@ def display_initial_ai_message():
 def display_conversation_log():
     """
     会話ログの一覧表示
+    （直近の会話のみを毎回描画し、それより前の会話はページ単位で必要な時だけ描画する）
     """
-    # 会話ログのループ処理
-    for message in st.session_state.messages:
-        # 「message」辞書の中の「role」キーには「user」か「assistant」が入っている
-        with st.chat_message(message["role"]):
-
-            # ユーザー入力値の場合、そのままテキストを表示するだけ
-            if message["role"] == "user":
-                st.markdown(message["content"])
-            
-            # LLMからの回答の場合
-            else:
-                # 「社内文書検索」の場合、テキストの種類に応じて表示形式を分岐処理
-                if message["content"]["mode"] == ct.ANSWER_MODE_1:
-                    
-                    # ファイルのありかの情報が取得できた場合（通常時）の表示処理
-                    if not "no_file_path_flg" in message["content"]:
-                        # ==========================================
-                        # ユーザー入力値と最も関連性が高いメインドキュメントのありかを表示
-                        # ==========================================
-                        # 補足文の表示
-                        st.markdown(message["content"]["main_message"])
+    messages = st.session_state.messages
 
-                        # 参照元のありかに応じて、適したアイコンを取得
-                        icon = utils.get_source_icon(message['content']['main_file_path'])
-                        # 参照元ドキュメントのページ番号が取得できた場合にのみ、ページ番号を表示
-                        if "main_page_number" in message["content"]:
-                            st.success(f"{message['content']['main_file_path']} （ページNo.{message['content']['main_page_number']}）", icon=icon)
-                        else:
-                            st.success(f"{message['content']['main_file_path']}", icon=icon)
-                        
-                        # ==========================================
-                        # ユーザー入力値と関連性が高いサブドキュメントのありかを表示
-                        # ==========================================
-                        if "sub_message" in message["content"]:
-                            # 補足メッセージの表示
-                            st.markdown(message["content"]["sub_message"])
-
-                            # サブドキュメントのありかを一覧表示
-                            for sub_choice in message["content"]["sub_choices"]:
-                                # 参照元のありかに応じて、適したアイコンを取得
-                                icon = utils.get_source_icon(sub_choice['source'])
-                                # 参照元ドキュメントのページ番号が取得できた場合にのみ、ページ番号を表示
-                                if "page_number" in sub_choice:
-                                    st.info(f"{sub_choice['source']} （ページNo.{sub_choice['page_number']}）", icon=icon)
-                                else:
-                                    st.info(f"{sub_choice['source']}", icon=icon)
-                    # ファイルのありかの情報が取得できなかった場合、LLMからの回答のみ表示
-                    else:
-                        st.markdown(message["content"]["answer"])
+    # 直近の会話として毎回描画する範囲と、それより前の会話の境界
+    window_start = max(0, len(messages) - ct.CONVERSATION_LOG_WINDOW_SIZE)
+    # 直近より前の会話の件数（メモリから外してデータベースのみに保存している会話も含む）
+    older_count = st.session_state.spilled_message_count + window_start
+
+    # 直近より前の会話が存在する場合のみ、過去の会話の表示欄を用意
+    if older_count > 0:
+        display_older_conversation_log(older_count)
+
+    # 直近の会話ログのループ処理（会話が長くなっても描画量は一定）
+    for message in messages[window_start:]:
+        display_message(message)
+
+
+@st.fragment
+def display_older_conversation_log(older_count):
+    """
+    直近より前の会話ログをページ単位で表示
+    （フラグメント化しているため、表示切り替えやページ移動ではこの部分のみが再実行される）
+
+    Args:
+        older_count: 直近より前の会話の件数
+    """
+    # 表示するかどうかの切り替え（既定では非表示とし、描画コストを発生させない）
+    # （ウィジェットはラベルや引数からも識別されるため、会話の件数で変わる値はラベル・引数に含めない）
+    show_older = st.toggle(ct.OLDER_CONVERSATION_LOG_LABEL, key="show_older_conversation_log")
+    st.caption(f"{older_count}件")
+    if not show_older:
+        return
+
+    # ページ数の算出（新しいページほど直近の会話に近い）
+    page_size = ct.CONVERSATION_LOG_PAGE_SIZE
+    page_count = (older_count + page_size - 1) // page_size
+    # 初回の表示では最新のページを選択し、以降は選択中のページを保持する
+    if "older_conversation_log_page" not in st.session_state:
+        st.session_state.older_conversation_log_page = page_count
+    page = st.number_input(label="ページ", min_value=1, step=1, key="older_conversation_log_page")
+    # 上限はページ数に合わせて丸める（上限を引数で渡すと、ページ数が変わるたびに選択がリセットされる）
+    page = min(int(page), page_count)
+    st.caption(f"{page} / {page_count}ページ")
+
+    # 選択されたページに含まれる会話のみを読み込んで描画
+    page_start = (page - 1) * page_size
+    page_end = min(page * page_size, older_count)
+    for message in load_conversation_log(page_start, page_end):
+        display_message(message)
+
+    st.divider()
+
+
+def load_conversation_log(start, end):
+    """
+    古い順の位置を指定して会話ログを取得
+    （メモリから外した会話はデータベースから、それ以外はメモリから取得）
+
+    Args:
+        start: 取得開始位置（最も古い会話が0）
+        end: 取得終了位置（この位置は含まない）
+
+    Returns:
+        会話ログのリスト
+    """
+    spilled_count = st.session_state.spilled_message_count
+    messages = []
+
+    if start < spilled_count:
+        messages.extend(session_store.get_store().load_messages(
+            st.session_state.session_id, start, min(end, spilled_count) - start
+        ))
+    if end > spilled_count:
+        messages.extend(st.session_state.messages[max(start, spilled_count) - spilled_count:end - spilled_count])
+
+    return messages
+
+
+def display_message(message):
+    """
+    会話ログ1件分の表示
+
+    Args:
+        message: 表示用の会話ログ1件（「role」と「content」を持つ辞書）
+    """
+    # 「message」辞書の中の「role」キーには「user」か「assistant」が入っている
+    with st.chat_message(message["role"]):
+
+        # ユーザー入力値の場合、そのままテキストを表示するだけ
+        if message["role"] == "user":
+            st.markdown(message["content"])
+        
+        # LLMからの回答の場合
+        else:
+            # 「社内文書検索」の場合、テキストの種類に応じて表示形式を分岐処理
+            if message["content"]["mode"] == ct.ANSWER_MODE_1:
                 
-                # 「社内問い合わせ」の場合の表示処理
+                # ファイルのありかの情報が取得できた場合（通常時）の表示処理
+                if not "no_file_path_flg" in message["content"]:
+                    # ==========================================
+                    # ユーザー入力値と最も関連性が高いメインドキュメントのありかを表示
+                    # ==========================================
+                    # 補足文の表示
+                    st.markdown(message["content"]["main_message"])
+
+                    # 参照元のありかに応じて、適したアイコンを取得
+                    icon = utils.get_source_icon(message['content']['main_file_path'])
+                    # 参照元ドキュメントのページ番号が取得できた場合にのみ、ページ番号を表示
+                    if "main_page_number" in message["content"]:
+                        st.success(f"{message['content']['main_file_path']} （ページNo.{message['content']['main_page_number']}）", icon=icon)
+                    else:
+                        st.success(f"{message['content']['main_file_path']}", icon=icon)
+                    
+                    # ==========================================
+                    # ユーザー入力値と関連性が高いサブドキュメントのありかを表示
+                    # ==========================================
+                    if "sub_message" in message["content"]:
+                        # 補足メッセージの表示
+                        st.markdown(message["content"]["sub_message"])
+
+                        # サブドキュメントのありかを一覧表示
+                        for sub_choice in message["content"]["sub_choices"]:
+                            # 参照元のありかに応じて、適したアイコンを取得
+                            icon = utils.get_source_icon(sub_choice['source'])
+                            # 参照元ドキュメントのページ番号が取得できた場合にのみ、ページ番号を表示
+                            if "page_number" in sub_choice:
+                                st.info(f"{sub_choice['source']} （ページNo.{sub_choice['page_number']}）", icon=icon)
+                            else:
+                                st.info(f"{sub_choice['source']}", icon=icon)
+                # ファイルのありかの情報が取得できなかった場合、LLMからの回答のみ表示
                 else:
-                    # LLMからの回答を表示
                     st.markdown(message["content"]["answer"])
-
-                    # 参照元のありかを一覧表示
-                    if "file_info_list" in message["content"]:
-                        # 区切り線の表示
-                        st.divider()
-                        # 「情報源」の文字を太字で表示
-                        st.markdown(f"##### {message['content']['message']}")
-                        # ドキュメントのありかを一覧表示
-                        for file_info in message["content"]["file_info_list"]:
-                            # 参照元のありかに応じて、適したアイコンを取得
-                            icon = utils.get_source_icon(file_info)
-                            st.info(file_info, icon=icon)
+            
+            # 「社内問い合わせ」の場合の表示処理
+            else:
+                # LLMからの回答を表示
+                st.markdown(message["content"]["answer"])
+
+                # 参照元のありかを一覧表示
+                if "file_info_list" in message["content"]:
+                    # 区切り線の表示
+                    st.divider()
+                    # 「情報源」の文字を太字で表示
+                    st.markdown(f"##### {message['content']['message']}")
+                    # ドキュメントのありかを一覧表示
+                    for file_info in message["content"]["file_info_list"]:
+                        # 参照元のありかに応じて、適したアイコンを取得
+                        icon = utils.get_source_icon(file_info)
+                        st.info(file_info, icon=icon)
 
 
 def display_search_llm_response(llm_response):
@@ -161,8 +283,8 @@ def display_search_llm_response(llm_response):
         icon = utils.get_source_icon(main_file_path)
         # ページ番号が取得できた場合のみ、ページ番号を表示（ドキュメントによっては取得できない場合がある）
         if "page" in llm_response["context"][0].metadata:
-            # ページ番号を取得（0ベースから1ベースに変換）
-            main_page_number = llm_response["context"][0].metadata["page"] + 1
+            # ページ番号を取得（0ベースから1ベースに変換、複数ページにまたがる場合はページ範囲）
+            main_page_number = utils.get_page_label(llm_response["context"][0].metadata)
             # 「メインドキュメントのファイルパス」と「ページ番号」を表示
             st.success(f"{main_file_path} （ページNo.{main_page_number}）", icon=icon)
         else:
@@ -196,8 +318,8 @@ def display_search_llm_response(llm_response):
             
             # ページ番号が取得できない場合のための分岐処理
             if "page" in document.metadata:
-                # ページ番号を取得（0ベースから1ベースに変換）
-                sub_page_number = document.metadata["page"] + 1
+                # ページ番号を取得（0ベースから1ベースに変換、複数ページにまたがる場合はページ範囲）
+                sub_page_number = utils.get_page_label(document.metadata)
                 # 「サブドキュメントのファイルパス」と「ページ番号」の辞書を作成
                 sub_choice = {"source": sub_file_path, "page_number": sub_page_number}
             else:
@@ -335,8 +457,8 @@ def display_contact_llm_response(llm_response):
 
             # ページ番号が取得できた場合のみ、ページ番号を表示（ドキュメントによっては取得できない場合がある）
             if "page" in document.metadata:
-                # ページ番号を取得（0ベースから1ベースに変換）
-                page_number = document.metadata["page"] + 1
+                # ページ番号を取得（0ベースから1ベースに変換、複数ページにまたがる場合はページ範囲）
+                page_number = utils.get_page_label(document.metadata)
                 # 「ファイルパス」と「ページ番号」
                 file_info = f"{file_path} （ページNo.{page_number}）"
             else:
@@ -100,6 +100,9 @@ LINK_SOURCE_ICON = ":material/link: "
 WARNING_ICON = ":material/warning:"
 ERROR_ICON = ":material/error:"
 SPINNER_TEXT = "回答生成中..."
+OLDER_CONVERSATION_LOG_LABEL = "過去の会話を表示"
+CONVERSATION_LOG_WINDOW_SIZE = 20   # 毎回描画する直近の会話ログの件数
+CONVERSATION_LOG_PAGE_SIZE = 20     # 過去の会話ログを表示する際の1ページあたりの件数
 
 
 # ==========================================
@@ -110,12 +113,88 @@ LOGGER_NAME = "ApplicationLog"
 LOG_FILE = "application.log"
 APP_BOOT_MESSAGE = "アプリが起動されました。"
 
+# プロファイリング設定
+PROFILE_DIR_PATH = f"{LOG_DIR_PATH}/profiles"   # プロファイリング結果の出力先
+PROFILE_ENV_VAR = "PROFILE_REQUESTS"            # 「true」で全リクエストをプロファイリングする環境変数
+PROFILE_ADMIN_TOKEN_ENV_VAR = "PROFILE_ADMIN_TOKEN"  # クエリパラメータでの有効化に必要な管理者用トークンの環境変数
+PROFILE_QUERY_PARAM = "profile"                 # 管理者用トークンを指定するクエリパラメータ名
+PROFILE_TOP_N = 40                              # 処理時間の長い関数の一覧に出力する件数
+
+
+# ==========================================
+# セッション保存系
+# ==========================================
+SESSION_STORE_DIR_PATH = "./session_store"
+SESSION_STORE_FILE = "sessions.sqlite3"
+SESSION_QUERY_PARAM = "resume"                              # 再読み込み・再起動後に会話を再開するための、再開用トークンのクエリパラメータ名
+SESSION_RESUME_TOKEN_BYTES = 32                             # 再開用トークンのランダムなバイト数（データベースにはハッシュ値のみ保存）
+SESSION_MEMORY_MESSAGE_LIMIT = CONVERSATION_LOG_WINDOW_SIZE  # メモリに保持する表示用の会話ログの上限件数
+SESSION_MEMORY_CHAT_HISTORY_LIMIT = 20                      # メモリに保持するLLMとのやりとり用の会話ログの上限件数
+SESSION_TTL_SECONDS = 7 * 24 * 60 * 60                      # 最終アクセスからこの秒数が経過したセッションを削除
+SESSION_CLEANUP_INTERVAL_SECONDS = 60 * 60                  # 期限切れセッションの削除処理の実行間隔
+
+
+# ==========================================
+# HTTP API系
+# ==========================================
+API_HOST = "127.0.0.1"
+API_PORT = 8000
+API_ENABLED_ENV_VAR = "API_SERVER_ENABLED"   # 「true」でStreamlitと同じプロセス内でHTTP APIも起動する環境変数
+API_KEEP_ALIVE_SECONDS = 30                  # 同じ接続で次のリクエストを待つ時間（秒）
+API_MAX_QUERY_LENGTH = 2000                  # 検索クエリ・質問の最大文字数
+API_MODES = {                                # APIで指定する利用目的のモード名と、画面のモード名の対応
+    "doc_search": ANSWER_MODE_1,
+    "inquiry": ANSWER_MODE_2,
+}
+
+
+# ==========================================
+# 一括実行系
+# ==========================================
+BATCH_CONCURRENCY = 4   # 一括実行で同時に実行する質問数（LLMへのリクエストはさらにLLMスケジューラーで制限される）
+
+
+# ==========================================
+# 利用量の集計系
+# ==========================================
+LLM_PRICES_PER_MILLION_TOKENS = {      # モデルごとの100万トークンあたりの料金（米ドル、入力・出力）
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+}
+USAGE_MAX_TRACKED_SESSIONS = 1000      # 累計を保持するセッション数の上限（超えた場合は最も古く利用されたものから破棄）
+USAGE_SUMMARY_TOP_N = 10               # 管理者向けの集計に含める、消費トークン数の多いセッションの件数
+USAGE_QUERY_PARAM = "usage"            # 画面に管理者向けの集計を表示するための、管理者用トークンを指定するクエリパラメータ名
+USAGE_ADMIN_HEADER = "X-Admin-Token"   # HTTP APIで管理者向けの集計を取得するための、管理者用トークンを指定するヘッダー名
+# 管理者用トークンは、プロファイリングと共通の環境変数「PROFILE_ADMIN_TOKEN」で設定する
+
 
 # ==========================================
 # LLM設定系
 # ==========================================
 MODEL = "gpt-4o-mini"
 TEMPERATURE = 0.5
+LLM_REQUEST_TIMEOUT_SECONDS = 60       # LLMへの1回のリクエストのタイムアウト（秒）
+
+# LLMスケジューラーの設定（全セッションからのLLMへのリクエストをプロセス内で一括して制御）
+LLM_MAX_CONCURRENCY = 8                # 同時に実行する最大リクエスト数
+LLM_REQUESTS_PER_MINUTE = 500          # 1分あたりの最大リクエスト数（OpenAIの利用枠に合わせる、Noneの場合は制限しない）
+LLM_TOKENS_PER_MINUTE = 200000         # 1分あたりの最大トークン数（OpenAIの利用枠に合わせる、Noneの場合は制限しない）
+LLM_MAX_QUEUE_SIZE = 200               # 実行待ちにできる最大リクエスト数（超えた場合はエラー）
+LLM_MAX_QUEUE_WAIT_SECONDS = 120       # 実行待ちの最大時間（秒、超えた場合はエラー）
+LLM_MAX_RETRIES = 4                    # レート制限・一時的なエラーの場合に再実行する最大回数
+LLM_RETRY_BASE_DELAY_SECONDS = 1.0     # 再実行までの待ち時間の基準値（回数ごとに2倍、Retry-After指定時は加えるゆらぎの最大値）
+LLM_RETRY_MAX_DELAY_SECONDS = 30.0     # 再実行までの待ち時間の上限（秒）
+LLM_CHARS_PER_TOKEN = 1.0              # トークン数の見積もりに使う1トークンあたりの文字数（日本語はおおよそ1文字1トークン）
+LLM_EXPECTED_COMPLETION_TOKENS = 500   # トークン数の見積もりに加える、回答の想定トークン数
+LLM_QUEUE_WAIT_LOG_THRESHOLD_SECONDS = 0.1  # 実行待ちの時間をログ出力する下限（秒）
+LLM_ASYNC_POLL_SECONDS = 0.05          # 非同期処理で、実行待ちのリクエストが実行できるかどうかを確認する間隔（秒）
+ASYNC_BRIDGE_POLL_SECONDS = 0.2        # Streamlitのスクリプトから非同期処理の完了を待つ際の確認間隔（秒）
+
+# サーキットブレーカーの設定（障害中のバックエンドへの呼び出しを遮断し、即座に代替処理へ切り替える）
+CIRCUIT_BREAKERS = {                   # バックエンドごとの（遮断を始める連続失敗回数, 遮断を続ける秒数）
+    "openai_chat": (3, 30),
+    "openai_embeddings": (3, 30),
+    "huggingface_embeddings": (1, 300),  # モデルの読み込みは重いため、1回失敗したらしばらく再試行しない
+}
 
 
 # ==========================================
@@ -131,11 +210,95 @@ SUPPORTED_EXTENSIONS = {
 WEB_URL_LOAD_TARGETS = [
     "https://generative-ai.web-camp.io/"
 ]
+WEB_LOAD_MAX_CONNECTIONS = 4          # Webページを取得する際の同時接続数の上限
+WEB_LOAD_TIMEOUT_SECONDS = 10         # 1つのWebページの取得のタイムアウト（秒）
+WEB_LOAD_USER_AGENT = "company-inner-search-app"  # 環境変数「USER_AGENT」が未設定の場合に送るUser-Agent
+WEB_CACHE_DIR_PATH = "./web_cache"    # 取得したWebページのキャッシュの保存先
+
+# 抽出結果のキャッシュ設定（PDF・Wordファイルの解析結果を、ファイルの内容が変わるまで再利用）
+EXTRACTION_CACHE_ENABLED = True                    # 抽出結果のキャッシュを使うかどうか
+EXTRACTION_CACHE_EXTENSIONS = [".pdf", ".docx"]    # キャッシュの対象とする拡張子（解析に時間のかかるファイル形式）
+EXTRACTION_CACHE_DIR_PATH = "./extraction_cache"
+EXTRACTION_CACHE_FILE = "extractions.sqlite3"
+EXTRACTION_CACHE_MAX_BYTES = 512 * 1024 * 1024     # 保存する圧縮後の合計サイズの上限（超えた場合、最も長く使われていないものから削除）
+EXTRACTION_CACHE_MAX_ENTRY_BYTES = 64 * 1024 * 1024  # 1ファイル分の圧縮後のサイズの上限（超える場合は保存しない）
+EXTRACTION_CACHE_COMPRESSION_LEVEL = 6             # zlibの圧縮レベル（1〜9、大きいほど小さくなり、保存が遅くなる）
+EXTRACTION_CACHE_LOADER_PACKAGES = {               # キャッシュのキーにバージョンを含める、ローダーが使うライブラリ
+    ".pdf": ["pymupdf", "langchain-community"],
+    ".docx": ["docx2txt", "langchain-community"],
+}
 
 # チャンク分割設定
 CHUNK_SIZE = 500          # チャンクの最大文字数
 CHUNK_OVERLAP = 50        # チャンク間の重複文字数
 CHUNK_SEPARATOR = "\n"    # チャンク分割の区切り文字
+# 分割せずに1つのチャンク（親子チャンクの場合は1つの親チャンク）とする重要なドキュメント（ファイルパスに含まれる文字列）
+UNSPLIT_DOCUMENT_KEYWORDS = ["社員名簿.csv", "議事録ルール.txt"]
+
+# 親子チャンク設定（小さな子チャンクを埋め込んで検索し、それを含む親チャンクをLLMに渡す）
+CHUNK_STRATEGY = "parent_child"  # チャンク分割方式（「flat」: 通常のチャンク分割、「parent_child」: 親子チャンク）
+PARENT_CHUNK_SIZE = 400         # 親チャンク（LLMに渡す文脈）の最大文字数
+CHILD_CHUNK_SIZE = 120           # 子チャンク（埋め込み対象）の最大文字数（埋め込みモデルの最大入力長128トークンに収まる長さ）
+CHILD_CHUNK_OVERLAP = 20         # 子チャンク間の重複文字数
+CHILD_SEARCH_MULTIPLIER = 4      # 親チャンクを取得件数分集めるために検索する子チャンク数（取得件数の何倍か）
+# 親子チャンクの分割に使う区切り文字（前から順に試し、最大文字数に収まらない場合は次の区切り文字で分割）
+PARENT_CHILD_SEPARATORS = ["\n\n", "\n", "。", "、", " ", ""]
+
+# 重複ドキュメントの検出設定（同じ内容のPDF版・Word版などを1つにまとめてから埋め込む）
+REMOVE_NEAR_DUPLICATES = True                # 読み込み時に内容がほぼ同じドキュメントをまとめるかどうか
+NEAR_DUPLICATE_THRESHOLD = 0.8               # 同じ内容とみなす類似度（文字n-gramのJaccard係数）の下限
+NEAR_DUPLICATE_SHINGLE_SIZE = 5              # 類似度の計算に使う文字n-gramの文字数
+NEAR_DUPLICATE_NUM_PERM = 128                # MinHash署名の長さ（大きいほど類似度の推定が正確になり、遅くなる）
+NEAR_DUPLICATE_LSH_BANDS = 32                # LSHで署名を分ける帯の数（署名の長さを割り切れる数）
+NEAR_DUPLICATE_HASH_BLOCK_SIZE = 4096        # MinHashで一度にハッシュ値を計算するシングル数（作業領域はこの数×署名の長さ×8バイト）
+NEAR_DUPLICATE_PREFERRED_EXTENSIONS = [".pdf", ".docx", ".txt", ".csv"]  # 代表として残すドキュメントの拡張子の優先順（PDFはページ番号を表示できる）
+
+# 検索設定
+VECTOR_STORE_TYPE = "chroma"  # ベクターストアの種類（「chroma」: Chroma、「numpy」: NumPyによるプロセス内の軽量ベクターストア、「ann」: 近似最近傍探索、「quantized」: 量子化したベクトルで検索）
+RETRIEVER_TYPE = "vector"  # 検索方式（「vector」: ベクトル検索のみ、「hybrid」: ベクトル検索とキーワード検索の統合）
+RETRIEVER_TOP_K = 10       # 検索で取得するドキュメント数
+RRF_RANK_CONSTANT = 60     # 統合検索（Reciprocal Rank Fusion）の順位補正値
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # 検索クエリの埋め込みをキャッシュする最大件数（全セッションで共有）
+
+# 近似最近傍探索（IVF-PQ）の設定（VECTOR_STORE_TYPE = "ann" の場合のみ使用）
+ANN_MIN_INDEX_SIZE = 10000    # インデックスを作成する最小件数（これ未満は厳密検索）
+ANN_NPROBE = 8                # 検索時に調べるクラスタの数（大きいほど再現率が上がり、遅くなる）
+ANN_PQ_SUBSPACES = 48         # PQの部分空間の数（大きいほど近似精度とメモリ使用量が上がる）
+ANN_RERANK_FACTOR = 16        # 元のベクトルで類似度を再計算する候補数（取得件数の何倍か）
+ANN_TRAIN_SAMPLE_SIZE = 50000  # k-meansの学習に使う最大件数
+ANN_KMEANS_ITERATIONS = 10    # k-meansの繰り返し回数
+
+# 量子化ベクターストアの設定（VECTOR_STORE_TYPE = "quantized" の場合のみ使用）
+QUANTIZED_DTYPE = "int8"                      # 量子化の種類（「int8」: 1/4のメモリ、「float16」: 1/2のメモリで、NumPyでの変換が遅いため検索も遅くなる）
+QUANTIZED_RERANK_FACTOR = 4                   # 元のベクトルで類似度を再計算する候補数（取得件数の何倍か）
+QUANTIZED_VECTOR_DIR_PATH = "./vector_store"  # 複数プロセスで共有する行列のファイルの保存先
+
+# キーワード検索の設定（埋め込みモデルが使えない場合、または検索方式が「hybrid」の場合に使用）
+KEYWORD_TOP_K = 5                  # キーワード検索で取得するドキュメント数
+KEYWORD_BM25_K1 = 1.2              # BM25の出現回数による加点の飽和の度合い（大きいほど出現回数が多い文書を優遇）
+KEYWORD_BM25_B = 0.75              # BM25の文書長による正規化の強さ（0〜1、大きいほど長い文書のスコアを下げる）
+KEYWORD_SOURCE_MATCH_BONUS = 10    # 検索クエリの語（空白区切り）がファイルパスに含まれる場合に加えるスコア
+KEYWORD_SOURCE_BOOSTS = {          # 検索クエリに含まれる語ごとの、スコアを加えるファイル名と加えるスコア
+    "人事": ("社員名簿", 50),
+    "議事録": ("議事録ルール", 50),
+}
+KEYWORD_INDEX_PERSIST = True               # 通常の起動時に作成したキーワード検索のインデックスを保存し、埋め込みモデルの障害時の起動に使うかどうか
+KEYWORD_INDEX_DIR_PATH = "./keyword_index"  # キーワード検索のインデックスの保存先
+KEYWORD_INDEX_FILE = "keyword_index.bin"
+
+# 検索範囲（フォルダ構成から求めたメタデータによる絞り込み）の設定
+SEARCH_SCOPE_LABEL = "検索範囲"
+SEARCH_SCOPE_ALL = "すべての文書"
+SEARCH_SCOPE_KEYS = {          # 絞り込みに使うメタデータの項目と、選択肢での表示名
+    "category": "カテゴリ",
+    "customer_status": "顧客区分",
+    "customer": "顧客",
+    "file_type": "ファイル形式",
+}
+CUSTOMER_FOLDER_NAME = "顧客"  # 配下が「顧客区分/会社名」のフォルダ構成になっているフォルダ名
+WEB_PAGE_CATEGORY = "Webページ"  # Webページから読み込んだデータのカテゴリ
+COMPANY_NAME_SUFFIXES = ["株式会社", "合同会社", "有限会社"]  # 入力内容から顧客名を検出する際に除く法人格
+AUTO_DETECT_CUSTOMER_SCOPE = True  # 「すべての文書」選択時に、入力内容に含まれる顧客名で自動的に絞り込むかどうか
 
 
 # ==========================================
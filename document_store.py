@@ -0,0 +1,394 @@
+"""
+このファイルは、チャンクの本文とメタデータをプロセス内で1か所にまとめて保持する、チャンクストアを定義したファイルです。
+- 本文は1つの連続したUTF-8のバイト列と、チャンクごとの開始位置の配列で保持する
+- メタデータは項目ごとの値の一覧（同じ値は1つにまとめる）と、チャンク×項目の値の番号の行列で保持する
+- ベクターストア・キーワード検索はチャンクを整数の番号で参照し、Documentオブジェクトは検索結果として返す分のみ作成する
+LangChainのDocumentはチャンクごとに本文の文字列とメタデータの辞書を持つため、Retrieverごとにリストを持つと同じ内容が重複します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import numpy as np
+from langchain_core.documents import Document
+
+
+############################################################
+# 関数定義
+############################################################
+
+def to_hashable(value):
+    """
+    メタデータの値を、値の一覧の対応表のキーに使える形に変換（リスト・辞書の値にも対応）
+
+    Args:
+        value: メタデータの値
+
+    Returns:
+        ハッシュ可能な値
+    """
+    if isinstance(value, (list, tuple)):
+        return ("__list__",) + tuple(to_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return ("__dict__",) + tuple(sorted((key, to_hashable(item)) for key, item in value.items()))
+    return value
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ChunkView:
+    """
+    チャンクストア内の1チャンクへの参照（本文・メタデータは参照した時点でチャンクストアから復元する）
+    """
+
+    __slots__ = ("store", "chunk_id")
+
+    def __init__(self, store, chunk_id):
+        self.store = store
+        self.chunk_id = chunk_id
+
+    @property
+    def page_content(self):
+        return self.store.text(self.chunk_id)
+
+    @property
+    def metadata(self):
+        return self.store.metadata(self.chunk_id)
+
+    def to_document(self):
+        """
+        Documentオブジェクトの作成
+
+        Returns:
+            ドキュメント
+        """
+        return self.store.document(self.chunk_id)
+
+
+class DocumentStore:
+    """
+    チャンクの本文とメタデータを、チャンクごとのオブジェクトを作らずに配列で保持するチャンクストア
+    （作成後に複数のRetriever・ベクターストアで共有するため、共有を始めた後はチャンクを追加しない）
+    """
+
+    def __init__(self):
+        # 本文のバイト列と、チャンクごとの開始位置（末尾に全体の長さを加えた、チャンク数+1の長さ）
+        self._texts = np.zeros(0, dtype=np.uint8)
+        self._text_offsets = np.zeros(1, dtype=np.uint64)
+        # メタデータの項目ごとの値の一覧と、チャンク×項目の値の番号の行列（列の順は項目の順、未設定の値は「-1」）
+        self._values = {}
+        self._columns = {}
+        self._codes = np.zeros((0, 0), dtype=np.int32)
+        # 項目ごとの「値→番号」の対応表と、値ごとのチャンクの番号の一覧（必要になった時点で作成）
+        self._numbers = {}
+        self._postings = {}
+
+    @classmethod
+    def from_documents(cls, docs):
+        """
+        ドキュメントのリストからのチャンクストアの作成
+
+        Args:
+            docs: ドキュメントのリスト
+
+        Returns:
+            チャンクストア
+        """
+        store = cls()
+        store.add([doc.page_content for doc in docs], [doc.metadata for doc in docs])
+        return store
+
+    @classmethod
+    def from_arrays(cls, header, arrays):
+        """
+        「to_arrays」で変換した配列からのチャンクストアの復元（メモリマップで開いた配列はそのまま参照する）
+
+        Args:
+            header: 値の一覧などの、配列以外の情報
+            arrays: 配列名と配列の辞書
+
+        Returns:
+            チャンクストア
+        """
+        store = cls()
+        store._texts = arrays["texts"]
+        store._text_offsets = arrays["text_offsets"]
+        store._values = header["metadata_values"]
+        store._columns = {key: column for column, key in enumerate(store._values)}
+        store._codes = arrays["metadata_codes"].reshape(len(store), len(store._values))
+        return store
+
+    def to_arrays(self):
+        """
+        ファイルに保存するための、配列以外の情報と配列への変換
+
+        Returns:
+            値の一覧などの配列以外の情報と、配列名と配列の辞書の組
+        """
+        arrays = {"texts": self._texts, "text_offsets": self._text_offsets, "metadata_codes": self._codes.ravel()}
+        return {"metadata_values": self._values}, arrays
+
+    def __len__(self):
+        return len(self._text_offsets) - 1
+
+    def __iter__(self):
+        return (ChunkView(self, chunk_id) for chunk_id in range(len(self)))
+
+    def __getitem__(self, chunk_id):
+        if not 0 <= chunk_id < len(self):
+            raise IndexError(chunk_id)
+        return ChunkView(self, chunk_id)
+
+    def add(self, texts, metadatas):
+        """
+        チャンクの追加
+
+        Args:
+            texts: チャンクごとの本文
+            metadatas: チャンクごとのメタデータ
+
+        Returns:
+            追加したチャンクの番号の範囲
+        """
+        start = len(self)
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.array([len(text) for text in encoded], dtype=np.uint64)
+        self._texts = np.concatenate([self._texts, np.frombuffer(b"".join(encoded), dtype=np.uint8)])
+        self._text_offsets = np.concatenate([self._text_offsets, self._text_offsets[-1] + np.cumsum(lengths)])
+
+        # 新しい項目は列を追加し、既存のチャンクの値は未設定とする
+        for metadata in metadatas:
+            for key in metadata:
+                if key not in self._columns:
+                    self._columns[key] = len(self._columns)
+                    self._values[key] = []
+        codes = np.full((start + len(encoded), len(self._columns)), -1, dtype=np.int32)
+        codes[:start, :self._codes.shape[1]] = self._codes
+
+        for key, column in self._columns.items():
+            values = self._values[key]
+            numbers = self._value_numbers(key)
+            for offset, metadata in enumerate(metadatas):
+                if key in metadata:
+                    value = metadata[key]
+                    number = numbers.setdefault(to_hashable(value), len(values))
+                    if number == len(values):
+                        values.append(value)
+                    codes[start + offset, column] = number
+        self._codes = codes
+
+        self._postings.clear()
+        return range(start, len(self))
+
+    def text(self, chunk_id):
+        """
+        本文の復元
+
+        Args:
+            chunk_id: チャンクの番号
+
+        Returns:
+            本文
+        """
+        start, end = int(self._text_offsets[chunk_id]), int(self._text_offsets[chunk_id + 1])
+        return bytes(self._texts[start:end]).decode("utf-8")
+
+    def texts(self):
+        """
+        全チャンクの本文の復元（埋め込みの作成など、全件を一度だけ処理する場合に使う）
+
+        Returns:
+            本文のリスト
+        """
+        return [self.text(chunk_id) for chunk_id in range(len(self))]
+
+    def metadata(self, chunk_id):
+        """
+        メタデータの復元（呼び出しごとに新しい辞書を作成する）
+
+        Args:
+            chunk_id: チャンクの番号
+
+        Returns:
+            メタデータ
+        """
+        # チャンクの行を1回でPythonの整数のリストに変換してから、項目ごとの値を参照する
+        row = self._codes[chunk_id].tolist()
+        return {key: values[code] for (key, values), code in zip(self._values.items(), row) if code >= 0}
+
+    def metadatas(self):
+        """
+        全チャンクのメタデータの復元
+
+        Returns:
+            メタデータのリスト
+        """
+        return [self.metadata(chunk_id) for chunk_id in range(len(self))]
+
+    def document(self, chunk_id, id=None):
+        """
+        Documentオブジェクトの作成
+
+        Args:
+            chunk_id: チャンクの番号
+            id: ドキュメントに設定するID
+
+        Returns:
+            ドキュメント
+        """
+        return Document(page_content=self.text(chunk_id), metadata=self.metadata(chunk_id), id=id)
+
+    def column(self, key):
+        """
+        メタデータの1項目の、チャンクごとの値の番号の配列と値の一覧の取得
+
+        Args:
+            key: メタデータの項目
+
+        Returns:
+            値の番号の配列（未設定は「-1」）と、値の一覧の組
+        """
+        if key not in self._columns:
+            return np.full(len(self), -1, dtype=np.int32), []
+        return self._codes[:, self._columns[key]], self._values[key]
+
+    def memory_usage(self):
+        """
+        本文・メタデータの配列のメモリ使用量
+
+        Returns:
+            本文・メタデータの配列のバイト数の辞書
+        """
+        return {
+            "texts": int(self._texts.nbytes + self._text_offsets.nbytes),
+            "metadata_columns": int(self._codes.nbytes),
+            "metadata_postings": int(sum(rows.nbytes + offsets.nbytes for rows, offsets in self._postings.values())),
+        }
+
+    def filter_ids(self, filter):
+        """
+        絞り込み条件に合うチャンクの番号の配列を取得
+
+        Args:
+            filter: 絞り込み条件（Chromaと同じ書式）
+
+        Returns:
+            条件に合うチャンクの番号の昇順の配列
+        """
+        # 値の一致のみの条件は、値ごとのチャンクの番号の一覧から求める（処理時間が全件数ではなく該当件数に比例する）
+        rows = self._posting_rows(filter)
+        if rows is not None:
+            return rows
+        return np.flatnonzero(self._filter_mask(filter))
+
+    def _value_numbers(self, key):
+        # 値の一覧から「値→番号」の対応表を作成（ファイルから復元した場合は、最初に必要になった時点で作成）
+        if key not in self._numbers:
+            self._numbers[key] = {to_hashable(value): number for number, value in enumerate(self._values.get(key, []))}
+        return self._numbers[key]
+
+    def _get_postings(self, key):
+        # 値ごとのチャンクの番号を連続した配列にまとめる（絞り込み時は該当する値の区間を取り出すだけで済む）
+        if key not in self._postings:
+            codes, _ = self.column(key)
+            rows = np.flatnonzero(codes >= 0)
+            rows = rows[np.argsort(codes[rows], kind="stable")].astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[rows], minlength=len(self._values[key])))])
+            self._postings[key] = (rows, offsets)
+        return self._postings[key]
+
+    def _posting_rows(self, filter):
+        """
+        値の一致のみの条件（「{"項目": 値}」「$eq」「$in」「$and」）に合うチャンクの番号を、値ごとの一覧から取得
+
+        Args:
+            filter: 絞り込み条件
+
+        Returns:
+            条件に合うチャンクの番号の昇順の配列（それ以外の条件を含む場合はNone）
+        """
+        rows = None
+
+        for key, condition in filter.items():
+            if key == "$and":
+                parts = [self._posting_rows(sub_filter) for sub_filter in condition]
+                if any(part is None for part in parts):
+                    return None
+            else:
+                operator, value = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+                if operator not in ("$eq", "$in"):
+                    return None
+                parts = [self._lookup_postings(key, [value] if operator == "$eq" else value)]
+
+            for part in parts:
+                rows = part if rows is None else np.intersect1d(rows, part, assume_unique=True)
+
+        return rows if rows is not None else np.arange(len(self))
+
+    def _lookup_postings(self, key, values):
+        """
+        メタデータの項目が指定の値のいずれかであるチャンクの番号を取得
+
+        Args:
+            key: メタデータの項目
+            values: 値のリスト
+
+        Returns:
+            チャンクの番号の昇順の配列
+        """
+        if key not in self._columns:
+            return np.zeros(0, dtype=np.int64)
+
+        rows, offsets = self._get_postings(key)
+        numbers = self._value_numbers(key)
+        codes = {numbers[to_hashable(value)] for value in values if to_hashable(value) in numbers}
+        parts = [rows[offsets[code]:offsets[code + 1]] for code in sorted(codes)]
+        if len(parts) == 1:
+            return parts[0]
+        # 値ごとのチャンクの番号は重複しないため、連結して並べ替えるだけでよい
+        return np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+
+    def _filter_mask(self, filter):
+        """
+        絞り込み条件に合うチャンクをTrueとする配列の作成
+        - 「{"項目": 値}」「{"項目": {"$eq" / "$ne" / "$in" / "$nin": 値}}」
+        - 「{"$and": [条件, ...]}」「{"$or": [条件, ...]}」
+
+        Args:
+            filter: 絞り込み条件
+
+        Returns:
+            チャンクごとの真偽値の配列
+        """
+        mask = np.ones(len(self), dtype=bool)
+
+        for key, condition in filter.items():
+            if key == "$and":
+                for sub_filter in condition:
+                    mask &= self._filter_mask(sub_filter)
+                continue
+            if key == "$or":
+                sub_mask = np.zeros(len(self), dtype=bool)
+                for sub_filter in condition:
+                    sub_mask |= self._filter_mask(sub_filter)
+                mask &= sub_mask
+                continue
+
+            # 条件の値を値の番号に変換し、配列の比較で判定する（存在しない値の番号は「-2」で、どのチャンクとも一致しない）
+            codes, _ = self.column(key)
+            numbers = self._value_numbers(key)
+            operator, value = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+
+            if operator == "$eq":
+                mask &= codes == numbers.get(to_hashable(value), -2)
+            elif operator == "$ne":
+                mask &= codes != numbers.get(to_hashable(value), -2)
+            elif operator in ("$in", "$nin"):
+                matched = np.isin(codes, [numbers.get(to_hashable(v), -2) for v in value])
+                mask &= matched if operator == "$in" else ~matched
+            else:
+                raise ValueError(f"Unsupported filter operator: {operator}")
+
+        return mask
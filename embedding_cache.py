@@ -0,0 +1,212 @@
+"""
+このファイルは、検索クエリの埋め込みベクトルをプロセス内で共有してキャッシュする機能を定義したファイルです。
+同じ検索クエリ（人事部検索の固定キーワードや、会話履歴から言い換えた質問の再検索など）では、埋め込みモデルを実行せずに結果を再利用します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List
+from langchain_core.embeddings import Embeddings
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するキャッシュ（全セッションで1つのキャッシュを使い回す）
+_cache = None
+_cache_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_cache():
+    """
+    プロセス内で共有する検索クエリの埋め込みキャッシュの取得（未作成の場合は作成）
+
+    Returns:
+        埋め込みキャッシュ
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryEmbeddingCache(max_size=ct.QUERY_EMBEDDING_CACHE_SIZE)
+        return _cache
+
+
+def normalize_query(text):
+    """
+    キャッシュのキーとする検索クエリの正規化
+    （全角・半角の違い、前後の空白、連続する空白の違いを同一視する）
+
+    Args:
+        text: 検索クエリ
+
+    Returns:
+        正規化後の検索クエリ
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def get_model_key(embeddings):
+    """
+    キャッシュのキーとする埋め込みモデルの識別名の取得
+
+    Args:
+        embeddings: 埋め込みモデル
+
+    Returns:
+        埋め込みモデルの識別名
+    """
+    model_name = getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None)
+    return f"{type(embeddings).__name__}:{model_name}"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class QueryEmbeddingCache:
+    """
+    件数上限付きのLRUキャッシュ（複数スレッドから同時に利用可能）
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size: 保持する最大件数（超えた場合、最も長く使われていないものから削除）
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        キャッシュ済みの値の取得（未キャッシュの場合は計算してキャッシュに追加）
+
+        Args:
+            key: キャッシュのキー
+            compute: 値を計算する関数
+
+        Returns:
+            キャッシュ済み、または計算した値
+        """
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+
+        # 埋め込みモデルの実行中は他のスレッドを待たせないよう、ロックの外で計算する
+        value = compute()
+        self._put(key, value)
+        return value
+
+    async def aget_or_compute(self, key, compute):
+        """
+        キャッシュ済みの値の非同期での取得（未キャッシュの場合は計算してキャッシュに追加）
+
+        Args:
+            key: キャッシュのキー
+            compute: 値を計算するコルーチンを返す関数
+
+        Returns:
+            キャッシュ済み、または計算した値
+        """
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+
+        value = await compute()
+        self._put(key, value)
+        return value
+
+    def _lookup(self, key):
+        # キャッシュ済みかどうかと、キャッシュ済みの値の組を返す（ヒット数・ミス数も集計）
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        キャッシュの利用状況の取得
+
+        Returns:
+            ヒット数・ミス数・ヒット率・保持件数の辞書
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+    def clear(self):
+        """
+        キャッシュの全件削除と、利用状況のリセット
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    検索クエリの埋め込みのみをキャッシュする埋め込みモデルのラッパー
+    （ドキュメントの埋め込みはベクターストア作成時に1回しか行わないため、キャッシュせずにそのまま実行）
+    """
+
+    def __init__(self, embeddings, cache=None):
+        """
+        Args:
+            embeddings: 埋め込みモデル
+            cache: 使用するキャッシュ（省略時はプロセス内で共有するキャッシュ）
+        """
+        self.embeddings = embeddings
+        self.cache = cache or get_cache()
+        self.model_key = get_model_key(embeddings)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # 同じキーには常に同じベクトルを返すよう、正規化後のテキストを埋め込む
+        query = normalize_query(text)
+        vector = self.cache.get_or_compute(
+            (self.model_key, query), lambda: self.embeddings.embed_query(query)
+        )
+        # 呼び出し側でリストが変更されてもキャッシュに影響しないよう、コピーを返す
+        return list(vector)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # 元の埋め込みモデルの非同期の処理（サーキットブレーカーなど）を、スレッドを介さずに呼び出す
+        query = normalize_query(text)
+        vector = await self.cache.aget_or_compute(
+            (self.model_key, query), lambda: self.embeddings.aembed_query(query)
+        )
+        return list(vector)
@@ -0,0 +1,269 @@
+"""
+このファイルは、PDF・Wordファイルから抽出したテキストとページごとのメタデータを、
+ファイルの内容のハッシュ値とローダーのバージョンをキーにローカルのSQLiteデータベースへ圧縮して保存する機能を定義したファイルです。
+内容が変わっていないファイルは、再読み込み時にファイルの解析を行わずキャッシュから復元します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from importlib import metadata as importlib_metadata
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するキャッシュ（全セッションで1つの接続を使い回す）
+_cache = None
+_cache_lock = threading.Lock()
+# 保存形式のバージョン（保存する内容の形式を変えた場合に上げ、古いキャッシュを使わないようにする）
+CACHE_FORMAT_VERSION = 1
+# キャッシュから復元する際に、現在のファイルパスに置き換えるメタデータの項目
+# （同じ内容のファイルが移動・コピーされた場合も、キャッシュを使い回せるようにする）
+PATH_METADATA_KEYS = ("source", "file_path")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_cache():
+    """
+    プロセス内で共有する抽出結果のキャッシュの取得（未作成の場合は作成）
+
+    Returns:
+        抽出結果のキャッシュ
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache(
+                os.path.join(ct.EXTRACTION_CACHE_DIR_PATH, ct.EXTRACTION_CACHE_FILE),
+                max_bytes=ct.EXTRACTION_CACHE_MAX_BYTES,
+                max_entry_bytes=ct.EXTRACTION_CACHE_MAX_ENTRY_BYTES
+            )
+        return _cache
+
+
+def get_loader_version(file_extension):
+    """
+    キャッシュのキーとするローダーのバージョンの取得
+    （ローダーのライブラリを更新した場合は、抽出結果が変わる可能性があるため別のキーになる）
+
+    Args:
+        file_extension: ファイルの拡張子
+
+    Returns:
+        ローダーの識別名とライブラリのバージョンをつなげた文字列
+    """
+    versions = [f"format={CACHE_FORMAT_VERSION}", ct.SUPPORTED_EXTENSIONS[file_extension].__name__]
+    for package in ct.EXTRACTION_CACHE_LOADER_PACKAGES.get(file_extension, []):
+        try:
+            versions.append(f"{package}={importlib_metadata.version(package)}")
+        except importlib_metadata.PackageNotFoundError:
+            versions.append(f"{package}=unknown")
+    return ";".join(versions)
+
+
+def get_file_hash(path):
+    """
+    キャッシュのキーとするファイルの内容のハッシュ値の取得
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        ハッシュ値（16進数の文字列）
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ExtractionCache:
+    """
+    ファイルからの抽出結果（ドキュメントのリスト）を、件数ではなく合計サイズの上限付きで保存するキャッシュ
+    （上限を超えた場合、最も長く使われていないものから削除）
+    """
+
+    def __init__(self, db_path, max_bytes, max_entry_bytes):
+        """
+        Args:
+            db_path: SQLiteデータベースファイルのパス
+            max_bytes: 保存する圧縮後の合計サイズの上限（バイト）
+            max_entry_bytes: 1ファイル分の圧縮後のサイズの上限（超える場合は保存しない）
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Streamlitは複数スレッドからスクリプトを実行するため、スレッド間で接続を共有する（排他はロックで行う）
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS extractions (
+                cache_key TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions (last_access);
+        """)
+        self._conn.commit()
+
+    def load(self, path, loader_func):
+        """
+        ファイルの抽出結果の取得（キャッシュにない場合はローダーで抽出してキャッシュに保存）
+
+        Args:
+            path: ファイルパス
+            loader_func: ファイルの拡張子に合ったローダー
+
+        Returns:
+            ドキュメントのリスト
+        """
+        file_extension = os.path.splitext(path)[1]
+        cache_key = f"{get_file_hash(path)}:{get_loader_version(file_extension)}"
+
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM extractions WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE extractions SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key)
+                )
+                self._conn.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if row is not None:
+            return self._decode(row[0], path)
+
+        # ファイルの解析中は他のスレッドを待たせないよう、ロックの外で抽出する
+        result = loader_func(path)
+        docs = result if isinstance(result, list) else result.load()
+        self._store(cache_key, docs)
+        return docs
+
+    def stats(self):
+        """
+        キャッシュの利用状況の取得
+
+        Returns:
+            ヒット数・ミス数・ヒット率・保存を見送った件数・削除件数・保存件数・合計サイズの辞書
+        """
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions"
+            ).fetchone()
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "skipped": self.skipped,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """
+        キャッシュの全件削除と、利用状況のリセット
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM extractions")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+            self.skipped = 0
+            self.evictions = 0
+
+    def _store(self, cache_key, docs):
+        """
+        抽出結果を圧縮して保存し、合計サイズが上限を超えた場合は古いものから削除
+
+        Args:
+            cache_key: キャッシュのキー
+            docs: ドキュメントのリスト
+        """
+        try:
+            payload = json.dumps(
+                [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+                ensure_ascii=False
+            )
+        except (TypeError, ValueError):
+            # JSONで表せないメタデータを含む場合は、キャッシュせずに毎回抽出する
+            with self._lock:
+                self.skipped += 1
+            return
+
+        data = zlib.compress(payload.encode("utf-8"), ct.EXTRACTION_CACHE_COMPRESSION_LEVEL)
+        with self._lock:
+            if len(data) > self.max_entry_bytes:
+                self.skipped += 1
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (cache_key, data, size, last_access) VALUES (?, ?, ?, ?)",
+                (cache_key, data, len(data), time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """
+        合計サイズが上限以下になるまで、最も長く使われていないものから削除（ロック取得済みの状態で呼び出す）
+        """
+        total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        rows = self._conn.execute("SELECT cache_key, size FROM extractions ORDER BY last_access").fetchall()
+        for cache_key, size in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM extractions WHERE cache_key = ?", (cache_key,))
+            total_bytes -= size
+            self.evictions += 1
+
+    def _decode(self, data, path):
+        """
+        保存した抽出結果からドキュメントを復元
+
+        Args:
+            data: 圧縮した抽出結果
+            path: 現在のファイルパス
+
+        Returns:
+            ドキュメントのリスト
+        """
+        docs = []
+        for item in json.loads(zlib.decompress(data).decode("utf-8")):
+            metadata = item["metadata"]
+            for key in PATH_METADATA_KEYS:
+                if key in metadata:
+                    metadata[key] = path
+            docs.append(Document(page_content=item["page_content"], metadata=metadata))
+        return docs
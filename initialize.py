@@ -6,7 +6,13 @@
 # ライブラリの読み込み
 ############################################################
 import os
+import asyncio
+import atexit
+import bisect
+import hashlib
+import json
 import logging
+import threading
 from logging.handlers import TimedRotatingFileHandler
 from uuid import uuid4
 import sys
@@ -14,15 +20,29 @@ import unicodedata
 from dotenv import load_dotenv
 import streamlit as st
 from docx import Document
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_text_splitters import CharacterTextSplitter
+from langchain_text_splitters import CharacterTextSplitter, RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.documents import Document
-from typing import List
+from langchain_core.vectorstores import VectorStore
+from typing import Any, List, Optional
 import constants as ct
+import log_utils
+import embedding_cache
+import extraction_cache
+import search_scope
+import near_duplicate
+import circuit_breaker
+import request_coalescing
+import session_store
+import document_store
+import vector_index
+import web_loader
+import ann_index
+import quantized_index
+import keyword_index
 
 
 ############################################################
@@ -45,6 +65,17 @@ except:
     pass
 
 
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するインデックス（Retriever・ベクターストアなど、画面の全セッションとHTTP APIで使い回す）
+_shared_index = None
+_shared_index_lock = threading.Lock()
+# 共有のインデックスから作成した、検索範囲ごとのRetriever（HTTP API・一括実行で使い回す）
+_shared_scoped_retrievers = {}
+_shared_scoped_retrievers_lock = threading.Lock()
+
+
 ############################################################
 # 関数定義
 ############################################################
@@ -84,26 +115,19 @@ def initialize_logger():
         when="D",
         encoding="utf8"
     )
-    # 出力するログメッセージのフォーマット定義
-    # - 「levelname」: ログの重要度（INFO, WARNING, ERRORなど）
-    # - 「asctime」: ログのタイムスタンプ（いつ記録されたか）
-    # - 「lineno」: ログが出力されたファイルの行番号
-    # - 「funcName」: ログが出力された関数名
-    # - 「session_id」: セッションID（誰のアプリ操作か分かるように）
-    # - 「message」: ログメッセージ
-    formatter = logging.Formatter(
-        f"[%(levelname)s] %(asctime)s line %(lineno)s, in %(funcName)s, session_id={st.session_state.session_id}: %(message)s"
-    )
-
-    # 定義したフォーマッターの適用
-    log_handler.setFormatter(formatter)
+    # 出力するログメッセージのフォーマット定義（1行1件のJSON形式）
+    # セッションID・リクエストIDはフォーマット文字列に埋め込まず、ログ出力時点のコンテキスト変数から取得する
+    log_handler.setFormatter(log_utils.JsonLineFormatter())
 
     # ログレベルを「INFO」に設定
     logger.setLevel(logging.INFO)
 
-    # 作成したハンドラー（ログ出力先を制御するオブジェクト）を、
-    # ロガー（ログメッセージを実際に生成するオブジェクト）に追加してログ出力の最終設定
-    logger.addHandler(log_handler)
+    # ロガーにはキューへの投入のみを行うハンドラーを設定し、ファイルへの書き込みはバックグラウンドスレッドで実行
+    # （リクエスト処理中のスレッドがディスクI/Oで待たされないようにするため）
+    listener = log_utils.start_queue_logging(logger, [log_handler])
+
+    # プロセス終了時に、キューに残っているログを書き出してからリスナーを停止
+    atexit.register(listener.stop)
 
 
 def initialize_session_id():
@@ -111,38 +135,98 @@ def initialize_session_id():
     セッションIDの作成
     """
     if "session_id" not in st.session_state:
-        # ランダムな文字列（セッションID）を、ログ出力用に作成
-        st.session_state.session_id = uuid4().hex
+        # URLに前回発行した再開用トークンが指定されており、対応する会話が存在する場合は会話を再開
+        # （ログにも出力するセッションIDではなく、サーバーが発行した推測できないトークンでのみ再開できる）
+        store = session_store.get_store()
+        resumed_session_id = store.find_session_by_resume_token(st.query_params.get(ct.SESSION_QUERY_PARAM, ""))
+        if resumed_session_id is not None and is_valid_session_id(resumed_session_id):
+            st.session_state.session_id = resumed_session_id
+            restore_session_state(resumed_session_id)
+        else:
+            # ランダムな文字列（セッションID）を、ログ出力用に作成
+            st.session_state.session_id = uuid4().hex
+        # 再読み込みやサーバー再起動の後も同じ会話を再開できるよう、URLに再開用トークンを保持
+        # （再開のたびに発行し直し、閲覧履歴などに残った以前のURLでは再開できないようにする）
+        st.query_params[ct.SESSION_QUERY_PARAM] = store.issue_resume_token(st.session_state.session_id)
+        # 放置されたセッションの保存データを削除（一定間隔でのみ実行される）
+        session_store.get_store().cleanup_expired()
+
+    # 以降のログ出力にセッションIDが付与されるよう、実行中のスレッドのコンテキストに設定
+    log_utils.bind_session_id(st.session_state.session_id)
 
 
 def initialize_retriever():
     """
     画面読み込み時にRAGのRetriever（ベクターストアから検索するオブジェクト）を作成
     """
-    # ロガーを読み込むことで、後続の処理中に発生したエラーなどがログファイルに記録される
-    logger = logging.getLogger(ct.LOGGER_NAME)
-
     # すでにRetrieverが作成済みの場合、後続の処理を中断
     if hasattr(st.session_state, "retriever") and st.session_state.retriever is not None:
         return
-    
+
     try:
-        # RAGの参照先となるデータソースの読み込み
-        docs_all = load_data_sources()
-        
-        # 同一ファイルから複数ドキュメントが生成された場合の統合処理
-        docs_all = consolidate_documents_by_source(docs_all)
-        
-        # 重要なドキュメント（社員名簿など）を優先して含める
-        docs_all = prioritize_important_documents(docs_all)
+        # プロセス内で共有するインデックス（未作成の場合のみ作成）を、セッションから参照できるようにする
+        st.session_state.update(get_shared_index())
+    except Exception:
+        # 空のretrieverを設定して完全な失敗を防ぐ
+        st.session_state.retriever = None
+        raise
 
-        # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
-        for doc in docs_all:
-            doc.page_content = adjust_string(doc.page_content)
-            for key in doc.metadata:
-                doc.metadata[key] = adjust_string(doc.metadata[key])
-        
+
+def get_shared_index(create=True):
+    """
+    プロセス内で共有するインデックスの取得（未作成の場合は作成）
+    （作成に失敗した場合は保持せず、次回の呼び出し時に再度作成を試みる）
+
+    Args:
+        create: 未作成の場合に作成するかどうか（Falseの場合はNoneを返す）
+
+    Returns:
+        Retriever・検索範囲の一覧・インデックスのバージョンなどの辞書
+    """
+    global _shared_index
+    if _shared_index is not None or not create:
+        return _shared_index
+    with _shared_index_lock:
+        if _shared_index is None:
+            _shared_index = build_index()
+        return _shared_index
+
+
+def get_shared_scoped_retriever(index, search_filter):
+    """
+    共有のインデックスから、絞り込み条件に応じたRetrieverを取得（同じ条件のRetrieverはプロセス内で使い回す）
+
+    Args:
+        index: 共有のインデックス
+        search_filter: 絞り込み条件（Noneの場合は絞り込まない）
+
+    Returns:
+        Retriever
+    """
+    if not search_filter:
+        return index["retriever"]
+
+    key = (index.get("index_version"), repr(sorted(search_filter.items())))
+    with _shared_scoped_retrievers_lock:
+        if key not in _shared_scoped_retrievers:
+            _shared_scoped_retrievers[key] = create_scoped_retriever(search_filter, index)
+        return _shared_scoped_retrievers[key]
+
+
+def build_index():
+    """
+    RAGの参照先となるデータソースを読み込み、Retriever（ベクターストアから検索するオブジェクト）を作成
+
+    Returns:
+        Retriever・検索範囲の一覧・インデックスのバージョンなどの辞書
+    """
+    # ロガーを読み込むことで、後続の処理中に発生したエラーなどがログファイルに記録される
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    index = {}
+
+    try:
         # エンベディングモデルの初期化（フォールバック対応）
+        # （キーワード検索で起動する場合に、保存済みのインデックスを使ってデータソースの読み込みを省けるよう、先に行う）
         logger.info("Initializing embeddings with fallback strategy")
         embeddings = None
         
@@ -161,11 +245,12 @@ def initialize_retriever():
                 warnings.filterwarnings("ignore", category=DeprecationWarning)
                 warnings.filterwarnings("ignore", category=UserWarning)
                 
-                embeddings = HuggingFaceEmbeddings(
+                # 読み込みに失敗したことがある場合、しばらくは他のセッションでも読み込みを試みずに次の方法へ進む
+                embeddings = circuit_breaker.get_breaker("huggingface_embeddings").call(lambda: HuggingFaceEmbeddings(
                     model_name="sentence-transformers/paraphrase-MiniLM-L3-v2",
                     model_kwargs={'device': 'cpu'},
                     encode_kwargs={'normalize_embeddings': True}
-                )
+                ))
                 logger.info("Local embeddings model loaded successfully")
                 
             except Exception as e:
@@ -176,7 +261,9 @@ def initialize_retriever():
         if embeddings is None:
             logger.info("Falling back to OpenAI embeddings")
             try:
-                embeddings = OpenAIEmbeddings()
+                # 障害中は埋め込みの呼び出しを遮断し、タイムアウトを待たずにエラーとする
+                breaker = circuit_breaker.get_breaker("openai_embeddings")
+                embeddings = circuit_breaker.ProtectedEmbeddings(breaker.call(OpenAIEmbeddings), breaker)
                 logger.info("OpenAI embeddings loaded successfully")
             except Exception as api_error:
                 logger.error(f"OpenAI embeddings also failed: {api_error}")
@@ -185,77 +272,204 @@ def initialize_retriever():
         # キーワードベース検索にフォールバック
         if embeddings is None:
             logger.info("Falling back to keyword-based search")
+            # 保存済みのキーワード検索のインデックスがあれば、データソースを読み込まずにそのまま使う
+            persisted_index = load_persisted_keyword_index()
+            if persisted_index is not None:
+                return persisted_index
+
+            docs_all = prepare_documents()
+            index["search_scopes"] = search_scope.collect_search_scopes(docs_all)
             retriever = create_simple_keyword_retriever(docs_all)
-            st.session_state.retriever = retriever
+            index["retriever"] = retriever
+            # 検索範囲を絞り込んだ検索用に、キーワード検索のインデックスも保存
+            index["keyword_index"] = retriever.index
+            # 同じ質問をまとめて処理する際に、同じインデックスを使うセッション同士かを判定するバージョン
+            index["index_version"] = request_coalescing.compute_index_version(docs_all, "keyword")
+            persist_keyword_index(retriever.index, index["index_version"], index["search_scopes"])
             logger.info("Keyword-based retriever initialized successfully")
-            return
+            return index
 
-        # チャンク分割用のオブジェクトを作成
-        text_splitter = CharacterTextSplitter(
-            chunk_size=ct.CHUNK_SIZE,
-            chunk_overlap=ct.CHUNK_OVERLAP,
-            separator=ct.CHUNK_SEPARATOR
-        )
+        # RAGの参照先となるデータソースの読み込みと整形
+        docs_all = prepare_documents()
 
-        # 重要なドキュメント（社員名簿など）は分割せず、その他のドキュメントのみ分割
-        splitted_docs = []
-        important_keywords = ['社員名簿.csv', '議事録ルール.txt']
-        
-        for doc in docs_all:
-            source = doc.metadata.get('source', '')
-            is_important = any(keyword in source for keyword in important_keywords)
-            
-            if is_important:
-                # 重要なドキュメントは分割せずにそのまま追加
-                splitted_docs.append(doc)
-                logger.info(f"Keeping important document unsplit: {source} ({len(doc.page_content)} chars)")
-            else:
-                # その他のドキュメントは通常通り分割
-                chunks = text_splitter.split_documents([doc])
-                splitted_docs.extend(chunks)
-                logger.info(f"Split document: {source} into {len(chunks)} chunks")
-        
-        logger.info(f"Total documents after processing: {len(splitted_docs)}")
+        # サイドバーで選択できる検索範囲の一覧を作成
+        index["search_scopes"] = search_scope.collect_search_scopes(docs_all)
+
+        # 同じ検索クエリで埋め込みモデルを再実行しないよう、全セッションで共有するキャッシュを経由させる
+        embeddings = embedding_cache.CachedEmbeddings(embeddings)
+
+        if ct.CHUNK_STRATEGY == "parent_child":
+            # 全ドキュメントを親チャンクに分割し、埋め込み対象はさらに細かく分割した子チャンクとする
+            parent_docs, splitted_docs = split_parent_child_documents(docs_all)
+        else:
+            # 重要なドキュメント（社員名簿など）以外をチャンク分割
+            parent_docs, splitted_docs = None, split_documents(docs_all)
         
         # Chromaデータベース用にメタデータを整理（リストや複雑なオブジェクトを文字列に変換）
-        for doc in splitted_docs:
-            for key, value in doc.metadata.items():
-                if isinstance(value, list):
-                    doc.metadata[key] = ", ".join(str(v) for v in value)
-                elif not isinstance(value, (str, int, float, bool)):
-                    doc.metadata[key] = str(value)
+        sanitize_metadata(splitted_docs)
+
+        # チャンクの本文・メタデータはチャンクストアに1つだけ保持し、各Retrieverからはチャンクの番号で参照する
+        # （分割前後のドキュメントのリストは、チャンクストアに移した時点で手放す）
+        chunk_store = document_store.DocumentStore.from_documents(splitted_docs)
+        parent_store = document_store.DocumentStore.from_documents(parent_docs) if parent_docs is not None else None
+        del docs_all, splitted_docs, parent_docs
 
         # ベクターストアの作成
-        db = Chroma.from_documents(splitted_docs, embedding=embeddings)
+        db = create_vectorstore(chunk_store, embeddings)
 
         # ベクターストアを検索するRetrieverの作成（より多くの結果を取得して精度向上）
         # 社員名簿のような重要文書を確実に取得するため、k値を増やす
-        st.session_state.retriever = db.as_retriever(search_kwargs={"k": 10})
+        vector_retriever = create_vector_retriever(db, parent_store)
+
+        # 検索方式が「hybrid」の場合、キーワード検索の結果も統合する（親子チャンクの場合は親チャンクを検索）
+        keyword_store = parent_store if parent_store is not None else chunk_store
+        keyword_retriever = create_simple_keyword_retriever(keyword_store)
+        if ct.RETRIEVER_TYPE == "hybrid":
+            index["retriever"] = create_hybrid_retriever([vector_retriever, keyword_retriever])
+            index["keyword_index"] = keyword_retriever.index
+        else:
+            index["retriever"] = vector_retriever
+        # 埋め込みモデルが障害中の場合に切り替える、キーワード検索のRetriever
+        index["degraded_retriever"] = keyword_retriever
+        # 次回以降、埋め込みモデルが使えない状態で起動した場合に、データソースを読み込まずに使えるよう保存
+        persist_keyword_index(
+            keyword_retriever.index,
+            request_coalescing.compute_index_version(keyword_store, "keyword"),
+            index["search_scopes"]
+        )
         
         # 社員名簿専用の高精度検索のため、ベクトルストアも保存
-        st.session_state.vectorstore = db
+        index["vectorstore"] = db
+        # 子チャンクの検索結果から親チャンクを取得するため、親チャンクも保存
+        index["parent_store"] = parent_store
+        # 同じ質問をまとめて処理する際に、同じインデックスを使うセッション同士かを判定するバージョン
+        index["index_version"] = request_coalescing.compute_index_version(
+            chunk_store, embeddings.model_key, ct.VECTOR_STORE_TYPE, ct.RETRIEVER_TYPE, ct.CHUNK_STRATEGY
+        )
         
         logger.info("Retriever initialized successfully")
-        
+        return index
+
     except Exception as e:
         logger.error(f"Critical error in retriever initialization: {str(e)}")
         
         # 最終フォールバック: キーワードベース検索
         try:
             logger.info("Attempting final fallback to keyword-based search")
-            docs_all = load_data_sources()
-            docs_all = consolidate_documents_by_source(docs_all)
-            docs_all = prioritize_important_documents(docs_all)
+            # 保存済みのキーワード検索のインデックスがあれば、データソースを読み込み直さずにそのまま使う
+            persisted_index = load_persisted_keyword_index()
+            if persisted_index is not None:
+                return persisted_index
+
+            docs_all = prepare_documents()
             
             retriever = create_simple_keyword_retriever(docs_all)
-            st.session_state.retriever = retriever
+            # 途中まで作成したベクターストアなどは使わず、キーワード検索のみの状態とする
+            index = {}
+            index["retriever"] = retriever
+            index["search_scopes"] = search_scope.collect_search_scopes(docs_all)
+            index["keyword_index"] = retriever.index
+            index["index_version"] = request_coalescing.compute_index_version(docs_all, "keyword")
+            persist_keyword_index(retriever.index, index["index_version"], index["search_scopes"])
             logger.info("Final fallback successful - keyword-based retriever initialized")
+            return index
             
         except Exception as fallback_error:
             logger.error(f"Final fallback also failed: {fallback_error}")
-            # 空のretrieverを設定して完全な失敗を防ぐ
-            st.session_state.retriever = None
             raise Exception(f"Complete initialization failure: {str(e)}, Fallback error: {str(fallback_error)}")
+
+
+def compute_source_fingerprint():
+    """
+    保存済みのキーワード検索のインデックスが、現在のデータソース・チャンク分割の設定で作成されたものかを判定する値の計算
+    （データソースの中身は読み込まず、ファイルのパス・更新日時・サイズのみを使う）
+
+    Returns:
+        フィンガープリント（16進数の文字列）
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    settings = {
+        "chunk_strategy": ct.CHUNK_STRATEGY,
+        "chunk_size": ct.CHUNK_SIZE,
+        "chunk_overlap": ct.CHUNK_OVERLAP,
+        "chunk_separator": ct.CHUNK_SEPARATOR,
+        "parent_chunk_size": ct.PARENT_CHUNK_SIZE,
+        "child_chunk_size": ct.CHILD_CHUNK_SIZE,
+        "child_chunk_overlap": ct.CHILD_CHUNK_OVERLAP,
+        "parent_child_separators": ct.PARENT_CHILD_SEPARATORS,
+        "unsplit_documents": ct.UNSPLIT_DOCUMENT_KEYWORDS,
+        "extensions": sorted(ct.SUPPORTED_EXTENSIONS),
+        "web_urls": ct.WEB_URL_LOAD_TARGETS,
+    }
+    digest.update(json.dumps(settings, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+    for root, dirs, files in os.walk(ct.RAG_TOP_FOLDER_PATH):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            relative_path = os.path.relpath(path, ct.RAG_TOP_FOLDER_PATH)
+            digest.update(f"{relative_path}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def persist_keyword_index(index, index_version, search_scopes):
+    """
+    キーワード検索のインデックスを、埋め込みモデルが使えない場合の起動用にファイルへ保存
+    （保存に失敗しても、起動は続行する）
+
+    Args:
+        index: キーワード検索のインデックス
+        index_version: インデックスのバージョン
+        search_scopes: 検索範囲の一覧
+    """
+    if not ct.KEYWORD_INDEX_PERSIST:
+        return
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    try:
+        keyword_index.save_index(
+            index, index_version=index_version, search_scopes=search_scopes,
+            source_fingerprint=compute_source_fingerprint()
+        )
+    except OSError as e:
+        logger.warning({"keyword_index": f"Failed to persist: {e}"})
+
+
+def load_persisted_keyword_index():
+    """
+    保存済みのキーワード検索のインデックスを開き、キーワード検索のみの状態のインデックスを作成
+    （保存後にデータソース・チャンク分割の設定が変わった場合は使わず、データソースから作り直してもらう）
+
+    Returns:
+        Retriever・検索範囲の一覧・インデックスのバージョンなどの辞書（保存済みのインデックスがない、または古い場合はNone）
+    """
+    if not ct.KEYWORD_INDEX_PERSIST:
+        return None
+    persisted = keyword_index.load_index()
+    if persisted is None:
+        return None
+
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    try:
+        fingerprint = compute_source_fingerprint()
+    except OSError as e:
+        logger.warning({"keyword_index": f"Ignored persisted index: failed to check data sources: {e}"})
+        return None
+    if persisted.header.get("source_fingerprint") != fingerprint:
+        logger.warning({"keyword_index": "Ignored persisted index built from different data sources or chunk settings",
+                        "built_at": persisted.header.get("built_at")})
+        return None
+
+    logger.info({"keyword_index": {"loaded": keyword_index.get_index_path(), "built_at": persisted.header.get("built_at"),
+                                   **persisted.stats()}})
+    return {
+        "retriever": keyword_index.KeywordRetriever(index=persisted),
+        "search_scopes": persisted.header.get("search_scopes", {}),
+        "keyword_index": persisted,
+        "index_version": persisted.header.get("index_version"),
+    }
+
+
 def initialize_session_state():
     """
     初期化データの用意
@@ -265,12 +479,370 @@ def initialize_session_state():
         st.session_state.messages = []
         # 「LLMとのやりとり用」の会話ログを順次格納するリストを用意
         st.session_state.chat_history = []
+        # メモリから外してデータベースのみに保存している「表示用」の会話ログの件数
+        st.session_state.spilled_message_count = 0
+        # メモリの会話ログの末尾のうち、データベースへの保存に失敗して未保存の件数
+        st.session_state.unpersisted_messages_count = 0
+        st.session_state.unpersisted_chat_history_count = 0
 
 
-def load_data_sources():
+def is_valid_session_id(session_id):
+    """
+    セッションIDの形式チェック（「uuid4().hex」で作成した32桁の16進数）
+
+    Args:
+        session_id: チェック対象の文字列
+
+    Returns:
+        正しい形式の場合はTrue
+    """
+    return len(session_id) == 32 and all(c in "0123456789abcdef" for c in session_id)
+
+
+def restore_session_state(session_id):
+    """
+    保存済みの会話ログのうち、直近のものをメモリに読み込む
+
+    Args:
+        session_id: セッションID
+    """
+    store = session_store.get_store()
+    message_count = store.count_messages(session_id)
+    memory_start = max(0, message_count - ct.SESSION_MEMORY_MESSAGE_LIMIT)
+
+    st.session_state.messages = store.load_messages(session_id, memory_start, ct.SESSION_MEMORY_MESSAGE_LIMIT)
+    st.session_state.spilled_message_count = memory_start
+    st.session_state.chat_history = store.load_chat_history(session_id, ct.SESSION_MEMORY_CHAT_HISTORY_LIMIT)
+    st.session_state.unpersisted_messages_count = 0
+    st.session_state.unpersisted_chat_history_count = 0
+
+
+def prepare_documents(include_web=True):
+    """
+    データソースの読み込みから、統合・優先度付け・文字列調整までを行う
+
+    Args:
+        include_web: Webページのデータも読み込むかどうか
+
+    Returns:
+        チャンク分割前のドキュメントのリスト
+    """
+    # RAGの参照先となるデータソースの読み込み
+    docs_all = load_data_sources(include_web=include_web)
+
+    # フォルダ構成から求めたメタデータ（カテゴリ・顧客名など）を付与し、検索範囲の絞り込みに使う
+    search_scope.add_path_metadata(docs_all)
+    
+    # 同一ファイルから複数ドキュメントが生成された場合の統合処理
+    docs_all = consolidate_documents_by_source(docs_all)
+
+    # 内容がほぼ同じドキュメント（同じ資料のPDF版とWord版など）を1つにまとめ、埋め込み件数と検索結果の重複を減らす
+    if ct.REMOVE_NEAR_DUPLICATES:
+        docs_all, removed_count = near_duplicate.remove_near_duplicates(docs_all)
+        logger = logging.getLogger(ct.LOGGER_NAME)
+        logger.info({"near_duplicates": {"documents": len(docs_all), "removed": removed_count}})
+    
+    # 重要なドキュメント（社員名簿など）を優先して含める
+    docs_all = prioritize_important_documents(docs_all)
+
+    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
+    for doc in docs_all:
+        doc.page_content = adjust_string(doc.page_content)
+        for key in doc.metadata:
+            doc.metadata[key] = adjust_string(doc.metadata[key])
+
+    return docs_all
+
+
+def split_documents(docs_all, chunk_size=ct.CHUNK_SIZE, chunk_overlap=ct.CHUNK_OVERLAP):
+    """
+    重要なドキュメント（社員名簿など）は分割せず、その他のドキュメントのみチャンク分割する
+
+    Args:
+        docs_all: ドキュメントのリスト
+        chunk_size: チャンクの最大文字数
+        chunk_overlap: チャンク間の重複文字数
+
+    Returns:
+        チャンク分割後のドキュメントのリスト
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    # チャンク分割用のオブジェクトを作成（ページ範囲の特定に使うため、各チャンクの開始位置も取得）
+    text_splitter = CharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separator=ct.CHUNK_SEPARATOR,
+        add_start_index=True
+    )
+
+    splitted_docs = []
+    
+    for doc in docs_all:
+        source = doc.metadata.get('source', '')
+        
+        if is_unsplit_document(doc):
+            # 重要なドキュメントは分割せずにそのまま追加
+            assign_page_range(doc.metadata, pop_page_map(doc.metadata), 0, len(doc.page_content))
+            splitted_docs.append(doc)
+            logger.info(f"Keeping important document unsplit: {source} ({len(doc.page_content)} chars)")
+        else:
+            # その他のドキュメントは通常通り分割し、各チャンクの開始位置から該当するページ範囲を付与
+            page_map = pop_page_map(doc.metadata)
+            chunks = text_splitter.split_documents([doc])
+            for chunk in chunks:
+                start = chunk.metadata.pop("start_index", 0)
+                pop_page_map(chunk.metadata)
+                assign_page_range(chunk.metadata, page_map, start, len(chunk.page_content))
+            splitted_docs.extend(chunks)
+            logger.info(f"Split document: {source} into {len(chunks)} chunks")
+    
+    logger.info(f"Total documents after processing: {len(splitted_docs)}")
+
+    return splitted_docs
+
+
+def is_unsplit_document(doc):
+    """
+    分割せずに1つのチャンクとする重要なドキュメント（社員名簿など）かどうかの判定
+
+    Args:
+        doc: ドキュメント
+
+    Returns:
+        分割しない場合はTrue
+    """
+    source = doc.metadata.get('source', '')
+    return any(keyword in source for keyword in ct.UNSPLIT_DOCUMENT_KEYWORDS)
+
+
+def split_parent_child_documents(docs_all, parent_chunk_size=ct.PARENT_CHUNK_SIZE,
+                                 child_chunk_size=ct.CHILD_CHUNK_SIZE, child_chunk_overlap=ct.CHILD_CHUNK_OVERLAP):
+    """
+    ドキュメントを親チャンクに分割し、各親チャンクをさらに子チャンクに分割する
+    （子チャンクのメタデータ「parent_id」に、親チャンクのリスト内の位置を格納）
+    （重要なドキュメント（社員名簿など）は分割せずに1つの親チャンクとし、子チャンクのみ分割する）
+
+    Args:
+        docs_all: ドキュメントのリスト
+        parent_chunk_size: 親チャンクの最大文字数
+        child_chunk_size: 子チャンクの最大文字数
+        child_chunk_overlap: 子チャンク間の重複文字数
+
+    Returns:
+        親チャンクのリストと、子チャンクのリスト
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    # 区切り文字で分割しても最大文字数を超える場合は、より細かい区切り文字で分割する
+    # （ページ範囲の特定に使うため、各チャンクの開始位置も取得）
+    parent_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=parent_chunk_size,
+        chunk_overlap=0,
+        separators=ct.PARENT_CHILD_SEPARATORS,
+        add_start_index=True
+    )
+    child_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=child_chunk_size,
+        chunk_overlap=child_chunk_overlap,
+        separators=ct.PARENT_CHILD_SEPARATORS,
+        add_start_index=True
+    )
+
+    parent_docs = []
+    for doc in docs_all:
+        if is_unsplit_document(doc):
+            # 社員名簿の一覧などを1つの文脈としてLLMに渡せるよう、ドキュメント全体を1つの親チャンクとする
+            parent_docs.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "start_index": 0}))
+        else:
+            parent_docs.extend(parent_splitter.split_documents([doc]))
+    child_docs = []
+    for parent_id, parent_doc in enumerate(parent_docs):
+        # 統合前のドキュメントのページ位置の対応表から、親チャンク・子チャンクそれぞれのページ範囲を付与
+        page_map = pop_page_map(parent_doc.metadata)
+        parent_start = parent_doc.metadata.pop("start_index", 0)
+        assign_page_range(parent_doc.metadata, page_map, parent_start, len(parent_doc.page_content))
+        parent_doc.metadata["parent_id"] = parent_id
+
+        for child_doc in child_splitter.split_documents([parent_doc]):
+            child_start = parent_start + child_doc.metadata.pop("start_index", 0)
+            assign_page_range(child_doc.metadata, page_map, child_start, len(child_doc.page_content))
+            child_docs.append(child_doc)
+
+    logger.info(f"Split {len(docs_all)} documents into {len(parent_docs)} parent chunks and {len(child_docs)} child chunks")
+
+    return parent_docs, child_docs
+
+
+def pop_page_map(metadata):
+    """
+    統合したドキュメントのメタデータから、ページ位置の対応表を取り出す（チャンクのメタデータには残さない）
+
+    Args:
+        metadata: ドキュメントのメタデータ
+
+    Returns:
+        （各ページの開始文字位置のリスト, 各ページのページ番号のリスト）、対応表がない場合はNone
+    """
+    page_offsets = metadata.pop("page_offsets", None)
+    page_numbers = metadata.pop("page_numbers", None)
+    if page_offsets is None or page_numbers is None:
+        return None
+    return page_offsets, page_numbers
+
+
+def assign_page_range(metadata, page_map, start, length):
+    """
+    チャンクの開始位置と文字数から、チャンクが含まれるページ範囲を二分探索で求めてメタデータに付与
+    （「page」に先頭のページ番号、「page_end」に末尾のページ番号を格納）
+
+    Args:
+        metadata: チャンクのメタデータ
+        page_map: ページ位置の対応表（Noneの場合は何もしない）
+        start: 統合したドキュメント内でのチャンクの開始文字位置
+        length: チャンクの文字数
+    """
+    if page_map is None:
+        return
+    page_offsets, page_numbers = page_map
+    first = max(bisect.bisect_right(page_offsets, start) - 1, 0)
+    last = max(bisect.bisect_right(page_offsets, start + max(length - 1, 0)) - 1, first)
+    metadata["page"] = page_numbers[first]
+    metadata["page_end"] = page_numbers[last]
+
+
+def create_vector_retriever(vectorstore, parent_store=None, search_filter=None, k=ct.RETRIEVER_TOP_K):
+    """
+    ベクターストアを検索するRetrieverの作成
+
+    Args:
+        vectorstore: ベクターストア
+        parent_store: 親チャンクのチャンクストア（Noneの場合、検索したチャンクをそのまま返す）
+        search_filter: メタデータによる絞り込み条件
+        k: 検索で取得するドキュメント数
+
+    Returns:
+        Retriever
+    """
+    if parent_store is not None:
+        return create_parent_child_retriever(vectorstore, parent_store, search_filter=search_filter, k=k)
+
+    search_kwargs = {"k": k}
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+    return vectorstore.as_retriever(search_kwargs=search_kwargs)
+
+
+def create_parent_child_retriever(vectorstore, parent_store, search_filter=None, k=ct.RETRIEVER_TOP_K):
+    """
+    子チャンクを検索し、ヒットした子チャンクを含む親チャンクを返すRetrieverを作成
+
+    Args:
+        vectorstore: 子チャンクを格納したベクターストア
+        parent_store: 親チャンクのチャンクストア
+        search_filter: メタデータによる絞り込み条件
+        k: 返す親チャンクの数
+
+    Returns:
+        親子チャンク検索用のRetriever
+    """
+
+    class ParentChildRetriever(BaseRetriever):
+        """LangChain互換の親子チャンク検索Retriever"""
+
+        vectorstore: VectorStore
+        # 親チャンクのチャンクストア（検証・コピーされないよう、型を指定せずに参照のみ持つ）
+        parent_store: Any
+        search_filter: Optional[dict] = None
+        k: int
+
+        def _get_relevant_documents(self, query: str, **kwargs) -> List[Document]:
+            """
+            子チャンクの類似度順に、親チャンクを重複なくk件返す
+            """
+            search_kwargs = {"filter": self.search_filter} if self.search_filter else {}
+            child_docs = self.vectorstore.similarity_search(
+                query, k=self.k * ct.CHILD_SEARCH_MULTIPLIER, **search_kwargs
+            )
+            return get_parent_documents(child_docs, self.parent_store)[:self.k]
+
+        async def _aget_relevant_documents(self, query: str, **kwargs) -> List[Document]:
+            # 非同期に対応したベクターストアでは、クエリの埋め込みを共有のイベントループ上で待つ
+            search_kwargs = {"filter": self.search_filter} if self.search_filter else {}
+            child_docs = await self.vectorstore.asimilarity_search(
+                query, k=self.k * ct.CHILD_SEARCH_MULTIPLIER, **search_kwargs
+            )
+            return get_parent_documents(child_docs, self.parent_store)[:self.k]
+
+    return ParentChildRetriever(vectorstore=vectorstore, parent_store=parent_store, search_filter=search_filter, k=k)
+
+
+def get_parent_documents(child_docs, parent_store):
+    """
+    子チャンクのリストを、それぞれを含む親チャンクのリストに変換（順序を保って重複を除去）
+
+    Args:
+        child_docs: 子チャンクのリスト
+        parent_store: 親チャンクのチャンクストア（Noneの場合は変換しない）
+
+    Returns:
+        親チャンクのリスト
+    """
+    if parent_store is None:
+        return child_docs
+    parent_ids = dict.fromkeys(int(doc.metadata["parent_id"]) for doc in child_docs if "parent_id" in doc.metadata)
+    # 返す親チャンクの分のみ、チャンクストアからドキュメントを作成
+    return [parent_store.document(parent_id) for parent_id in parent_ids]
+
+
+def create_vectorstore(chunk_store, embeddings, store_type=ct.VECTOR_STORE_TYPE):
+    """
+    設定に応じたベクターストアの作成
+
+    Args:
+        chunk_store: チャンク分割後のチャンクを格納したチャンクストア
+        embeddings: 埋め込みモデル
+        store_type: ベクターストアの種類（「chroma」「numpy」「ann」「quantized」のいずれか）
+
+    Returns:
+        ベクターストア
+    """
+    # NumPy系のベクターストアは、チャンクストアをコピーせずに共有する
+    if store_type == "ann":
+        # 件数が多い場合に近似最近傍探索（IVF-PQ）で検索するベクターストア
+        return ann_index.AnnVectorStore.from_store(chunk_store, embedding=embeddings)
+    if store_type == "quantized":
+        # ベクトルを量子化してメモリ使用量を抑え、複数プロセスで行列を共有するベクターストア
+        return quantized_index.QuantizedVectorStore.from_store(chunk_store, embedding=embeddings)
+    if store_type == "numpy":
+        # NumPyの行列演算のみで検索する、プロセス内の軽量ベクターストア
+        return vector_index.NumpyVectorStore.from_store(chunk_store, embedding=embeddings)
+    # Chromaは本文・メタデータを自身のデータベースに格納するため、チャンクストアから渡す
+    return Chroma.from_texts(chunk_store.texts(), embedding=embeddings, metadatas=chunk_store.metadatas())
+
+
+def sanitize_metadata(docs):
+    """
+    ベクターストアに格納できるよう、メタデータのリストや複雑なオブジェクトを文字列に変換
+
+    Args:
+        docs: ドキュメントのリスト
+    """
+    for doc in docs:
+        for key, value in doc.metadata.items():
+            if isinstance(value, list):
+                doc.metadata[key] = ", ".join(str(v) for v in value)
+            elif not isinstance(value, (str, int, float, bool)):
+                doc.metadata[key] = str(value)
+
+
+def load_data_sources(include_web=True):
     """
     RAGの参照先となるデータソースの読み込み
 
+    Args:
+        include_web: Webページのデータも読み込むかどうか（オフラインでのベンチマーク実行時などはFalse）
+
     Returns:
         読み込んだ通常データソース
     """
@@ -279,15 +851,17 @@ def load_data_sources():
     # ファイル読み込みの実行（渡した各リストにデータが格納される）
     recursive_file_check(ct.RAG_TOP_FOLDER_PATH, docs_all)
 
-    web_docs_all = []
+    # 抽出結果のキャッシュの利用状況をログ出力
+    if ct.EXTRACTION_CACHE_ENABLED:
+        logger = logging.getLogger(ct.LOGGER_NAME)
+        logger.info({"extraction_cache": extraction_cache.get_cache().stats()})
+
+    if not include_web:
+        return docs_all
+
     # ファイルとは別に、指定のWebページ内のデータも読み込み
-    # 読み込み対象のWebページ一覧に対して処理
-    for web_url in ct.WEB_URL_LOAD_TARGETS:
-        # 指定のWebページを読み込み
-        loader = WebBaseLoader(web_url)
-        web_docs = loader.load()
-        # for文の外のリストに読み込んだデータソースを追加
-        web_docs_all.extend(web_docs)
+    # （全URLを並行して取得し、更新がない・取得できないWebページはキャッシュ済みの内容を使う）
+    web_docs_all = web_loader.load_web_documents(ct.WEB_URL_LOAD_TARGETS)
     # 通常読み込みのデータソースにWebページのデータを追加
     docs_all.extend(web_docs_all)
 
@@ -321,11 +895,21 @@ def consolidate_documents_by_source(docs_all):
             # 複数のドキュメントがある場合は統合
             combined_content = []
             combined_metadata = source_docs[0].metadata.copy()
+            # チャンク分割後にページ範囲を求められるよう、各ページの開始文字位置とページ番号を記録
+            page_offsets = []
+            page_numbers = []
+            position = 0
             
             for i, doc in enumerate(source_docs):
-                combined_content.append(f"=== セクション {i+1} ===")
-                combined_content.append(doc.page_content)
-                combined_content.append("")  # 空行で区切り
+                section = [f"=== セクション {i+1} ===", doc.page_content, ""]  # 末尾は空行で区切り
+                page_offsets.append(position)
+                page_numbers.append(doc.metadata.get("page", i))
+                combined_content.extend(section)
+                # 「\n」で連結するため、各要素の文字数に改行1文字分を加える
+                position += sum(len(part) + 1 for part in section)
+
+            combined_metadata["page_offsets"] = page_offsets
+            combined_metadata["page_numbers"] = page_numbers
             
             # 統合ドキュメントを作成
             from langchain.schema import Document
@@ -378,85 +962,114 @@ def prioritize_important_documents(docs_all):
 
 def create_simple_keyword_retriever(docs_all):
     """
-    埋め込みベクトルを使わない簡易キーワードベース検索システムを作成
-    
+    埋め込みベクトルを使わないキーワード検索のRetrieverを作成（文字bigramの転置インデックスをBM25で検索）
+
     Args:
-        docs_all: ドキュメントのリスト
+        docs_all: ドキュメントのリスト、またはチャンクストア（チャンクストアの場合はコピーせずに参照する）
+
+    Returns:
+        キーワード検索用のRetriever
     """
-    import streamlit as st
-    import logging
-    
     logger = logging.getLogger(ct.LOGGER_NAME)
-    
-    class SimpleKeywordRetriever(BaseRetriever):
-        """LangChain互換のキーワードベースRetriever"""
-        
-        documents: List[Document]
-        
-        def __init__(self, documents: List[Document], **kwargs):
-            super().__init__(documents=documents, **kwargs)
-            
+
+    if isinstance(docs_all, document_store.DocumentStore):
+        index = keyword_index.KeywordIndex.from_store(docs_all)
+    else:
+        index = keyword_index.KeywordIndex.from_documents(docs_all)
+    retriever = keyword_index.KeywordRetriever(index=index)
+    logger.info({"keyword_index": {"created": retriever.index.stats()}})
+    return retriever
+
+
+def create_hybrid_retriever(retrievers, k=ct.RETRIEVER_TOP_K):
+    """
+    複数のRetrieverの検索結果をReciprocal Rank Fusionで統合するRetrieverを作成
+
+    Args:
+        retrievers: 統合対象のRetrieverのリスト（ベクトル検索・キーワード検索など）
+        k: 統合後に返すドキュメント数
+
+    Returns:
+        統合検索用のRetriever
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    class HybridRetriever(BaseRetriever):
+        """LangChain互換の統合検索Retriever"""
+
+        retrievers: List[BaseRetriever]
+        k: int
+
         def _get_relevant_documents(self, query: str, **kwargs) -> List[Document]:
             """
-            キーワードベースの簡易検索（LangChain BaseRetriever互換）
+            各Retrieverの順位からスコアを算出し、上位k件を返す
             """
-            query_lower = query.lower()
-            scored_docs = []
-            
-            for doc in self.documents:
-                content_lower = doc.page_content.lower()
-                source_lower = doc.metadata.get("source", "").lower()
-                
-                # 基本スコア計算
-                score = 0
-                query_words = query_lower.split()
-                
-                for word in query_words:
-                    # コンテンツ内の出現回数
-                    content_count = content_lower.count(word)
-                    score += content_count * 1
-                    
-                    # ソース名での一致（高い重み）
-                    if word in source_lower:
-                        score += 10
-                
-                # 特別なキーワード処理
-                if "人事" in query_lower and "社員名簿" in source_lower:
-                    score += 50
-                if "議事録" in query_lower and "議事録ルール" in source_lower:
-                    score += 50
-                    
-                if score > 0:
-                    scored_docs.append((score, doc))
-            
-            # スコア順にソートして上位5件を返す（デフォルト）
-            scored_docs.sort(key=lambda x: x[0], reverse=True)
-            return [doc for _, doc in scored_docs[:5]]
-            
-        def invoke(self, input_data, config=None, **kwargs) -> List[Document]:
+            return self._fuse([retriever.invoke(query) for retriever in self.retrievers])
+
+        async def _aget_relevant_documents(self, query: str, **kwargs) -> List[Document]:
             """
-            LangChain互換のinvokeメソッド
+            各Retriever（ベクトル検索・キーワード検索など）を並行して実行し、結果を統合する
             """
-            # inputからqueryを抽出
-            if isinstance(input_data, dict):
-                query = input_data.get("input", input_data.get("query", ""))
-            elif isinstance(input_data, str):
-                query = input_data
-            else:
-                query = str(input_data)
-                
-            k = kwargs.get("k", 5)
-            if not isinstance(k, int):
-                k = 5
-                
-            return self._get_relevant_documents(query, **kwargs)
-    
-    # 簡易検索システムをセッション状態に保存
-    retriever = SimpleKeywordRetriever(docs_all)
-    logger.info("Simple keyword-based retriever created successfully")
+            results = await asyncio.gather(*[retriever.ainvoke(query) for retriever in self.retrievers])
+            return self._fuse(results)
+
+        def _fuse(self, results) -> List[Document]:
+            """
+            各Retrieverの検索結果の順位からスコアを算出し、上位k件を返す
+            """
+            scores = {}
+            docs_by_key = {}
+
+            for docs in results:
+                for rank, doc in enumerate(docs):
+                    # 同一チャンクは「ファイルパス＋本文」で同一とみなす
+                    key = (doc.metadata.get("source", ""), doc.page_content)
+                    docs_by_key.setdefault(key, doc)
+                    # 順位が高いほど大きいスコアを加算（RRF）
+                    scores[key] = scores.get(key, 0.0) + 1.0 / (ct.RRF_RANK_CONSTANT + rank + 1)
+
+            ranked_keys = sorted(scores, key=scores.get, reverse=True)
+            return [docs_by_key[key] for key in ranked_keys[:self.k]]
+
+    retriever = HybridRetriever(retrievers=retrievers, k=k)
+    logger.info("Hybrid retriever created successfully")
     return retriever
 
 
+def create_scoped_retriever(search_filter, index=None):
+    """
+    検索範囲をメタデータで絞り込んだRetrieverの作成
+    （ベクターストア・キーワード検索とも、絞り込んだ範囲のドキュメントのみを検索対象とする）
+
+    Args:
+        search_filter: 絞り込み条件
+        index: 検索対象のインデックス（省略時はセッションに保存したもの）
+
+    Returns:
+        絞り込み済みのRetriever
+    """
+    if index is None:
+        index = st.session_state
+    retrievers = []
+
+    vectorstore = index.get("vectorstore")
+    if vectorstore is not None:
+        retrievers.append(create_vector_retriever(vectorstore, index.get("parent_store"), search_filter))
+
+    shared_keyword_index = index.get("keyword_index")
+    if shared_keyword_index is not None:
+        # インデックスは作り直さず、絞り込んだ範囲のドキュメントの番号のみを検索対象とする
+        retrievers.append(keyword_index.KeywordRetriever(
+            index=shared_keyword_index, doc_ids=shared_keyword_index.filter_ids(search_filter)
+        ))
+
+    if not retrievers:
+        return index.get("retriever")
+    if len(retrievers) == 1:
+        return retrievers[0]
+    return create_hybrid_retriever(retrievers)
+
+
 def recursive_file_check(path, docs_all):
     """
     RAGの参照先となるデータソースの読み込み
@@ -497,6 +1110,12 @@ def file_load(path, docs_all):
     if file_extension in ct.SUPPORTED_EXTENSIONS:
         # ファイルの拡張子に合ったdata loaderを使ってデータ読み込み
         loader_func = ct.SUPPORTED_EXTENSIONS[file_extension]
+
+        # 解析に時間のかかるファイル形式は、ファイルの内容が変わっていなければキャッシュから復元
+        if ct.EXTRACTION_CACHE_ENABLED and file_extension in ct.EXTRACTION_CACHE_EXTENSIONS:
+            docs_all.extend(extraction_cache.get_cache().load(path, loader_func))
+            return
+
         result = loader_func(path)
         
         # 戻り値がリスト（カスタムローダーの場合）か、ローダーオブジェクトかを判定
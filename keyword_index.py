@@ -0,0 +1,412 @@
+"""
+このファイルは、キーワード検索の転置インデックスと、それを検索するRetrieverを定義したファイルです。
+- 日本語は単語の区切りに空白を使わないため、正規化したテキストの文字bigram（2文字ずつの組）を語として扱い、BM25でスコアを算出する
+- 本文・メタデータはチャンクストアを参照し、インデックスは語彙・ポスティングリスト・文書長のみを持つ
+- 保存時は、インデックスとチャンクストアの配列を1つのバイナリファイルにまとめる
+- 保存したファイルはメモリマップで開くため、データソースを読み込み直さずに数ミリ秒でキーワード検索を始められる
+  （埋め込みモデルが使えない場合の起動に使う）
+
+ファイルの形式:
+    識別子（8バイト）・ヘッダーの長さ（8バイト、リトルエンディアン）・ヘッダー（JSON）を先頭に置き、
+    8バイト境界に揃えた位置から、ヘッダーに記載した各配列（語彙・ポスティングリストなど）を続けて格納する
+    （チャンクストアの配列は、配列名の先頭に「store.」を付けて格納する）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import logging
+import math
+import os
+import unicodedata
+from datetime import datetime, timezone
+from typing import List, Optional
+from uuid import uuid4
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import constants as ct
+from document_store import DocumentStore
+
+
+############################################################
+# 変数定義
+############################################################
+# ファイルの先頭に置く識別子と、保存形式のバージョン（形式を変えた場合に上げ、古いファイルを使わないようにする）
+MAGIC = b"KWINDEX\0"
+FORMAT_VERSION = 2
+# 配列を格納する位置の境界（メモリマップで開いた配列を、そのままの型で参照できるようにする）
+ALIGNMENT = 8
+# 文字bigramを1つの整数で表す際の、1文字目をずらすビット数（Unicodeの最大値は21ビットに収まる）
+CODE_POINT_BITS = 21
+# 語の区切りとみなす文字（NFKC正規化後の空白文字）のコードポイント
+WHITESPACE_CODES = np.array([code for code in range(0x3001) if chr(code).isspace()], dtype=np.uint32)
+# ファイルに格納するチャンクストアの配列名の接頭辞
+STORE_ARRAY_PREFIX = "store."
+# ポスティングリストに記録する出現回数の上限（2バイトで保持するため）
+MAX_TERM_FREQUENCY = np.iinfo(np.uint16).max
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_text(text):
+    """
+    検索用のテキストの正規化（全角・半角の違いと、大文字・小文字の違いを同一視する）
+
+    Args:
+        text: テキスト
+
+    Returns:
+        正規化後のテキスト
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def to_term_codes(text):
+    """
+    テキストを、語（文字bigram）を表す整数の配列に変換
+    （空白で区切られた1文字だけの語は、その1文字を語とする）
+
+    Args:
+        text: テキスト
+
+    Returns:
+        語を表す整数の配列（出現順、重複あり）
+    """
+    chars = np.frombuffer(normalize_text(text).encode("utf-32-le"), dtype=np.uint32)
+    is_word = ~np.isin(chars, WHITESPACE_CODES)
+    # 連続する2文字がどちらも空白でない位置を、1文字目を上位ビットに置いた整数に変換
+    paired = is_word[:-1] & is_word[1:]
+    bigrams = (chars[:-1][paired].astype(np.uint64) << CODE_POINT_BITS) | chars[1:][paired]
+    # 前後が空白（または文頭・文末）の1文字
+    isolated = is_word & ~np.r_[False, is_word[:-1]] & ~np.r_[is_word[1:], False]
+    return np.concatenate([bigrams, chars[isolated].astype(np.uint64)])
+
+
+def build_index_buffer(store):
+    """
+    チャンクストアのチャンクから転置インデックスを作成し、ファイルの形式のバイト列に変換
+
+    Args:
+        store: チャンクストア
+
+    Returns:
+        インデックスのバイト列（チャンクストアの配列は含まない）
+    """
+    doc_lengths = np.zeros(len(store), dtype=np.uint32)
+    term_parts, doc_id_parts, frequency_parts = [], [], []
+    for doc_id in range(len(store)):
+        codes = to_term_codes(store.text(doc_id))
+        doc_lengths[doc_id] = len(codes)
+        terms, frequencies = np.unique(codes, return_counts=True)
+        term_parts.append(terms)
+        frequency_parts.append(frequencies)
+        doc_id_parts.append(np.full(len(terms), doc_id, dtype=np.uint32))
+
+    # 語・ドキュメントの順に並べ、語ごとのポスティングリストの開始位置を求める
+    terms = np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.uint64)
+    doc_ids = np.concatenate(doc_id_parts) if doc_id_parts else np.zeros(0, dtype=np.uint32)
+    frequencies = np.concatenate(frequency_parts) if frequency_parts else np.zeros(0, dtype=np.int64)
+    order = np.lexsort((doc_ids, terms))
+    terms, doc_ids, frequencies = terms[order], doc_ids[order], frequencies[order]
+    vocabulary, starts = np.unique(terms, return_index=True)
+
+    arrays = {
+        "vocabulary": vocabulary.astype(np.uint64),
+        "posting_offsets": np.append(starts, len(terms)).astype(np.uint64),
+        "posting_doc_ids": doc_ids,
+        "posting_frequencies": np.minimum(frequencies, MAX_TERM_FREQUENCY).astype(np.uint16),
+        "doc_lengths": doc_lengths,
+    }
+    header = {
+        "format_version": FORMAT_VERSION,
+        "documents": len(store),
+        "average_length": float(doc_lengths.mean()) if len(store) else 0.0,
+    }
+    return serialize(header, arrays)
+
+
+def align(position):
+    """
+    格納位置を配列の境界に揃える
+
+    Args:
+        position: 格納位置（バイト）
+
+    Returns:
+        境界に揃えた格納位置
+    """
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def serialize(header, arrays):
+    """
+    ヘッダーと配列を、ファイルの形式のバイト列に変換
+
+    Args:
+        header: ヘッダー（配列の格納位置以外）
+        arrays: 配列名と配列の辞書
+
+    Returns:
+        バイト列
+    """
+    data = bytearray()
+    layout = {}
+    for name, array in arrays.items():
+        data.extend(b"\0" * (align(len(data)) - len(data)))
+        # 格納位置は、配列の格納を始める位置からの相対位置とする（ヘッダーの長さに依存させないため）
+        layout[name] = [array.dtype.str, len(data), len(array)]
+        data.extend(np.ascontiguousarray(array).tobytes())
+    encoded_header = json.dumps({**header, "arrays": layout}, ensure_ascii=False).encode("utf-8")
+
+    prefix = MAGIC + np.uint64(len(encoded_header)).astype("<u8").tobytes() + encoded_header
+    return prefix + b"\0" * (align(len(prefix)) - len(prefix)) + bytes(data)
+
+
+def get_index_path():
+    """
+    保存するキーワード検索のインデックスのファイルパスの取得
+
+    Returns:
+        ファイルパス
+    """
+    return os.path.join(ct.KEYWORD_INDEX_DIR_PATH, ct.KEYWORD_INDEX_FILE)
+
+
+def save_index(index, path=None, **info):
+    """
+    キーワード検索のインデックスをファイルに保存
+
+    Args:
+        index: キーワード検索のインデックス
+        path: 保存先のファイルパス（省略時は既定の保存先）
+        info: ヘッダーに記録する付加情報（インデックスのバージョン・検索範囲の一覧など）
+    """
+    path = path or get_index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # チャンクストアの配列も同じファイルに格納し、読み込み時にデータソースを読み込み直さずに済むようにする
+    store_header, store_arrays = index.store.to_arrays()
+    header = {**index.header, **info, "store": store_header, "built_at": datetime.now(timezone.utc).isoformat()}
+    arrays = {**index.arrays, **{STORE_ARRAY_PREFIX + name: array for name, array in store_arrays.items()}}
+    data = serialize(header, arrays)
+    # 他のプロセスが書き込み途中のファイルを開かないよう、一時ファイルに書き出してから置き換える
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_index(path=None):
+    """
+    保存したキーワード検索のインデックスをメモリマップで開く
+    （ファイルがない、または形式が異なる場合はNone）
+
+    Args:
+        path: ファイルパス（省略時は既定の保存先）
+
+    Returns:
+        キーワード検索のインデックス
+    """
+    path = path or get_index_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        return KeywordIndex(np.memmap(path, dtype=np.uint8, mode="r"))
+    except (ValueError, KeyError) as e:
+        logging.getLogger(ct.LOGGER_NAME).warning({"keyword_index": f"Ignored unreadable index {path}: {e}"})
+        return None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class KeywordIndex:
+    """
+    文字bigramの転置インデックス（メモリ上のバイト列・メモリマップで開いたファイルのどちらも同じ形式で参照する）
+    本文・メタデータはチャンクストアを参照し、検索結果として返すドキュメントの分のみ復元する
+    """
+
+    def __init__(self, buffer, store=None):
+        """
+        Args:
+            buffer: ファイルの形式のバイト列（uint8の配列）
+            store: 参照するチャンクストア（Noneの場合、ファイルに格納したチャンクストアを使う）
+        """
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError("Not a keyword index")
+        header_length = int(buffer[len(MAGIC):len(MAGIC) + 8].view("<u8")[0])
+        header_end = len(MAGIC) + 8 + header_length
+        header = json.loads(bytes(buffer[len(MAGIC) + 8:header_end]).decode("utf-8"))
+        if header["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported keyword index format: {header['format_version']}")
+
+        data_start = align(header_end)
+        self.arrays, store_arrays = {}, {}
+        for name, (dtype, offset, length) in header.pop("arrays").items():
+            start = data_start + offset
+            array = buffer[start:start + length * np.dtype(dtype).itemsize].view(dtype)
+            if name.startswith(STORE_ARRAY_PREFIX):
+                store_arrays[name[len(STORE_ARRAY_PREFIX):]] = array
+            else:
+                self.arrays[name] = array
+        store_header = header.pop("store", None)
+        self.header = header
+        self.store = store if store is not None else DocumentStore.from_arrays(store_header, store_arrays)
+        if len(self.store) != header["documents"]:
+            raise ValueError("Keyword index does not match the chunk store")
+
+        # 検索のたびに使う値は、あらかじめ計算しておく
+        self.document_count = header["documents"]
+        # 出典は種類が少ないため、出典の一覧ごとに加点を求め、チャンクごとには一覧の番号で参照する
+        self._source_codes, sources = self.store.column("source")
+        self._sources = [normalize_text(str(source)) for source in sources]
+        average_length = header["average_length"] or 1.0
+        self._length_norm = ct.KEYWORD_BM25_K1 * (
+            1 - ct.KEYWORD_BM25_B + ct.KEYWORD_BM25_B * self.arrays["doc_lengths"].astype(np.float32) / average_length
+        )
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        チャンクストアからのインデックスの作成（チャンクストアはコピーせずに参照する）
+
+        Args:
+            store: チャンクストア
+
+        Returns:
+            キーワード検索のインデックス
+        """
+        return cls(np.frombuffer(build_index_buffer(store), dtype=np.uint8), store=store)
+
+    @classmethod
+    def from_documents(cls, docs):
+        """
+        ドキュメントからのインデックスの作成
+
+        Args:
+            docs: ドキュメントのリスト
+
+        Returns:
+            キーワード検索のインデックス
+        """
+        return cls.from_store(DocumentStore.from_documents(docs))
+
+    def __len__(self):
+        return self.document_count
+
+    def stats(self):
+        """
+        インデックスの規模の取得
+
+        Returns:
+            ドキュメント数・語彙数・ポスティング数・バイト数（インデックスとチャンクストア）の辞書
+        """
+        return {
+            "documents": self.document_count,
+            "terms": len(self.arrays["vocabulary"]),
+            "postings": len(self.arrays["posting_doc_ids"]),
+            "bytes": int(sum(array.nbytes for array in self.arrays.values())),
+            "store_bytes": int(sum(self.store.memory_usage().values())),
+        }
+
+    def get_document(self, doc_id):
+        """
+        ドキュメントの復元
+
+        Args:
+            doc_id: ドキュメントの番号
+
+        Returns:
+            ドキュメント
+        """
+        return self.store.document(doc_id)
+
+    def filter_ids(self, search_filter):
+        """
+        絞り込み条件に一致するドキュメントの番号の取得
+
+        Args:
+            search_filter: 絞り込み条件
+
+        Returns:
+            ドキュメントの番号の配列
+        """
+        return self.store.filter_ids(search_filter)
+
+    def source_bonus(self, query):
+        """
+        出典（ファイルパス）ごとの加点の算出
+        - 検索クエリの語（空白区切り）がファイルパスに含まれる場合
+        - 検索クエリに特定の語が含まれ、対応するファイル（人事の質問に対する社員名簿など）の場合
+
+        Args:
+            query: 検索クエリ
+
+        Returns:
+            出典の一覧の順の加点の配列
+        """
+        query = normalize_text(query)
+        words = query.split()
+        bonus = np.zeros(len(self._sources), dtype=np.float32)
+        for number, source in enumerate(self._sources):
+            bonus[number] += ct.KEYWORD_SOURCE_MATCH_BONUS * sum(1 for word in words if word in source)
+            for keyword, (file_name, boost) in ct.KEYWORD_SOURCE_BOOSTS.items():
+                if keyword in query and file_name in source:
+                    bonus[number] += boost
+        return bonus
+
+    def search(self, query, k, doc_ids=None):
+        """
+        BM25と出典の加点によるスコアの上位k件の取得（スコアが0のドキュメントは含めない）
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            doc_ids: 検索対象とするドキュメントの番号の配列（Noneの場合は全件）
+
+        Returns:
+            ドキュメントの番号とスコアの組のリスト（スコアの高い順）
+        """
+        vocabulary = self.arrays["vocabulary"]
+        offsets = self.arrays["posting_offsets"]
+        scores = np.zeros(self.document_count, dtype=np.float32)
+
+        # 検索クエリの語ごとに、その語を含むドキュメントのみスコアを加算
+        codes = np.unique(to_term_codes(query))
+        positions = np.searchsorted(vocabulary, codes)
+        positions = positions[positions < len(vocabulary)]
+        positions = positions[np.isin(vocabulary[positions], codes)]
+        for position in positions:
+            start, end = int(offsets[position]), int(offsets[position + 1])
+            posting_doc_ids = self.arrays["posting_doc_ids"][start:end]
+            frequencies = self.arrays["posting_frequencies"][start:end].astype(np.float32)
+            document_frequency = end - start
+            idf = math.log(1 + (self.document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            scores[posting_doc_ids] += idf * frequencies * (ct.KEYWORD_BM25_K1 + 1) / (
+                frequencies + self._length_norm[posting_doc_ids]
+            )
+        # 出典が未設定のチャンク（番号「-1」）は、末尾に加えた0を参照する
+        scores += np.append(self.source_bonus(query), 0.0)[self._source_codes]
+
+        candidates = np.arange(self.document_count) if doc_ids is None else doc_ids
+        candidate_scores = scores[candidates]
+        matched = np.flatnonzero(candidate_scores > 0)
+        top = matched[np.argsort(-candidate_scores[matched], kind="stable")[:k]]
+        return [(int(candidates[i]), float(candidate_scores[i])) for i in top]
+
+
+class KeywordRetriever(BaseRetriever):
+    """
+    キーワード検索のインデックスを検索するLangChain互換のRetriever（検索範囲の絞り込みはドキュメントの番号で行う）
+    """
+
+    index: KeywordIndex
+    doc_ids: Optional[np.ndarray] = None
+    k: int = ct.KEYWORD_TOP_K
+
+    def _get_relevant_documents(self, query: str, **kwargs) -> List[Document]:
+        return [self.index.get_document(doc_id) for doc_id, _ in self.index.search(query, self.k, self.doc_ids)]
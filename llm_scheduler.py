@@ -0,0 +1,571 @@
+"""
+このファイルは、全セッションからのLLMへのリクエストをプロセス内で一括して制御するスケジューラーを定義したファイルです。
+- 1分あたりのリクエスト数・トークン数の上限をトークンバケットで守り、同時実行数にも上限を設ける
+- 待ち行列はセッションごとに分け、順番に1件ずつ実行する（1つのセッションの連続リクエストが他のセッションを待たせない）
+- レート制限（429）や一時的なエラーの場合は、Retry-Afterに従い、ゆらぎを加えた待ち時間の後に再実行する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, List, Optional
+import openai
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+import constants as ct
+import circuit_breaker
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するスケジューラー（全セッションで1つのスケジューラーを使い回す）
+_scheduler = None
+_scheduler_lock = threading.Lock()
+# 再実行の対象とする、時間をおけば成功する可能性のあるエラー
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_scheduler():
+    """
+    プロセス内で共有するLLMスケジューラーの取得（未作成の場合は作成）
+
+    Returns:
+        LLMスケジューラー
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LlmScheduler(
+                max_concurrency=ct.LLM_MAX_CONCURRENCY,
+                requests_per_minute=ct.LLM_REQUESTS_PER_MINUTE,
+                tokens_per_minute=ct.LLM_TOKENS_PER_MINUTE,
+                max_queue_size=ct.LLM_MAX_QUEUE_SIZE,
+                max_wait_seconds=ct.LLM_MAX_QUEUE_WAIT_SECONDS,
+                max_retries=ct.LLM_MAX_RETRIES
+            )
+        return _scheduler
+
+
+def estimate_tokens(messages):
+    """
+    リクエストで消費するトークン数の見積もり（入力の文字数と、回答の想定トークン数の合計）
+
+    Args:
+        messages: LLMに渡すメッセージのリスト
+
+    Returns:
+        見積もったトークン数
+    """
+    characters = sum(len(str(message.content)) for message in messages)
+    return math.ceil(characters / ct.LLM_CHARS_PER_TOKEN) + ct.LLM_EXPECTED_COMPLETION_TOKENS
+
+
+def get_retry_delay(error, attempt):
+    """
+    再実行までの待ち時間の取得
+    （Retry-Afterの指定があればそれに従い、なければ指数的に延ばす。同時に再実行が集中しないよう、ゆらぎを加える）
+
+    Args:
+        error: 発生したエラー
+        attempt: 何回目の再実行か（0始まり）
+
+    Returns:
+        待ち時間（秒）
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000
+        else:
+            retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = None
+
+    if retry_after is not None:
+        return min(retry_after, ct.LLM_RETRY_MAX_DELAY_SECONDS) + random.uniform(0, ct.LLM_RETRY_BASE_DELAY_SECONDS)
+    return random.uniform(0, min(ct.LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt, ct.LLM_RETRY_MAX_DELAY_SECONDS))
+
+
+def is_backend_failure(error):
+    """
+    サーキットブレーカーで数える、LLMのバックエンドの障害によるエラーかどうかの判定
+    （リクエスト内容の誤りや、スケジューラーの待ち行列があふれた場合は数えない）
+    （実行1回ごとに数えるため、時間をおけば成功するレート制限もスケジューラーの再実行に任せて数えない）
+
+    Args:
+        error: 発生したエラー
+
+    Returns:
+        バックエンドの障害の場合はTrue
+    """
+    if isinstance(error, openai.RateLimitError) and is_retryable(error):
+        return False
+    return not isinstance(error, (openai.BadRequestError, LlmSchedulerError))
+
+
+def is_retryable(error):
+    """
+    再実行の対象となるエラーかどうかの判定
+    （利用枠の上限に達した「insufficient_quota」は、時間をおいても成功しないため対象外）
+
+    Args:
+        error: 発生したエラー
+
+    Returns:
+        再実行の対象の場合はTrue
+    """
+    if not isinstance(error, RETRYABLE_ERRORS):
+        return False
+    return getattr(error, "code", None) != "insufficient_quota"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LlmSchedulerError(RuntimeError):
+    """
+    待ち行列が上限に達した、または待ち時間の上限を超えたため、リクエストを受け付けられなかった場合のエラー
+    """
+
+
+class TokenBucket:
+    """
+    1分あたりの上限量を、一定の速さで補充しながら消費するトークンバケット
+    """
+
+    def __init__(self, per_minute):
+        """
+        Args:
+            per_minute: 1分あたりの上限量（Noneの場合は制限しない）
+        """
+        self.capacity = per_minute
+        self.available = float(per_minute or 0)
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        """
+        経過時間に応じた補充
+
+        Args:
+            now: 現在時刻（time.monotonic()の値）
+        """
+        if self.capacity is None:
+            return
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def get_wait_time(self, amount):
+        """
+        指定量を消費できるまでの待ち時間の取得（補充済みの状態で呼び出す）
+
+        Args:
+            amount: 消費する量
+
+        Returns:
+            待ち時間（秒、すぐに消費できる場合は0）
+        """
+        if self.capacity is None:
+            return 0.0
+        # 上限を超える量は、上限まで貯まった時点で消費できるものとする（永久に待たないようにする）
+        shortage = min(amount, self.capacity) - self.available
+        return max(shortage, 0.0) * 60 / self.capacity
+
+    def consume(self, amount):
+        """
+        指定量の消費（実際の消費量との差の精算にも使うため、残量はマイナスにもなる）
+
+        Args:
+            amount: 消費する量
+        """
+        if self.capacity is not None:
+            self.available -= amount
+
+
+class LlmScheduler:
+    """
+    LLMへのリクエストを、レート制限・同時実行数・セッション間の公平性を守って実行するスケジューラー
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute, max_queue_size,
+                 max_wait_seconds, max_retries):
+        """
+        Args:
+            max_concurrency: 同時に実行する最大リクエスト数
+            requests_per_minute: 1分あたりの最大リクエスト数（Noneの場合は制限しない）
+            tokens_per_minute: 1分あたりの最大トークン数（Noneの場合は制限しない）
+            max_queue_size: 実行待ちにできる最大リクエスト数（超えた場合は受け付けない）
+            max_wait_seconds: 実行待ちの最大時間（秒）
+            max_retries: エラー時に再実行する最大回数
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_retries = max_retries
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        # セッションごとの実行待ちの行列（先頭のセッションの先頭のリクエストから実行し、実行後はそのセッションを末尾に回す）
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        self._condition = threading.Condition()
+        # 利用状況の集計
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.acquired = 0
+        self.total_wait_seconds = 0.0
+
+    def run(self, session_id, estimated_tokens, call, breaker=None):
+        """
+        順番・レート制限・同時実行数の上限を守ってリクエストを実行（エラー時は必要に応じて再実行）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            estimated_tokens: 見積もったトークン数
+            call: リクエストを実行する関数
+            breaker: 実行1回ごとに成功・失敗を記録するサーキットブレーカー（実行待ちの時間は含めない）
+
+        Returns:
+            リクエストの実行結果
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire(session_id, estimated_tokens)
+            try:
+                result = (call() if breaker is None else breaker.call(call))
+                with self._condition:
+                    self.completed += 1
+                return result
+            except Exception as e:
+                # 障害のため遮断された場合は、再実行せずに即座にエラーとする
+                if attempt >= self.max_retries or not is_retryable(e) or (breaker is not None and breaker.is_open()):
+                    with self._condition:
+                        self.failed += 1
+                    raise
+                delay = get_retry_delay(e, attempt)
+                with self._condition:
+                    self.retries += 1
+                logging.getLogger(ct.LOGGER_NAME).warning(
+                    {"llm_retry": {"attempt": attempt + 1, "delay_seconds": round(delay, 2), "error": type(e).__name__}}
+                )
+            finally:
+                self._release()
+            # 待っている間は実行枠を他のリクエストに譲る
+            time.sleep(delay)
+
+    async def arun(self, session_id, estimated_tokens, call, breaker=None):
+        """
+        「run」の非同期版（実行待ち・再実行までの待ちの間も、イベントループを止めない）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            estimated_tokens: 見積もったトークン数
+            call: リクエストを実行するコルーチンを返す関数
+            breaker: 実行1回ごとに成功・失敗を記録するサーキットブレーカー（実行待ちの時間は含めない）
+
+        Returns:
+            リクエストの実行結果
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire(session_id, estimated_tokens)
+            try:
+                result = await (call() if breaker is None else breaker.acall(call))
+                with self._condition:
+                    self.completed += 1
+                return result
+            except Exception as e:
+                # 障害のため遮断された場合は、再実行せずに即座にエラーとする
+                if attempt >= self.max_retries or not is_retryable(e) or (breaker is not None and breaker.is_open()):
+                    with self._condition:
+                        self.failed += 1
+                    raise
+                delay = get_retry_delay(e, attempt)
+                with self._condition:
+                    self.retries += 1
+                logging.getLogger(ct.LOGGER_NAME).warning(
+                    {"llm_retry": {"attempt": attempt + 1, "delay_seconds": round(delay, 2), "error": type(e).__name__}}
+                )
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    def settle_tokens(self, estimated_tokens, actual_tokens):
+        """
+        見積もったトークン数と、実際に消費したトークン数の差の精算
+
+        Args:
+            estimated_tokens: 見積もったトークン数
+            actual_tokens: 実際に消費したトークン数
+        """
+        with self._condition:
+            self._token_bucket.consume(actual_tokens - estimated_tokens)
+
+    def stats(self):
+        """
+        スケジューラーの利用状況の取得
+
+        Returns:
+            実行待ち数（待ち行列の深さ）・実行中の数・完了数などの辞書
+        """
+        with self._condition:
+            return {
+                "queue_depth": self._queued,
+                "waiting_sessions": len(self._queues),
+                "running": self._running,
+                "max_queue_depth": self.max_queue_depth,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "average_wait_ms": round(self.total_wait_seconds / self.acquired * 1000, 1) if self.acquired else 0.0,
+            }
+
+    def _acquire(self, session_id, tokens):
+        """
+        実行の順番が回ってきて、レート制限・同時実行数の上限内で実行できるようになるまで待つ
+
+        Args:
+            session_id: リクエスト元のセッションID
+            tokens: 見積もったトークン数
+        """
+        started = time.monotonic()
+        with self._condition:
+            ticket = self._enqueue(session_id)
+            while True:
+                wait_time = self._get_wait_time(session_id, ticket, tokens)
+                if wait_time == 0:
+                    break
+                remaining = self._get_remaining_wait(session_id, ticket, started)
+                self._condition.wait(timeout=remaining if wait_time is None else min(wait_time, remaining))
+            self._grant(session_id, ticket, tokens, started)
+        self._log_wait(started)
+
+    async def _aacquire(self, session_id, tokens):
+        """
+        実行できるようになるまで、イベントループを止めずに待つ（非同期処理用）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            tokens: 見積もったトークン数
+        """
+        started = time.monotonic()
+        with self._condition:
+            ticket = self._enqueue(session_id)
+        try:
+            while True:
+                with self._condition:
+                    wait_time = self._get_wait_time(session_id, ticket, tokens)
+                    if wait_time == 0:
+                        self._grant(session_id, ticket, tokens, started)
+                        break
+                    remaining = self._get_remaining_wait(session_id, ticket, started)
+                # 他のリクエストの完了は通知されないため、一定間隔で実行できるかどうかを確認する
+                await asyncio.sleep(min(wait_time or ct.LLM_ASYNC_POLL_SECONDS, remaining))
+        except asyncio.CancelledError:
+            # 待っている間にキャンセルされた場合は、行列から外して後続のリクエストに順番を譲る
+            with self._condition:
+                if ticket in self._queues.get(session_id, ()):
+                    self._remove(session_id, ticket)
+                    self._condition.notify_all()
+            raise
+        self._log_wait(started)
+
+    def _enqueue(self, session_id):
+        """
+        セッションの行列の末尾へのリクエストの追加（ロック取得済みの状態で呼び出す）
+
+        Args:
+            session_id: リクエスト元のセッションID
+
+        Returns:
+            リクエストの識別用オブジェクト
+        """
+        if self._queued >= self.max_queue_size:
+            self.rejected += 1
+            raise LlmSchedulerError(f"LLM request queue is full ({self._queued} requests waiting)")
+        ticket = object()
+        self._queues.setdefault(session_id, deque()).append(ticket)
+        self._queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queued)
+        return ticket
+
+    def _get_remaining_wait(self, session_id, ticket, started):
+        """
+        待ち時間の上限までの残り時間の取得（上限を超えた場合は行列から外してエラー、ロック取得済みの状態で呼び出す）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            ticket: リクエストの識別用オブジェクト
+            started: 待ち始めた時刻
+
+        Returns:
+            残り時間（秒）
+        """
+        remaining = self.max_wait_seconds - (time.monotonic() - started)
+        if remaining <= 0:
+            self._remove(session_id, ticket)
+            self.rejected += 1
+            self._condition.notify_all()
+            raise LlmSchedulerError(f"LLM request waited more than {self.max_wait_seconds} seconds")
+        return remaining
+
+    def _grant(self, session_id, ticket, tokens, started):
+        """
+        実行枠とバケットを消費し、このセッションを行列の末尾に回す（ロック取得済みの状態で呼び出す）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            ticket: リクエストの識別用オブジェクト
+            tokens: 見積もったトークン数
+            started: 待ち始めた時刻
+        """
+        self._remove(session_id, ticket)
+        if session_id in self._queues:
+            self._queues.move_to_end(session_id)
+        self._running += 1
+        self._request_bucket.consume(1)
+        self._token_bucket.consume(tokens)
+        self.acquired += 1
+        self.total_wait_seconds += time.monotonic() - started
+        # 次の順番のリクエストに、実行できるかどうかを確認させる
+        self._condition.notify_all()
+
+    def _log_wait(self, started):
+        """
+        実行待ちの時間が長かった場合のログ出力
+
+        Args:
+            started: 待ち始めた時刻
+        """
+        waited = time.monotonic() - started
+        if waited >= ct.LLM_QUEUE_WAIT_LOG_THRESHOLD_SECONDS:
+            logging.getLogger(ct.LOGGER_NAME).info(
+                {"llm_queue": {"wait_ms": round(waited * 1000, 1), "queue_depth": self._queued}}
+            )
+
+    def _release(self):
+        """
+        実行枠の返却
+        """
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def _get_wait_time(self, session_id, ticket, tokens):
+        """
+        リクエストを実行できるまでの待ち時間の取得（ロック取得済みの状態で呼び出す）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            ticket: リクエストの識別用オブジェクト
+            tokens: 見積もったトークン数
+
+        Returns:
+            待ち時間（秒、すぐに実行できる場合は0。他のリクエストの完了待ちの場合は通知されるまで待つためNone）
+        """
+        first_session, first_queue = next(iter(self._queues.items()))
+        if first_session != session_id or first_queue[0] is not ticket or self._running >= self.max_concurrency:
+            return None
+
+        now = time.monotonic()
+        self._request_bucket.refill(now)
+        self._token_bucket.refill(now)
+        return max(self._request_bucket.get_wait_time(1), self._token_bucket.get_wait_time(tokens))
+
+    def _remove(self, session_id, ticket):
+        """
+        行列からのリクエストの削除（ロック取得済みの状態で呼び出す）
+
+        Args:
+            session_id: リクエスト元のセッションID
+            ticket: リクエストの識別用オブジェクト
+        """
+        queue = self._queues[session_id]
+        queue.remove(ticket)
+        self._queued -= 1
+        if not queue:
+            del self._queues[session_id]
+
+
+class ScheduledChatModel(BaseChatModel):
+    """
+    LLMスケジューラーを通してリクエストを実行するチャットモデルのラッパー
+    （Chainの中で呼び出される質問の言い換え・回答生成の両方が、スケジューラーの制御下で実行される）
+    """
+
+    llm: BaseChatModel
+    session_id: str
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.llm._llm_type}"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        scheduler = get_scheduler()
+        estimated_tokens = estimate_tokens(messages)
+        # 障害中の場合は待ち行列に並ばず、即座にエラーとする（成功・失敗は実行1回ごとにスケジューラーで記録する）
+        breaker = circuit_breaker.get_breaker("openai_chat", is_failure=is_backend_failure)
+        breaker.reject_if_open()
+        # 元のチャットモデルのトークンのストリーミングなどが呼び出し元のコールバックに届くよう、実行の管理オブジェクトを引き渡す
+        result = scheduler.run(
+            self.session_id, estimated_tokens,
+            lambda: self.llm._generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            breaker=breaker
+        )
+        self._settle_tokens(scheduler, estimated_tokens, result)
+        return result
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        scheduler = get_scheduler()
+        estimated_tokens = estimate_tokens(messages)
+        breaker = circuit_breaker.get_breaker("openai_chat", is_failure=is_backend_failure)
+        breaker.reject_if_open()
+        result = await scheduler.arun(
+            self.session_id, estimated_tokens,
+            lambda: self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            breaker=breaker
+        )
+        self._settle_tokens(scheduler, estimated_tokens, result)
+        return result
+
+    def _settle_tokens(self, scheduler, estimated_tokens, result):
+        """
+        実際の消費トークン数が分かる場合は、見積もりとの差をバケットで精算
+
+        Args:
+            scheduler: LLMスケジューラー
+            estimated_tokens: 見積もったトークン数
+            result: LLMの実行結果
+        """
+        token_usage = (result.llm_output or {}).get("token_usage") or {}
+        if token_usage.get("total_tokens"):
+            scheduler.settle_tokens(estimated_tokens, token_usage["total_tokens"])
@@ -0,0 +1,158 @@
+"""
+このファイルは、ログ出力の補助機能（コンテキスト変数・JSON整形・非同期書き込み）を定義したファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import logging
+import queue
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from uuid import uuid4
+
+
+############################################################
+# コンテキスト変数の定義
+############################################################
+# コンテキスト変数が未設定の場合にログへ出力する値
+UNBOUND_ID = "-"
+# ログに付与するセッションID（Streamlitのスクリプト実行スレッドごとに設定）
+session_id_var = ContextVar("session_id", default=UNBOUND_ID)
+# ログに付与するリクエストID（チャット送信1回ごとに採番）
+request_id_var = ContextVar("request_id", default=UNBOUND_ID)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def bind_session_id(session_id):
+    """
+    以降のログ出力に付与するセッションIDを設定（リクエストIDは未採番の状態に戻す）
+
+    Args:
+        session_id: セッションID
+    """
+    session_id_var.set(session_id)
+    request_id_var.set(UNBOUND_ID)
+
+
+def new_request_id():
+    """
+    リクエストIDを新規に採番し、以降のログ出力に付与するよう設定
+
+    Returns:
+        採番したリクエストID
+    """
+    request_id = uuid4().hex
+    request_id_var.set(request_id)
+    return request_id
+
+
+def start_queue_logging(logger, handlers):
+    """
+    ロガーにQueueHandlerを設定し、実際の書き込みはバックグラウンドスレッドで行う
+
+    Args:
+        logger: 設定対象のロガー
+        handlers: バックグラウンドスレッドで実行するハンドラー（ファイル書き込みなど）のリスト
+
+    Returns:
+        起動したQueueListener
+    """
+    # ログレコードの受け渡し用キュー（上限なしのため、呼び出し元がブロックされることはない）
+    log_queue = queue.Queue(-1)
+
+    # 呼び出し元スレッドではキューへの投入のみを行うハンドラー
+    logger.addHandler(ContextQueueHandler(log_queue))
+
+    # キューからレコードを取り出してファイルなどに書き込むリスナー
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    return listener
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ContextQueueHandler(QueueHandler):
+    """
+    ログ出力時点のコンテキスト変数（セッションID・リクエストID）を確定させてキューに投入するハンドラー
+    """
+
+    def prepare(self, record):
+        """
+        キュー投入前のレコード整形
+
+        Args:
+            record: ログレコード
+
+        Returns:
+            別スレッドに受け渡し可能な状態に整形したログレコード
+        """
+        # コンテキスト変数は呼び出し元スレッドでしか参照できないため、ここで値を確定させる
+        record.session_id = session_id_var.get()
+        record.request_id = request_id_var.get()
+
+        # 例外情報はトレースバックを文字列化して保持（トレースバックオブジェクトはスレッドをまたいで保持しない）
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        # 辞書形式のメッセージは構造化データとしてそのまま受け渡し、それ以外は引数を埋め込んだ文字列に変換
+        if not isinstance(record.msg, dict):
+            record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+class JsonLineFormatter(logging.Formatter):
+    """
+    ログレコードを1行1件のJSON形式に整形するフォーマッター
+    """
+
+    def format(self, record):
+        """
+        ログレコードのJSON文字列化
+
+        Args:
+            record: ログレコード
+
+        Returns:
+            JSON文字列
+        """
+        # 出力する項目
+        # - 「time」: ログのタイムスタンプ（UTC、ISO 8601形式）
+        # - 「level」: ログの重要度（INFO, WARNING, ERRORなど）
+        # - 「line」/「func」: ログが出力された行番号・関数名
+        # - 「session_id」/「request_id」: 誰のどの操作のログか分かるように
+        payload = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "line": record.lineno,
+            "func": record.funcName,
+            "session_id": getattr(record, "session_id", UNBOUND_ID),
+            "request_id": getattr(record, "request_id", UNBOUND_ID),
+        }
+
+        # 辞書形式のメッセージはキーを展開して出力し、それ以外は「message」に格納
+        # （上記の項目と同じキーは上書きせず、先頭に「msg_」を付けて出力する）
+        if isinstance(record.msg, dict):
+            for key, value in record.msg.items():
+                payload[f"msg_{key}" if key in payload else key] = value
+        else:
+            payload["message"] = record.getMessage()
+
+        # 例外情報が存在する場合のみ追加
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        elif record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(payload, ensure_ascii=False, default=str)
@@ -21,6 +21,16 @@ from initialize import initialize
 import components as cn
 # （自作）変数（定数）がまとめて定義・管理されているモジュール
 import constants as ct
+# （自作）ログ出力の補助機能が定義されているモジュール
+import log_utils
+# （自作）リクエスト単位のプロファイリング機能が定義されているモジュール
+import profiler
+# （自作）検索クエリの埋め込みキャッシュが定義されているモジュール
+import embedding_cache
+# （自作）LLMへのリクエストを制御するスケジューラーが定義されているモジュール
+import llm_scheduler
+# （自作）画面を介さずに検索・回答を取得するHTTP APIが定義されているモジュール
+import api_server
 
 
 ############################################################
@@ -141,10 +151,13 @@ except Exception as e:
         if "session_id" not in st.session_state:
             from uuid import uuid4
             st.session_state.session_id = uuid4().hex
+        log_utils.bind_session_id(st.session_state.session_id)
         if "messages" not in st.session_state:
             st.session_state.messages = []
         if "chat_history" not in st.session_state:
             st.session_state.chat_history = []
+        if "spilled_message_count" not in st.session_state:
+            st.session_state.spilled_message_count = 0
         
         # Retrieverをフォールバック状態に設定
         st.session_state.retriever = None
@@ -156,6 +169,10 @@ except Exception as e:
         # 完全な失敗の場合のみ停止
         st.stop()
 
+# 環境変数で有効化されている場合、同じプロセス内でHTTP APIも起動（画面と同じインデックスを共有する）
+if os.getenv(ct.API_ENABLED_ENV_VAR, "false").lower() == "true":
+    api_server.start_in_background()
+
 # アプリ起動時のログファイルへの出力
 if not "initialized" in st.session_state:
     st.session_state.initialized = True
@@ -176,6 +193,13 @@ with st.sidebar:
     # モード表示（サイドバーに移動）
     cn.display_select_mode()
 
+    # 検索範囲の選択
+    st.markdown("## 検索範囲")
+    cn.display_search_scope()
+
+    # 消費トークン数・料金の集計（管理者用トークンが指定された場合のみ）
+    cn.display_usage_summary()
+
 ############################################################
 # 5. メインコンテンツエリアの表示
 ############################################################
@@ -207,96 +231,107 @@ chat_message = st.chat_input(ct.CHAT_INPUT_HELPER_TEXT)
 # 7. チャット送信時の処理
 ############################################################
 if chat_message:
-    # ==========================================
-    # 7-1. ユーザーメッセージの表示
-    # ==========================================
-    # ユーザーメッセージのログ出力
-    logger.info({"message": chat_message, "application_mode": st.session_state.mode})
+    # チャット送信1回ごとにリクエストIDを採番（以降のログに自動で付与される）
+    request_id = log_utils.new_request_id()
+
+    # 有効化されている場合のみ、チャット送信時の処理全体をプロファイリング（無効時の負荷はほぼゼロ）
+    with profiler.profile_request(st.session_state.session_id, request_id, enabled=profiler.is_profiling_enabled()):
+        # ==========================================
+        # 7-1. ユーザーメッセージの表示
+        # ==========================================
+        # ユーザーメッセージのログ出力
+        logger.info({"message": chat_message, "application_mode": st.session_state.mode})
 
-    # ユーザーメッセージを表示
-    with st.chat_message("user"):
-        st.markdown(chat_message)
+        # ユーザーメッセージを表示
+        with st.chat_message("user"):
+            st.markdown(chat_message)
 
-    # ==========================================
-    # 7-2. LLMからの回答取得
-    # ==========================================
-    # 「st.spinner」でグルグル回っている間、表示の不具合が発生しないよう空のエリアを表示
-    res_box = st.empty()
-    # LLMによる回答生成（回答生成が完了するまでグルグル回す）
-    with st.spinner(ct.SPINNER_TEXT):
-        try:
-            # 初期化状態の確認
-            if not hasattr(st.session_state, 'retriever'):
-                logger.warning("Retriever not initialized, attempting emergency initialization")
-                # 緊急初期化を試行
-                try:
-                    initialize()
-                except Exception as init_error:
-                    logger.error(f"Emergency initialization failed: {init_error}")
-                    # 完全にフォールバックモードで動作
-                    st.session_state.retriever = None
+        # ==========================================
+        # 7-2. LLMからの回答取得
+        # ==========================================
+        # 「st.spinner」でグルグル回っている間、表示の不具合が発生しないよう空のエリアを表示
+        res_box = st.empty()
+        # LLMによる回答生成（回答生成が完了するまでグルグル回す）
+        with st.spinner(ct.SPINNER_TEXT):
+            try:
+                # 初期化状態の確認
+                if not hasattr(st.session_state, 'retriever'):
+                    logger.warning("Retriever not initialized, attempting emergency initialization")
+                    # 緊急初期化を試行
+                    try:
+                        initialize()
+                    except Exception as init_error:
+                        logger.error(f"Emergency initialization failed: {init_error}")
+                        # 完全にフォールバックモードで動作
+                        st.session_state.retriever = None
             
-            # 画面読み込み時に作成したRetrieverを使い、Chainを実行
-            llm_response = utils.get_llm_response(chat_message)
+                # 画面読み込み時に作成したRetrieverを使い、Chainを実行
+                # （待っている間も空のエリアを更新し、新しいメッセージの送信・画面を閉じた場合に処理をキャンセルできるようにする）
+                llm_response = utils.get_llm_response(chat_message, on_wait=res_box.empty)
             
-            # 回答が正常に生成されたかチェック
-            if not llm_response or 'answer' not in llm_response:
-                raise Exception("Invalid response structure generated")
+                # 回答が正常に生成されたかチェック
+                if not llm_response or 'answer' not in llm_response:
+                    raise Exception("Invalid response structure generated")
                 
-        except Exception as e:
-            # エラーログの出力
-            logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
-            logger.error(f"Session state debug - retriever: {hasattr(st.session_state, 'retriever')}")
-            logger.error(f"Session state debug - mode: {getattr(st.session_state, 'mode', 'UNKNOWN')}")
+            except Exception as e:
+                # エラーログの出力
+                logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
+                logger.error(f"Session state debug - retriever: {hasattr(st.session_state, 'retriever')}")
+                logger.error(f"Session state debug - mode: {getattr(st.session_state, 'mode', 'UNKNOWN')}")
             
-            # エラーメッセージの画面表示
-            st.error(utils.build_error_message(ct.GET_LLM_RESPONSE_ERROR_MESSAGE), icon=ct.ERROR_ICON)
+                # エラーメッセージの画面表示
+                st.error(utils.build_error_message(ct.GET_LLM_RESPONSE_ERROR_MESSAGE), icon=ct.ERROR_ICON)
             
-            # 詳細エラー情報（デバッグ用）
-            with st.expander("詳細エラー情報（管理者向け）"):
-                st.code(f"""
+                # 詳細エラー情報（デバッグ用）
+                with st.expander("詳細エラー情報（管理者向け）"):
+                    st.code(f"""
 エラー詳細: {str(e)}
 初期化状態: {'✓' if hasattr(st.session_state, 'retriever') else '✗'}
 Retriever状態: {getattr(st.session_state, 'retriever', 'NOT_SET')}
 モード: {getattr(st.session_state, 'mode', 'UNKNOWN')}
 """)
             
-            # 後続の処理を中断
-            st.stop()
+                # 後続の処理を中断
+                st.stop()
     
-    # ==========================================
-    # 7-3. LLMからの回答表示
-    # ==========================================
-    with st.chat_message("assistant"):
-        try:
-            # ==========================================
-            # モードが「社内文書検索」の場合
-            # ==========================================
-            if st.session_state.mode == ct.ANSWER_MODE_1:
-                # 入力内容と関連性が高い社内文書のありかを表示
-                content = cn.display_search_llm_response(llm_response)
+        # ==========================================
+        # 7-3. LLMからの回答表示
+        # ==========================================
+        with st.chat_message("assistant"):
+            try:
+                # ==========================================
+                # モードが「社内文書検索」の場合
+                # ==========================================
+                if st.session_state.mode == ct.ANSWER_MODE_1:
+                    # 入力内容と関連性が高い社内文書のありかを表示
+                    content = cn.display_search_llm_response(llm_response)
 
-            # ==========================================
-            # モードが「社内問い合わせ」の場合
-            # ==========================================
-            elif st.session_state.mode == ct.ANSWER_MODE_2:
-                # 入力に対しての回答と、参照した文書のありかを表示
-                content = cn.display_contact_llm_response(llm_response)
+                # ==========================================
+                # モードが「社内問い合わせ」の場合
+                # ==========================================
+                elif st.session_state.mode == ct.ANSWER_MODE_2:
+                    # 入力に対しての回答と、参照した文書のありかを表示
+                    content = cn.display_contact_llm_response(llm_response)
             
-            # AIメッセージのログ出力
-            logger.info({"message": content, "application_mode": st.session_state.mode})
-        except Exception as e:
-            # エラーログの出力
-            logger.error(f"{ct.DISP_ANSWER_ERROR_MESSAGE}\n{e}")
-            # エラーメッセージの画面表示
-            st.error(utils.build_error_message(ct.DISP_ANSWER_ERROR_MESSAGE), icon=ct.ERROR_ICON)
-            # 後続の処理を中断
-            st.stop()
+                # AIメッセージのログ出力
+                logger.info({"message": content, "application_mode": st.session_state.mode})
+                # 検索クエリの埋め込みキャッシュの利用状況のログ出力
+                logger.info({"query_embedding_cache": embedding_cache.get_cache().stats()})
+                # LLMスケジューラーの利用状況（待ち行列の深さなど）のログ出力
+                logger.info({"llm_scheduler": llm_scheduler.get_scheduler().stats()})
+            except Exception as e:
+                # エラーログの出力
+                logger.error(f"{ct.DISP_ANSWER_ERROR_MESSAGE}\n{e}")
+                # エラーメッセージの画面表示
+                st.error(utils.build_error_message(ct.DISP_ANSWER_ERROR_MESSAGE), icon=ct.ERROR_ICON)
+                # 後続の処理を中断
+                st.stop()
 
-    # ==========================================
-    # 7-4. 会話ログへの追加
-    # ==========================================
-    # 表示用の会話ログにユーザーメッセージを追加
-    st.session_state.messages.append({"role": "user", "content": chat_message})
-    # 表示用の会話ログにAIメッセージを追加
-    st.session_state.messages.append({"role": "assistant", "content": content})
\ No newline at end of file
+        # ==========================================
+        # 7-4. 会話ログへの追加
+        # ==========================================
+        # 表示用の会話ログにユーザーメッセージとAIメッセージを追加
+        utils.add_display_messages([
+            {"role": "user", "content": chat_message},
+            {"role": "assistant", "content": content}
+        ])
\ No newline at end of file
@@ -0,0 +1,199 @@
+"""
+このファイルは、内容がほぼ同じドキュメント（同じ資料のPDF版とWord版など）を読み込み時に検出し、
+1つの代表ドキュメントにまとめる機能を定義したファイルです。
+MinHashで各ドキュメントの文字n-gramの集合を短い署名に要約し、LSH（署名を帯に分けたバケット）で
+候補の組だけを比較するため、ドキュメント数が増えても全組み合わせの比較は行いません。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+import numpy as np
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# 類似度の比較前に取り除く、複数ページを統合した際の区切り行
+SECTION_MARKER_PATTERN = re.compile(r"=== セクション \d+ ===")
+# MinHashのハッシュ関数を作る乱数のシード（同じドキュメントに常に同じ署名を割り当てる）
+MINHASH_SEED = 0
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_shingles(text, size=ct.NEAR_DUPLICATE_SHINGLE_SIZE):
+    """
+    類似度の計算に使う、文字n-gram（シングル）の集合の取得
+    （日本語は単語の区切りがないため文字単位とし、PDFの改行位置などの違いを無視するよう空白は除く）
+
+    Args:
+        text: ドキュメントの本文
+        size: 1つのシングルの文字数
+
+    Returns:
+        シングルのハッシュ値の配列（重複なし）
+    """
+    text = SECTION_MARKER_PATTERN.sub("", unicodedata.normalize("NFKC", text))
+    text = re.sub(r"\s+", "", text)
+    shingles = {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+    return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+def create_hash_parameters(num_perm=ct.NEAR_DUPLICATE_NUM_PERM, seed=MINHASH_SEED):
+    """
+    MinHashで使うハッシュ関数（乗算シフト法）の係数の作成
+
+    Args:
+        num_perm: ハッシュ関数の数（署名の長さ）
+        seed: 乱数のシード
+
+    Returns:
+        乗数（奇数）と加数の配列
+    """
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    return multipliers, increments
+
+
+def minhash_signature(shingles, hash_parameters, block_size=ct.NEAR_DUPLICATE_HASH_BLOCK_SIZE):
+    """
+    シングルの集合のMinHash署名の計算
+    （2つの署名で値が一致する位置の割合が、元の集合のJaccard係数の推定値になる）
+
+    Args:
+        shingles: シングルのハッシュ値の配列
+        hash_parameters: ハッシュ関数の係数
+        block_size: 一度にハッシュ値を計算するシングル数
+
+    Returns:
+        ハッシュ関数ごとの最小値の配列
+    """
+    multipliers, increments = hash_parameters
+    # シングル数×ハッシュ関数の数の行列を一度に作ると大きなファイルでメモリを使い切るため、
+    # 一定数のシングルごとに最小値を求め、それまでの最小値と比べて更新する
+    signature = np.full(len(multipliers), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(shingles), block_size):
+        block = shingles[start:start + block_size]
+        # 64ビットの桁あふれを利用した乗算シフト法で、上位32ビットをハッシュ値とする
+        with np.errstate(over="ignore"):
+            hashed = (block[:, None] * multipliers[None, :] + increments[None, :]) >> np.uint64(32)
+        np.minimum(signature, hashed.min(axis=0), out=signature)
+    return signature
+
+
+def find_candidate_pairs(signatures, bands=ct.NEAR_DUPLICATE_LSH_BANDS):
+    """
+    LSHによる、類似している可能性のあるドキュメントの組の列挙
+    （署名を帯に分け、いずれかの帯の値がすべて一致する組のみを候補とする）
+
+    Args:
+        signatures: ドキュメントごとの署名の行列
+        bands: 帯の数
+
+    Returns:
+        候補の組（行番号の小さい順）の集合
+    """
+    rows = signatures.shape[1] // bands
+    candidates = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for index, signature in enumerate(signatures):
+            buckets[signature[band * rows:(band + 1) * rows].tobytes()].append(index)
+        for members in buckets.values():
+            for position, first in enumerate(members):
+                for second in members[position + 1:]:
+                    candidates.add((first, second))
+    return candidates
+
+
+def get_scope_key(metadata):
+    """
+    同じ検索範囲に属するかどうかの判定に使うキーの取得
+    （顧客などが異なるドキュメントをまとめると、検索範囲を絞り込んだ際に内容が見つからなくなるため、ファイル形式以外の項目が一致する場合のみまとめる）
+
+    Args:
+        metadata: ドキュメントのメタデータ
+
+    Returns:
+        検索範囲のメタデータの組
+    """
+    return tuple(metadata.get(key) for key in ct.SEARCH_SCOPE_KEYS if key != "file_type")
+
+
+def get_canonical_rank(doc):
+    """
+    重複するドキュメントのうち、代表として残すドキュメントの優先順位の取得
+    （ページ番号を表示できるPDFなど、優先する拡張子の順。同じ場合は本文が長い方）
+
+    Args:
+        doc: ドキュメント
+
+    Returns:
+        並べ替え用のキー（小さいほど優先）
+    """
+    extension = os.path.splitext(doc.metadata.get("source", ""))[1].lower()
+    if extension in ct.NEAR_DUPLICATE_PREFERRED_EXTENSIONS:
+        extension_rank = ct.NEAR_DUPLICATE_PREFERRED_EXTENSIONS.index(extension)
+    else:
+        extension_rank = len(ct.NEAR_DUPLICATE_PREFERRED_EXTENSIONS)
+    return extension_rank, -len(doc.page_content)
+
+
+def remove_near_duplicates(docs, threshold=ct.NEAR_DUPLICATE_THRESHOLD):
+    """
+    内容がほぼ同じドキュメントを1つの代表ドキュメントにまとめる
+    （まとめたドキュメントのファイルパスは、代表ドキュメントのメタデータ「alternate_sources」に記録）
+
+    Args:
+        docs: ドキュメントのリスト
+        threshold: 同じ内容とみなすJaccard係数（推定値）の下限
+
+    Returns:
+        代表ドキュメントのリスト（元の並び順を維持）と、まとめたドキュメント数
+    """
+    if len(docs) < 2:
+        return docs, 0
+
+    hash_parameters = create_hash_parameters()
+    signatures = np.stack([minhash_signature(get_shingles(doc.page_content), hash_parameters) for doc in docs])
+
+    # 候補の組のうち、同じ検索範囲で署名の一致率がしきい値以上の組を、同じグループとしてつなぐ（Union-Find）
+    parents = list(range(len(docs)))
+
+    def find_root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for first, second in find_candidate_pairs(signatures):
+        if get_scope_key(docs[first].metadata) != get_scope_key(docs[second].metadata):
+            continue
+        if np.mean(signatures[first] == signatures[second]) >= threshold:
+            parents[find_root(second)] = find_root(first)
+
+    groups = defaultdict(list)
+    for index in range(len(docs)):
+        groups[find_root(index)].append(index)
+
+    # グループごとに代表ドキュメントを選び、それ以外のドキュメントのファイルパスを記録
+    canonical_indices = set()
+    for members in groups.values():
+        canonical = min(members, key=lambda index: get_canonical_rank(docs[index]))
+        canonical_indices.add(canonical)
+        alternates = [docs[index].metadata.get("source") for index in members if index != canonical]
+        if alternates:
+            docs[canonical].metadata["alternate_sources"] = alternates
+
+    kept_docs = [doc for index, doc in enumerate(docs) if index in canonical_indices]
+    return kept_docs, len(docs) - len(kept_docs)
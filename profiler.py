@@ -0,0 +1,202 @@
+"""
+このファイルは、チャット送信1回分の処理をプロファイリングし、結果をログフォルダに出力する機能を定義したファイルです。
+検索・回答生成は共有のイベントループのスレッドで実行されるため（cProfileの計測はスレッドごと）、
+スクリプトのスレッドの処理と、イベントループのスレッドでのそのリクエストの処理を別々に計測し、まとめて出力します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import contextvars
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import streamlit as st
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# 実行中のリクエストの、イベントループのスレッドでの処理を計測するプロファイラー（プロファイリングが無効の場合はNone）
+_loop_profile_var = contextvars.ContextVar("loop_profile", default=None)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def is_profiling_enabled():
+    """
+    プロファイリングを有効にするかどうかの判定
+    - 環境変数「PROFILE_REQUESTS」が「true」の場合、全リクエストを対象とする
+    - URLのクエリパラメータ「profile」に管理者用トークンが指定された場合、そのセッションのリクエストを対象とする
+
+    Returns:
+        プロファイリングを有効にする場合はTrue
+    """
+    if os.getenv(ct.PROFILE_ENV_VAR, "false").lower() == "true":
+        return True
+
+    # 管理者用トークンが設定されていない環境では、クエリパラメータによる有効化を受け付けない
+    admin_token = os.getenv(ct.PROFILE_ADMIN_TOKEN_ENV_VAR)
+    if not admin_token:
+        return False
+
+    requested_token = st.query_params.get(ct.PROFILE_QUERY_PARAM)
+    if not requested_token:
+        return False
+
+    # トークンの比較は、処理時間から値を推測されないよう定数時間で行う
+    return hmac.compare_digest(requested_token, admin_token)
+
+
+@contextmanager
+def profile_request(session_id, request_id, enabled):
+    """
+    withブロック内の処理をプロファイリングし、結果をファイルに出力する
+    （無効時は何もしないため、通常のリクエストへの影響はない）
+
+    Args:
+        session_id: セッションID
+        request_id: リクエストID
+        enabled: プロファイリングを有効にするかどうか
+    """
+    if not enabled:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    # イベントループのスレッドで実行する処理は、「profile_coroutine」で包んだコルーチンの実行中のみ計測する
+    loop_profile = cProfile.Profile()
+    token = _loop_profile_var.set(loop_profile)
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        # 「st.stop()」などで処理が中断された場合も、そこまでの結果を出力する
+        profile.disable()
+        _loop_profile_var.reset(token)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        write_profile(profile, session_id, request_id, elapsed_ms, loop_profile)
+
+
+def profile_coroutine(coroutine):
+    """
+    共有のイベントループで実行するコルーチンを、実行中のリクエストのプロファイリングの対象にする
+    （「profile_request」のブロック内で、呼び出し元のスレッドから呼び出す。プロファイリングが無効の場合はそのまま返す）
+
+    Args:
+        coroutine: 実行するコルーチン
+
+    Returns:
+        コルーチン
+    """
+    loop_profile = _loop_profile_var.get()
+    if loop_profile is None:
+        return coroutine
+    return _ProfiledCoroutine(coroutine, loop_profile).run()
+
+
+def write_profile(profile, session_id, request_id, elapsed_ms, loop_profile=None):
+    """
+    プロファイリング結果（pstats形式）と、処理時間の長い関数の上位一覧をファイルに出力
+
+    Args:
+        profile: 計測済みのプロファイラー（スクリプトのスレッド）
+        session_id: セッションID
+        request_id: リクエストID
+        elapsed_ms: 計測対象の処理時間（ミリ秒）
+        loop_profile: 計測済みのプロファイラー（イベントループのスレッドでの、このリクエストの処理）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    try:
+        os.makedirs(ct.PROFILE_DIR_PATH, exist_ok=True)
+
+        # ファイル名に日時・セッションID・リクエストIDを含め、ログと突き合わせられるようにする
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        base_name = f"{timestamp}_{session_id}_{request_id}"
+        profile_path = os.path.join(ct.PROFILE_DIR_PATH, f"{base_name}.prof")
+        summary_path = os.path.join(ct.PROFILE_DIR_PATH, f"{base_name}.txt")
+
+        # 両スレッドの計測結果をまとめ、「snakeviz」や「python -m pstats」で開ける形式で保存
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        if loop_profile is not None and loop_profile.getstats():
+            stats.add(loop_profile)
+        stats.dump_stats(profile_path)
+
+        # 累積時間の長い関数の上位N件を、テキストで保存
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(ct.PROFILE_TOP_N)
+        with open(summary_path, "w", encoding="utf8") as f:
+            f.write(f"session_id={session_id} request_id={request_id} elapsed_ms={elapsed_ms:.1f}\n")
+            f.write("threads=script+event_loop (event loop: only this request's steps; time spent awaiting I/O is not included)\n")
+            f.write(stream.getvalue())
+
+        logger.info({
+            "message": "Request profiled",
+            "elapsed_ms": round(elapsed_ms, 1),
+            "profile_path": profile_path,
+            "summary_path": summary_path,
+        })
+    except Exception as e:
+        # プロファイリング結果の出力失敗で、ユーザーへの回答表示を妨げない
+        logger.error(f"Failed to write profile: {e}")
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _ProfiledCoroutine:
+    """
+    コルーチンを1ステップずつ進め、そのステップの実行中のみプロファイラーを有効にする仕組み
+    （共有のイベントループでは他のセッションの処理も交互に実行されるため、このリクエストの処理のみを計測する）
+    """
+
+    def __init__(self, coroutine, profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    async def run(self):
+        return await self
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            enabled = self._enable()
+            try:
+                if error is not None:
+                    future = self.coroutine.throw(error)
+                else:
+                    future = self.coroutine.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if enabled:
+                    self.profile.disable()
+            # 待機対象をイベントループに渡し、再開時の値・例外（キャンセルなど）をコルーチンに引き渡す
+            try:
+                value, error = (yield future), None
+            except GeneratorExit:
+                self.coroutine.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+    def _enable(self):
+        # 他のプロファイラーが同じスレッドで有効な場合などは、計測せずに処理を続ける
+        try:
+            self.profile.enable()
+            return True
+        except ValueError as e:
+            logging.getLogger(ct.LOGGER_NAME).warning({"profiler": f"Event loop profiling skipped: {e}"})
+            return False
@@ -0,0 +1,139 @@
+"""
+このファイルは、埋め込みベクトルを量子化（int8 または float16）して保持し、メモリ使用量を抑えるベクターストアを定義したファイルです。
+- 量子化した行列で全件の類似度を近似計算し、上位候補のみ元のfloat32のベクトルで再計算する
+- 量子化した行列・元の行列はファイルに書き出してメモリマップで開くため、同じデータを読み込んだ複数のプロセスで
+  物理メモリ上の1つのコピーを共有できる（元の行列は再計算する候補の行しか読み込まれない）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hashlib
+import os
+from uuid import uuid4
+import numpy as np
+import constants as ct
+from vector_index import NumpyVectorStore, top_k_indices
+
+
+############################################################
+# 変数定義
+############################################################
+# 量子化の種類ごとの保存形式
+QUANTIZED_DTYPES = {"int8": np.int8, "float16": np.float16}
+# int8の量子化で使う値の範囲（-127〜127、-128は使わず0を中心に対称にする）
+INT8_MAX = 127
+# 類似度の近似計算で、float32に変換して計算する1回あたりの行数
+# （変換後の一時配列がCPUキャッシュに収まる大きさにすると、float32の行列で計算するより速くなる）
+SCORE_BATCH_SIZE = 1024
+
+
+############################################################
+# 関数定義
+############################################################
+
+def quantize(matrix, dtype):
+    """
+    行列の量子化
+
+    Args:
+        matrix: 正規化済みのベクトルの行列（float32）
+        dtype: 量子化の種類（「int8」または「float16」）
+
+    Returns:
+        量子化した行列と、次元ごとの倍率（float16の場合はNone）
+    """
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+
+    # 次元ごとに、絶対値の最大値が127になる倍率で整数に丸める
+    scale = np.abs(matrix).max(axis=0) / INT8_MAX
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.rint(matrix / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+
+def save_and_map(path, array):
+    """
+    配列を「.npy」ファイルに書き出し、読み取り専用のメモリマップで開く
+    （同じ内容のファイルが既にある場合は書き出さずに開く）
+
+    Args:
+        path: ファイルパス
+        array: 書き出す配列
+
+    Returns:
+        メモリマップで開いた配列
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 他のプロセスが書き込み途中のファイルを開かないよう、一時ファイルに書き出してから置き換える
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+############################################################
+# クラス定義
+############################################################
+
+class QuantizedVectorStore(NumpyVectorStore):
+    """
+    量子化した行列で検索し、上位候補のみ元のベクトルで類似度を再計算するベクターストア
+    """
+
+    def __init__(self, embedding, dtype=ct.QUANTIZED_DTYPE, rerank_factor=ct.QUANTIZED_RERANK_FACTOR,
+                 storage_dir=ct.QUANTIZED_VECTOR_DIR_PATH):
+        """
+        Args:
+            embedding: 埋め込みモデル
+            dtype: 量子化の種類（「int8」または「float16」）
+            rerank_factor: 元のベクトルで再計算する候補数（k の何倍か）
+            storage_dir: 行列のファイルの保存先フォルダ
+        """
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError(f"Unsupported quantization dtype: {dtype}")
+        super().__init__(embedding)
+        self.dtype = dtype
+        self.rerank_factor = rerank_factor
+        self.storage_dir = storage_dir
+        self._quantized = np.zeros((0, 0), dtype=QUANTIZED_DTYPES[dtype])
+        self._scale = None
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        super().add_vectors(vectors, texts, metadatas, ids)
+
+        # 行列の内容から求めたファイル名で保存するため、同じデータを読み込んだプロセス同士は同じファイルを共有する
+        matrix = np.ascontiguousarray(self._matrix, dtype=np.float32)
+        digest = hashlib.blake2b(matrix.tobytes(), digest_size=16).hexdigest()
+        quantized, self._scale = quantize(matrix, self.dtype)
+
+        self._quantized = save_and_map(os.path.join(self.storage_dir, f"{digest}.{self.dtype}.npy"), quantized)
+        self._matrix = save_and_map(os.path.join(self.storage_dir, f"{digest}.float32.npy"), matrix)
+
+    def memory_usage(self):
+        usage = super().memory_usage()
+        # 元の行列はメモリマップで、再計算する候補の行のみ読み込まれる
+        usage["rescoring_vectors_mapped"] = usage.pop("vectors")
+        usage["vectors"] = int(self._quantized.nbytes + (self._scale.nbytes if self._scale is not None else 0))
+        return usage
+
+    def _search(self, query_vector, k, candidates):
+        # 量子化した行列で類似度を近似計算（int8の場合、次元ごとの倍率は検索ベクトル側に掛けておく）
+        weights = query_vector * self._scale if self._scale is not None else query_vector
+        row_count = len(self._quantized) if candidates is None else len(candidates)
+        approximate_scores = np.empty(row_count, dtype=np.float32)
+        for start in range(0, row_count, SCORE_BATCH_SIZE):
+            rows = slice(start, start + SCORE_BATCH_SIZE)
+            block = self._quantized[rows] if candidates is None else self._quantized[candidates[rows]]
+            approximate_scores[rows] = block.astype(np.float32) @ weights
+
+        # 近似スコアの上位候補のみ、元のベクトルで類似度を再計算して並べ替え
+        shortlist = top_k_indices(approximate_scores, k * self.rerank_factor)
+        if candidates is not None:
+            shortlist = candidates[shortlist]
+        exact_scores = self._matrix[shortlist] @ query_vector
+        top = top_k_indices(exact_scores, k)
+        return shortlist[top], exact_scores[top]
@@ -0,0 +1,180 @@
+"""
+このファイルは、複数のセッションから同時に届いた同じ質問を1回の検索・回答生成にまとめる機能（シングルフライト）を定義したファイルです。
+同じキー（モード・言い換え後の質問・インデックスのバージョン・回答生成に渡す入力内容と会話ログ）の処理が実行中の場合、後から来たリクエストは
+新たに実行せずに実行中の処理の完了を待ち、同じ結果を受け取ります（会話履歴への追加は各セッションで行う）。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import hashlib
+import threading
+import embedding_cache
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するシングルフライト（全セッションで1つを使い回す）
+_group = None
+_group_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_group():
+    """
+    プロセス内で共有するシングルフライトの取得（未作成の場合は作成）
+
+    Returns:
+        シングルフライト
+    """
+    global _group
+    with _group_lock:
+        if _group is None:
+            _group = SingleFlight()
+        return _group
+
+
+def compute_index_version(docs, *settings):
+    """
+    インデックスのバージョンの計算
+    （検索対象のドキュメントと検索の設定が同じであれば、セッションが異なっても同じ値になる）
+
+    Args:
+        docs: インデックスに登録したドキュメントのリスト
+        settings: 検索結果に影響する設定（埋め込みモデル名・ベクターストアの種類など）
+
+    Returns:
+        バージョン（16進数の文字列）
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for setting in settings:
+        digest.update(f"{setting}\0".encode("utf-8"))
+    for doc in docs:
+        digest.update(f"{doc.metadata.get('source', '')}\0{doc.page_content}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_request_key(mode, standalone_question, index_version, search_filter=None, chat_message=None,
+                      chat_history=None):
+    """
+    同じリクエストとみなすためのキーの作成
+    （検索範囲が異なると検索結果も異なるため、絞り込み条件もキーに含める）
+    （回答生成には入力内容と会話ログも渡すため、それらのダイジェストもキーに含め、
+      他のセッションの会話に基づく回答を受け取らないようにする）
+
+    Args:
+        mode: 利用目的のモード
+        standalone_question: 会話履歴なしで意味が通るよう言い換えた質問
+        index_version: インデックスのバージョン
+        search_filter: 検索範囲の絞り込み条件
+        chat_message: 回答生成に渡す入力内容
+        chat_history: 回答生成に渡す会話ログ
+
+    Returns:
+        キー
+    """
+    filter_key = repr(sorted(search_filter.items())) if search_filter else None
+    return (
+        mode, embedding_cache.normalize_query(standalone_question), index_version, filter_key,
+        compute_conversation_digest(chat_message, chat_history),
+    )
+
+
+def compute_conversation_digest(chat_message, chat_history):
+    """
+    回答生成に渡す入力内容と会話ログのダイジェストの計算
+    （入力内容は、言い換え後の質問と同じく表記の揺れを吸収してから計算する）
+
+    Args:
+        chat_message: 入力内容
+        chat_history: 会話ログ
+
+    Returns:
+        ダイジェスト（16進数の文字列）
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{embedding_cache.normalize_query(chat_message or '')}\0".encode("utf-8"))
+    for message in chat_history or []:
+        digest.update(f"{message.type}\0{message.content}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class SingleFlight:
+    """
+    同じキーの処理を同時に1件だけ実行し、実行中に届いた同じキーのリクエストには同じ結果を返す仕組み
+    （完了した結果は保持しないため、古い回答を返し続けることはない）
+    """
+
+    def __init__(self):
+        # キーごとの実行中のタスクと、その結果を待っているリクエスト数
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    async def ado(self, key, func):
+        """
+        キーごとに1回だけ処理を実行し、結果を取得（同じイベントループ上のリクエスト同士で、1つのタスクの結果を共有する）
+        - 結果を待っているリクエストがすべてキャンセルされた場合のみ、実行中のタスクもキャンセルする
+
+        Args:
+            key: 同じ処理とみなすためのキー
+            func: 処理を実行するコルーチンを返す関数
+
+        Returns:
+            処理の結果と、他のリクエストの処理結果を受け取ったかどうかの組
+        """
+        with self._lock:
+            entry = self._tasks.get(key)
+            if entry is None:
+                entry = [asyncio.ensure_future(func()), 0]
+                self._tasks[key] = entry
+                entry[0].add_done_callback(lambda _: self._discard_task(key, entry))
+                self.executed += 1
+                shared = False
+            else:
+                self.shared += 1
+                shared = True
+            entry[1] += 1
+
+        task = entry[0]
+        try:
+            # 1つのリクエストがキャンセルされても、他のリクエストが待っているタスクは止めない
+            return await asyncio.shield(task), shared
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                abandoned = entry[1] == 0 and not task.done()
+            if abandoned:
+                task.cancel()
+
+    def _discard_task(self, key, entry):
+        """
+        完了したタスクの削除（完了後に届いたリクエストは新たに実行する）
+
+        Args:
+            key: 同じ処理とみなすためのキー
+            entry: 完了したタスクの情報
+        """
+        with self._lock:
+            if self._tasks.get(key) is entry:
+                del self._tasks[key]
+
+    def stats(self):
+        """
+        シングルフライトの利用状況の取得
+
+        Returns:
+            実行数・結果を共有した数・実行中の数の辞書
+        """
+        with self._lock:
+            return {"executed": self.executed, "shared": self.shared, "in_flight": len(self._tasks)}
@@ -0,0 +1,155 @@
+"""
+このファイルは、データソースのフォルダ構成から求めたメタデータ（カテゴリ・顧客名・顧客区分・ファイル形式）を使い、
+検索範囲を絞り込むための機能を定義したファイルです。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def extract_path_metadata(source):
+    """
+    データソースのパスから、検索範囲の絞り込みに使うメタデータを取得
+    - 例: 「./data/MTG議事録/顧客/既存/<会社名>/<ファイル名>」→ カテゴリ「MTG議事録」、顧客区分「既存」、顧客「<会社名>」
+
+    Args:
+        source: データソースのファイルパス、またはURL
+
+    Returns:
+        メタデータの辞書（該当しない項目は含めない）
+    """
+    if source.startswith(("http://", "https://")):
+        return {"category": ct.WEB_PAGE_CATEGORY, "file_type": "html"}
+
+    metadata = {"file_type": os.path.splitext(source)[1].lstrip(".").lower()}
+    parts = os.path.normpath(os.path.relpath(source, ct.RAG_TOP_FOLDER_PATH)).split(os.sep)
+    folders = parts[:-1]
+
+    if folders:
+        metadata["category"] = folders[0]
+    # 顧客フォルダ配下は「顧客区分（既存・見込み）/会社名」のフォルダ構成
+    if ct.CUSTOMER_FOLDER_NAME in folders:
+        position = folders.index(ct.CUSTOMER_FOLDER_NAME)
+        if position + 1 < len(folders):
+            metadata["customer_status"] = folders[position + 1]
+        if position + 2 < len(folders):
+            metadata["customer"] = folders[position + 2]
+
+    return metadata
+
+
+def add_path_metadata(docs):
+    """
+    各ドキュメントのメタデータに、パスから求めた検索範囲用のメタデータを追加
+
+    Args:
+        docs: ドキュメントのリスト
+    """
+    for doc in docs:
+        doc.metadata.update(extract_path_metadata(doc.metadata.get("source", "")))
+
+
+def collect_search_scopes(docs):
+    """
+    サイドバーの検索範囲の選択肢と、それぞれの絞り込み条件を取得
+
+    Args:
+        docs: ドキュメントのリスト
+
+    Returns:
+        「選択肢の表示名: 絞り込み条件」の辞書（項目ごとに、値の昇順）
+    """
+    scopes = {}
+    for key, label in ct.SEARCH_SCOPE_KEYS.items():
+        values = sorted({doc.metadata[key] for doc in docs if doc.metadata.get(key)})
+        for value in values:
+            scopes[f"{label}：{value}"] = {key: value}
+    return scopes
+
+
+def detect_customer_filter(chat_message, customers):
+    """
+    入力内容に含まれる顧客名から、絞り込み条件を作成
+    （「株式会社」などを除いた社名のみで言及された場合も検出する）
+
+    Args:
+        chat_message: ユーザー入力値
+        customers: 顧客名のリスト
+
+    Returns:
+        絞り込み条件（顧客名が含まれない場合はNone）
+    """
+    detected = []
+    for customer in customers:
+        core_name = customer
+        for suffix in ct.COMPANY_NAME_SUFFIXES:
+            core_name = core_name.replace(suffix, "")
+        if core_name and core_name in chat_message:
+            detected.append(customer)
+
+    if not detected:
+        return None
+    if len(detected) == 1:
+        return {"customer": detected[0]}
+    return {"customer": {"$in": detected}}
+
+
+def resolve_search_filter(scopes, scope, chat_message):
+    """
+    選択された検索範囲から絞り込み条件を取得
+    （検索範囲が未選択の場合は、入力内容に含まれる顧客名から検出）
+
+    Args:
+        scopes: 「検索範囲の名前: 絞り込み条件」の辞書
+        scope: 選択された検索範囲の名前（未選択の場合はNoneまたは「すべての文書」）
+        chat_message: ユーザー入力値
+
+    Returns:
+        絞り込み条件（絞り込まない場合はNone）
+    """
+    if scope and scope != ct.SEARCH_SCOPE_ALL:
+        if scope not in scopes:
+            raise ValueError(f"Unknown search scope: {scope}")
+        return scopes[scope]
+    if ct.AUTO_DETECT_CUSTOMER_SCOPE:
+        customers = [scope_filter["customer"] for scope_filter in scopes.values() if "customer" in scope_filter]
+        return detect_customer_filter(chat_message, customers)
+    return None
+
+
+def matches_filter(metadata, search_filter):
+    """
+    メタデータが絞り込み条件に合うかどうかの判定（ベクターストアを使わない検索用）
+    - 「{"項目": 値}」「{"項目": {"$eq" / "$in": 値}}」「{"$and": [条件, ...]}」に対応
+
+    Args:
+        metadata: ドキュメントのメタデータ
+        search_filter: 絞り込み条件
+
+    Returns:
+        条件に合う場合はTrue
+    """
+    for key, condition in search_filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+            continue
+
+        operator, value = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+        if operator == "$eq":
+            matched = key in metadata and metadata[key] == value
+        elif operator == "$in":
+            matched = key in metadata and metadata[key] in value
+        else:
+            raise ValueError(f"Unsupported filter operator: {operator}")
+        if not matched:
+            return False
+
+    return True
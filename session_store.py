@@ -0,0 +1,297 @@
+"""
+このファイルは、セッションごとの会話ログをローカルのSQLiteデータベースに保存する機能を定義したファイルです。
+直近の会話のみをメモリ（st.session_state）に保持し、それより前の会話は必要な時にデータベースから読み込みます。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hashlib
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from langchain_core.messages import HumanMessage, AIMessage
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有するストア（全セッションで1つの接続を使い回す）
+_store = None
+_store_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_store():
+    """
+    プロセス内で共有するセッションストアの取得（未作成の場合は作成）
+
+    Returns:
+        セッションストア
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore(
+                os.path.join(ct.SESSION_STORE_DIR_PATH, ct.SESSION_STORE_FILE),
+                ttl_seconds=ct.SESSION_TTL_SECONDS
+            )
+        return _store
+
+
+############################################################
+# クラス定義
+############################################################
+
+class SessionStore:
+    """
+    会話ログ（表示用・LLMとのやりとり用）をセッション単位で保存するストア
+    """
+
+    # LLMとのやりとり用の会話ログを保存・復元する際の、メッセージ種別とクラスの対応
+    CHAT_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage}
+
+    def __init__(self, db_path, ttl_seconds):
+        """
+        Args:
+            db_path: SQLiteデータベースファイルのパス
+            ttl_seconds: 最終アクセスからこの秒数が経過したセッションを削除対象とする
+        """
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Streamlitは複数スレッドからスクリプトを実行するため、スレッド間で接続を共有する（排他はロックで行う）
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL,
+                resume_token_hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS chat_history (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions (last_access);
+        """)
+        # 再開用トークンの列がない、以前の形式のデータベースには列を追加（既存のセッションはトークンがなく再開できない）
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")]
+        if "resume_token_hash" not in columns:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN resume_token_hash TEXT")
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_resume_token_hash ON sessions (resume_token_hash)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _hash_resume_token(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def issue_resume_token(self, session_id):
+        """
+        会話を再開するためのトークンの発行（以前に発行したトークンは無効になる）
+        （データベースにはハッシュ値のみを保存し、トークン自体はURLにのみ保持する）
+
+        Args:
+            session_id: セッションID
+
+        Returns:
+            再開用トークン
+        """
+        token = secrets.token_urlsafe(ct.SESSION_RESUME_TOKEN_BYTES)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, last_access, resume_token_hash) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET "
+                "last_access = excluded.last_access, resume_token_hash = excluded.resume_token_hash",
+                (session_id, time.time(), self._hash_resume_token(token))
+            )
+            self._conn.commit()
+        return token
+
+    def find_session_by_resume_token(self, token):
+        """
+        再開用トークンに対応するセッションIDの取得
+
+        Args:
+            token: 再開用トークン
+
+        Returns:
+            セッションID（対応するセッションがない場合はNone）
+        """
+        if not token:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE resume_token_hash = ?", (self._hash_resume_token(token),)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def has_session(self, session_id):
+        """
+        セッションが保存されているかどうかの確認
+
+        Args:
+            session_id: セッションID
+
+        Returns:
+            保存されている場合はTrue
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def append_messages(self, session_id, messages):
+        """
+        表示用の会話ログの追加
+
+        Args:
+            session_id: セッションID
+            messages: 追加する会話ログ（「role」と「content」を持つ辞書）のリスト
+        """
+        self._append(session_id, "messages", "role", [
+            (message["role"], json.dumps(message["content"], ensure_ascii=False)) for message in messages
+        ])
+
+    def append_chat_history(self, session_id, chat_messages):
+        """
+        LLMとのやりとり用の会話ログの追加
+
+        Args:
+            session_id: セッションID
+            chat_messages: 追加するLangChainのメッセージのリスト
+        """
+        self._append(session_id, "chat_history", "type", [
+            (message.type, message.content) for message in chat_messages
+        ])
+
+    def count_messages(self, session_id):
+        """
+        表示用の会話ログの件数を取得
+
+        Args:
+            session_id: セッションID
+
+        Returns:
+            会話ログの件数
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0]
+
+    def load_messages(self, session_id, offset, limit):
+        """
+        表示用の会話ログを、古い順の位置を指定して読み込み
+
+        Args:
+            session_id: セッションID
+            offset: 読み込み開始位置（最も古い会話が0）
+            limit: 読み込む件数
+
+        Returns:
+            会話ログ（「role」と「content」を持つ辞書）のリスト
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+                (session_id, limit, offset)
+            ).fetchall()
+        return [{"role": role, "content": json.loads(content)} for role, content in rows]
+
+    def load_chat_history(self, session_id, limit):
+        """
+        LLMとのやりとり用の会話ログのうち、直近のものを読み込み
+
+        Args:
+            session_id: セッションID
+            limit: 読み込む件数
+
+        Returns:
+            LangChainのメッセージのリスト（古い順）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT type, content FROM chat_history WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+        return [self.CHAT_MESSAGE_TYPES[message_type](content=content) for message_type, content in reversed(rows)]
+
+    def cleanup_expired(self, force=False):
+        """
+        最終アクセスから一定時間が経過したセッションのデータを削除
+        （頻繁に実行しないよう、前回の実行から一定時間が経過している場合のみ実行）
+
+        Args:
+            force: 前回の実行からの経過時間に関わらず実行するかどうか
+
+        Returns:
+            削除したセッション数
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_cleanup < ct.SESSION_CLEANUP_INTERVAL_SECONDS:
+                return 0
+            self._last_cleanup = now
+
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE last_access < ?", (now - self.ttl_seconds,)
+            )]
+            for table in ("messages", "chat_history", "sessions"):
+                self._conn.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(s,) for s in expired])
+            self._conn.commit()
+
+        if expired:
+            logging.getLogger(ct.LOGGER_NAME).info(f"Removed {len(expired)} expired sessions from session store")
+        return len(expired)
+
+    def _append(self, session_id, table, kind_column, rows):
+        """
+        会話ログの追加（連番を採番し、セッションの最終アクセス日時も更新）
+
+        Args:
+            session_id: セッションID
+            table: 追加先のテーブル名
+            kind_column: メッセージの種別を格納する列名
+            rows: （種別, 内容）のリスト
+        """
+        with self._lock:
+            try:
+                next_seq = self._conn.execute(
+                    f"SELECT COALESCE(MAX(seq), -1) + 1 FROM {table} WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                self._conn.executemany(
+                    f"INSERT INTO {table} (session_id, seq, {kind_column}, content) VALUES (?, ?, ?, ?)",
+                    [(session_id, next_seq + i, kind, content) for i, (kind, content) in enumerate(rows)]
+                )
+                self._conn.execute(
+                    "INSERT INTO sessions (session_id, last_access) VALUES (?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET last_access = excluded.last_access",
+                    (session_id, time.time())
+                )
+                self._conn.commit()
+            except Exception:
+                # 途中まで追加した行が、次回の追加時にまとめて確定されないよう取り消す（呼び出し元で再保存する）
+                self._conn.rollback()
+                raise
@@ -0,0 +1,272 @@
+"""
+このファイルは、LLMの消費トークン数と料金を、リクエストごと・セッションごとに集計する機能を定義したファイルです。
+- リクエストごとに、処理段階（質問の言い換え・回答生成）ごとの入力・出力トークン数を記録する
+- 回答生成の入力のうち、検索結果（コンテキスト）と会話履歴が占めるトークン数の見積もりを記録する
+- 他のセッションの処理結果を受け取った場合は、回答生成で消費しなかったトークン数を節約分として記録する
+- セッションごと・モードごと・プロセス全体の累計を保持し、管理者向けの集計として返す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hmac
+import math
+import os
+import threading
+from collections import OrderedDict
+from langchain_core.callbacks import BaseCallbackHandler
+import constants as ct
+
+
+############################################################
+# 変数定義
+############################################################
+# プロセス内で共有する集計（画面・HTTP API・一括実行のリクエストを1か所で集計する）
+_tracker = None
+_tracker_lock = threading.Lock()
+# リクエストごとの利用量から累計する項目（LLMの呼び出し回数とトークン数）
+COUNTER_KEYS = (
+    "llm_calls", "prompt_tokens", "completion_tokens", "total_tokens",
+    "context_tokens", "history_tokens", "saved_tokens",
+)
+# 処理段階（LLMを呼び出すもの）
+STAGES = ("rewrite", "answer")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_tracker():
+    """
+    プロセス内で共有する利用量の集計の取得（未作成の場合は作成）
+
+    Returns:
+        利用量の集計
+    """
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = UsageTracker(max_sessions=ct.USAGE_MAX_TRACKED_SESSIONS)
+        return _tracker
+
+
+def estimate_text_tokens(texts):
+    """
+    テキストのトークン数の見積もり（LLMスケジューラーの見積もりと同じく、文字数から換算）
+
+    Args:
+        texts: テキストのリスト
+
+    Returns:
+        見積もったトークン数
+    """
+    return math.ceil(sum(len(str(text)) for text in texts) / ct.LLM_CHARS_PER_TOKEN)
+
+
+def get_cost_usd(prompt_tokens, completion_tokens, model=ct.MODEL):
+    """
+    消費トークン数から料金を算出（料金が未設定のモデルの場合はNone）
+
+    Args:
+        prompt_tokens: 入力トークン数
+        completion_tokens: 出力トークン数
+        model: モデル名
+
+    Returns:
+        料金（米ドル）
+    """
+    prices = ct.LLM_PRICES_PER_MILLION_TOKENS.get(model)
+    if prices is None:
+        return None
+    return round((prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1_000_000, 6)
+
+
+def build_request_usage(stage_usages, docs=None, chat_history=None, saved_usage=None, model=ct.MODEL):
+    """
+    1リクエスト分の利用量の作成
+
+    Args:
+        stage_usages: 処理段階ごとの消費トークン数を集計したコールバックの辞書
+        docs: 回答生成に渡した検索結果のドキュメントのリスト
+        chat_history: 回答生成に渡した会話ログ
+        saved_usage: 他のセッションの処理結果を受け取った場合の、その処理の回答生成での消費トークン数
+        model: モデル名
+
+    Returns:
+        処理段階ごとと合計の消費トークン数・コンテキストと会話履歴のトークン数・節約分・料金の辞書
+    """
+    stages = {stage: callback.totals() for stage, callback in stage_usages.items()}
+    prompt_tokens = sum(stage["prompt_tokens"] for stage in stages.values())
+    completion_tokens = sum(stage["completion_tokens"] for stage in stages.values())
+    saved_usage = saved_usage or {}
+    if saved_usage:
+        # 他のセッションの処理結果を受け取った場合は、このリクエストでは回答生成にコンテキスト・会話履歴を渡していない
+        docs, chat_history = None, None
+    return {
+        "model": model,
+        "stages": stages,
+        "llm_calls": sum(stage["llm_calls"] for stage in stages.values()),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        # 回答生成の入力のうち、検索結果・会話履歴が占めるトークン数（文字数からの見積もり）
+        "context_tokens": estimate_text_tokens(doc.page_content for doc in docs or []),
+        "history_tokens": estimate_text_tokens(message.content for message in chat_history or []),
+        "coalesced": bool(saved_usage),
+        "saved_tokens": saved_usage.get("total_tokens", 0),
+        "cost_usd": get_cost_usd(prompt_tokens, completion_tokens, model),
+        "saved_cost_usd": get_cost_usd(
+            saved_usage.get("prompt_tokens", 0), saved_usage.get("completion_tokens", 0), model
+        ),
+    }
+
+
+def is_admin_token(token):
+    """
+    管理者用トークンの確認（管理者用トークンが設定されていない環境では、常に無効とする）
+
+    Args:
+        token: 指定されたトークン
+
+    Returns:
+        管理者用トークンと一致する場合はTrue
+    """
+    admin_token = os.getenv(ct.PROFILE_ADMIN_TOKEN_ENV_VAR)
+    if not admin_token or not token:
+        return False
+    # トークンの比較は、処理時間から値を推測されないよう定数時間で行う
+    return hmac.compare_digest(token, admin_token)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """
+    LLMの呼び出しごとの消費トークン数を合計するコールバック（処理段階ごとに1つ使う）
+    """
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+
+    def on_llm_end(self, response, **kwargs):
+        self.calls += 1
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        self.prompt_tokens += token_usage.get("prompt_tokens", 0)
+        self.completion_tokens += token_usage.get("completion_tokens", 0)
+
+    def totals(self):
+        """
+        消費トークン数の取得
+
+        Returns:
+            LLMの呼び出し回数と、入力・出力・合計のトークン数の辞書
+        """
+        return {
+            "llm_calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+        }
+
+
+class UsageTracker:
+    """
+    消費トークン数と料金の累計（プロセス全体・モードごと・セッションごと）
+    セッションごとの累計は、保持数の上限を超えた場合に最も古く利用されたものから破棄する
+    """
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._totals = self._new_totals()
+        self._modes = {}
+        self._sessions = OrderedDict()
+        # 共有のイベントループのスレッドから記録し、画面・HTTP APIのスレッドから参照するため
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_totals():
+        totals = {"requests": 0, "coalesced_requests": 0, **dict.fromkeys(COUNTER_KEYS, 0), "saved_cost_usd": 0.0}
+        totals["stages"] = {stage: dict.fromkeys(("llm_calls", "prompt_tokens", "completion_tokens"), 0)
+                            for stage in STAGES}
+        return totals
+
+    @staticmethod
+    def _add(totals, usage):
+        totals["requests"] += 1
+        totals["coalesced_requests"] += int(usage["coalesced"])
+        for key in COUNTER_KEYS:
+            totals[key] += usage[key]
+        totals["saved_cost_usd"] = round(totals["saved_cost_usd"] + (usage["saved_cost_usd"] or 0), 6)
+        for stage, stage_usage in usage["stages"].items():
+            for key in totals["stages"].setdefault(stage, {}):
+                totals["stages"][stage][key] += stage_usage[key]
+
+    @staticmethod
+    def _with_cost(totals):
+        result = {**totals, "stages": {stage: dict(values) for stage, values in totals["stages"].items()}}
+        result["cost_usd"] = get_cost_usd(totals["prompt_tokens"], totals["completion_tokens"])
+        return result
+
+    def record(self, session_id, mode, usage):
+        """
+        1リクエスト分の利用量の記録
+
+        Args:
+            session_id: リクエスト元のセッションID
+            mode: 利用目的のモード
+            usage: 1リクエスト分の利用量（「build_request_usage」の戻り値）
+
+        Returns:
+            記録後のセッションの累計（料金を含む）
+        """
+        with self._lock:
+            self._add(self._totals, usage)
+            self._add(self._modes.setdefault(mode, self._new_totals()), usage)
+
+            session = self._sessions.pop(session_id, None) or self._new_totals()
+            self._add(session, usage)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return self._with_cost(session)
+
+    def get_session(self, session_id):
+        """
+        セッションの累計の取得
+
+        Args:
+            session_id: セッションID
+
+        Returns:
+            セッションの累計（料金を含む、記録がない場合は全項目0）
+        """
+        with self._lock:
+            return self._with_cost(self._sessions.get(session_id) or self._new_totals())
+
+    def summary(self, top_n=ct.USAGE_SUMMARY_TOP_N):
+        """
+        管理者向けの集計の取得
+
+        Args:
+            top_n: 含めるセッションの件数（消費トークン数の多い順）
+
+        Returns:
+            プロセス全体・モードごとの累計と、消費トークン数の多いセッションの累計の辞書
+        """
+        with self._lock:
+            top_sessions = sorted(self._sessions.items(), key=lambda item: item[1]["total_tokens"], reverse=True)
+            return {
+                "model": ct.MODEL,
+                "totals": self._with_cost(self._totals),
+                "by_mode": {mode: self._with_cost(totals) for mode, totals in self._modes.items()},
+                "tracked_sessions": len(self._sessions),
+                "top_sessions": [
+                    {"session_id": session_id, **self._with_cost(totals)}
+                    for session_id, totals in top_sessions[:top_n]
+                ],
+            }
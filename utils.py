@@ -6,14 +6,18 @@
 # ライブラリの読み込み
 ############################################################
 import os
+import logging
 from dotenv import load_dotenv
 import streamlit as st
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, AIMessage
-from langchain_openai import ChatOpenAI
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
 import constants as ct
+import session_store
+import search_scope
+import circuit_breaker
+import request_coalescing
+import async_pipeline
+import profiler
+from initialize import create_scoped_retriever, get_parent_documents, get_shared_index, get_shared_scoped_retriever
 
 
 ############################################################
@@ -59,6 +63,23 @@ def get_source_icon(source):
     return icon
 
 
+def get_page_label(metadata):
+    """
+    ドキュメントのメタデータから、画面表示用のページ番号を取得（0ベースから1ベースに変換）
+
+    Args:
+        metadata: ドキュメントのメタデータ
+
+    Returns:
+        ページ番号（複数ページにまたがる場合は「開始ページ〜終了ページ」）
+    """
+    first_page = metadata["page"] + 1
+    last_page = metadata.get("page_end", metadata["page"]) + 1
+    if last_page > first_page:
+        return f"{first_page}〜{last_page}"
+    return first_page
+
+
 def build_error_message(message):
     """
     エラーメッセージと管理者問い合わせテンプレートの連結
@@ -72,12 +93,94 @@ def build_error_message(message):
     return "\n".join([message, ct.COMMON_ERROR_MESSAGE])
 
 
-def get_llm_response(chat_message):
+def add_display_messages(messages):
+    """
+    表示用の会話ログの追加（データベースに保存し、メモリには直近の会話のみを保持）
+
+    Args:
+        messages: 追加する会話ログ（「role」と「content」を持つ辞書）のリスト
+    """
+    overflow = append_session_data(
+        "messages", messages, session_store.SessionStore.append_messages, ct.SESSION_MEMORY_MESSAGE_LIMIT
+    )
+    st.session_state.spilled_message_count += overflow
+
+
+def add_chat_history(chat_message, answer):
+    """
+    LLMとのやりとり用の会話ログの追加（データベースに保存し、メモリには直近の会話のみを保持）
+
+    Args:
+        chat_message: ユーザー入力値
+        answer: LLMからの回答
+    """
+    chat_messages = [HumanMessage(content=chat_message), AIMessage(content=answer)]
+    append_session_data(
+        "chat_history", chat_messages, session_store.SessionStore.append_chat_history,
+        ct.SESSION_MEMORY_CHAT_HISTORY_LIMIT
+    )
+
+
+def append_session_data(key, items, append_method, memory_limit):
+    """
+    会話ログをメモリに追加してデータベースに保存し、上限を超えた古い会話をメモリから外す
+    - 以前に保存に失敗した会話ログがある場合は、それも含めて順に保存し直す
+    - メモリから外すのは、データベースへの保存を確認できた会話ログのみ（未保存の会話ログがある間は外さない）
+
+    Args:
+        key: 会話ログを格納したセッション状態のキー（「messages」または「chat_history」）
+        items: 追加する会話ログのリスト
+        append_method: 保存に使うSessionStoreのメソッド
+        memory_limit: メモリに保持する会話ログの上限件数
+
+    Returns:
+        メモリから外した会話ログの件数
+    """
+    data = st.session_state[key]
+    data.extend(items)
+
+    # 末尾の未保存の会話ログの件数（保存に失敗した分を含む）
+    pending_key = f"unpersisted_{key}_count"
+    pending = st.session_state.get(pending_key, 0) + len(items)
+    if not persist_session_data(append_method, data[len(data) - pending:]):
+        st.session_state[pending_key] = pending
+        return 0
+    st.session_state[pending_key] = 0
+
+    # データベースに保存済みのため、上限を超えた古い会話はメモリから外す
+    overflow = len(data) - memory_limit
+    if overflow <= 0:
+        return 0
+    del data[:overflow]
+    return overflow
+
+
+def persist_session_data(append_method, items):
+    """
+    会話ログをセッションストアに保存
+
+    Args:
+        append_method: 保存に使うSessionStoreのメソッド
+        items: 保存する会話ログのリスト
+
+    Returns:
+        保存に成功した場合はTrue（失敗した場合、会話ログはメモリにのみ保持される）
+    """
+    try:
+        append_method(session_store.get_store(), st.session_state.session_id, items)
+        return True
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).error(f"Failed to persist session data: {e}")
+        return False
+
+
+def get_llm_response(chat_message, on_wait=None):
     """
     LLMからの回答取得（OpenAI APIクォータ制限対策のためモック実装）
 
     Args:
         chat_message: ユーザー入力値
+        on_wait: 回答を待っている間、一定間隔で呼び出す関数（再実行・セッション終了時に処理をキャンセルするため）
 
     Returns:
         LLMからの回答
@@ -89,59 +192,110 @@ def get_llm_response(chat_message):
             return get_fallback_mock_response(chat_message)
         
         # OpenAI LLMを試行
-        llm = ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE)
-        
-        # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのプロンプトテンプレートを作成
-        question_generator_template = ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT
-        question_generator_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", question_generator_template),
-                MessagesPlaceholder("chat_history"),
-                ("human", "{input}")
-            ]
-        )
-
-        # モードによってLLMから回答を取得する用のプロンプトを変更
-        if st.session_state.mode == ct.ANSWER_MODE_1:
-            # モードが「社内文書検索」の場合のプロンプト
-            question_answer_template = ct.SYSTEM_PROMPT_DOC_SEARCH
-        else:
-            # モードが「社内問い合わせ」の場合のプロンプト
-            question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
-        # LLMから回答を取得する用のプロンプトテンプレートを作成
-        question_answer_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", question_answer_template),
-                MessagesPlaceholder("chat_history"),
-                ("human", "{input}")
-            ]
-        )
-
-        # 会話履歴なしでもLLMに理解してもらえる、独立した入力テキストを取得するためのRetrieverを作成
-        history_aware_retriever = create_history_aware_retriever(
-            llm, st.session_state.retriever, question_generator_prompt
-        )
-
-        # LLMから回答を取得する用のChainを作成
-        question_answer_chain = create_stuff_documents_chain(llm, question_answer_prompt)
-        # 「RAG x 会話履歴の記憶機能」を実現するためのChainを作成
-        chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-        # LLMへのリクエストとレスポンス取得
-        llm_response = chain.invoke({"input": chat_message, "chat_history": st.session_state.chat_history})
-        # LLMレスポンスを会話履歴に追加
-        st.session_state.chat_history.extend([HumanMessage(content=chat_message), AIMessage(content=llm_response["answer"])])
+        # （質問の言い換え・検索・回答生成は共有のイベントループ上で非同期に実行し、完了まで待つ）
+        search_filter = get_search_filter(chat_message)
+        # プロファイリング中は、共有のイベントループのスレッドでのこのリクエストの処理も計測する
+        coroutine = profiler.profile_coroutine(async_pipeline.answer_question(
+            chat_message,
+            list(st.session_state.chat_history),
+            st.session_state.mode,
+            # 検索範囲が選択・検出された場合は、その範囲のドキュメントのみを検索対象とする
+            get_scoped_retriever(search_filter),
+            st.session_state.session_id,
+            search_filter=search_filter,
+            index_version=st.session_state.get("index_version"),
+            degraded_retriever=st.session_state.get("degraded_retriever")
+        ))
+        llm_response, shared = async_pipeline.run_sync(coroutine, st.session_state.session_id, on_wait=on_wait)
+        if shared:
+            logger = logging.getLogger(ct.LOGGER_NAME)
+            logger.info({"coalesced_request": request_coalescing.get_group().stats()})
+
+        # LLMレスポンスを会話履歴に追加（結果を受け取った場合も、会話履歴は各セッションで保持する）
+        add_chat_history(chat_message, llm_response["answer"])
 
         return llm_response
         
     except Exception as e:
-        # OpenAI APIクォータ制限の場合、モック回答を返す
-        if 'quota' in str(e).lower() or '429' in str(e):
+        # OpenAI APIクォータ制限の場合、またはLLMが障害中で呼び出しを遮断した場合、モック回答を返す
+        if isinstance(e, circuit_breaker.CircuitOpenError) or 'quota' in str(e).lower() or '429' in str(e):
             return get_mock_llm_response(chat_message)
         else:
             raise e
 
 
+def invoke_retriever(retriever, query):
+    """
+    Retrieverでの検索（埋め込みモデルが障害中で呼び出しを遮断した場合は、キーワード検索に切り替える）
+
+    Args:
+        retriever: Retriever
+        query: 検索クエリ
+
+    Returns:
+        検索結果のドキュメントのリスト
+    """
+    try:
+        return retriever.invoke(query)
+    except circuit_breaker.CircuitOpenError as e:
+        degraded_retriever = st.session_state.get("degraded_retriever")
+        if degraded_retriever is None:
+            raise
+        logging.getLogger(ct.LOGGER_NAME).warning({"degraded_retrieval": str(e)})
+        return degraded_retriever.invoke(query)
+
+
+def get_search_filter(chat_message):
+    """
+    検索範囲の絞り込み条件を取得
+    （サイドバーで選択された検索範囲を優先し、未選択の場合は入力内容に含まれる顧客名から検出）
+
+    Args:
+        chat_message: ユーザー入力値
+
+    Returns:
+        絞り込み条件（絞り込まない場合はNone）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    scopes = st.session_state.get("search_scopes", {})
+
+    selected_scope = st.session_state.get("search_scope", ct.SEARCH_SCOPE_ALL)
+    # 選択中の検索範囲が一覧にない場合は、未選択として扱う
+    if selected_scope not in scopes:
+        selected_scope = None
+    search_filter = search_scope.resolve_search_filter(scopes, selected_scope, chat_message)
+
+    if search_filter:
+        logger.info({"search_filter": search_filter})
+    return search_filter
+
+
+def get_scoped_retriever(search_filter):
+    """
+    絞り込み条件に応じたRetrieverの取得
+    （セッションが共有のインデックスを使っている場合は、API・バッチ処理と同じくプロセス内で使い回す）
+
+    Args:
+        search_filter: 絞り込み条件（Noneの場合は絞り込まない）
+
+    Returns:
+        Retriever
+    """
+    if not search_filter:
+        return st.session_state.retriever
+
+    index = get_shared_index(create=False)
+    if index is not None and index.get("index_version") == st.session_state.get("index_version"):
+        return get_shared_scoped_retriever(index, search_filter)
+
+    # 共有のインデックス以外を使っている場合のみ、セッション内で使い回す
+    key = repr(sorted(search_filter.items()))
+    scoped_retrievers = st.session_state.setdefault("scoped_retrievers", {})
+    if key not in scoped_retrievers:
+        scoped_retrievers[key] = create_scoped_retriever(search_filter)
+    return scoped_retrievers[key]
+
+
 def get_fallback_mock_response(chat_message):
     """
     初期化未完了時のフォールバック回答生成
@@ -163,10 +317,7 @@ def get_fallback_mock_response(chat_message):
     
     # 会話履歴に追加（chat_historyが存在する場合のみ）
     if hasattr(st.session_state, 'chat_history') and st.session_state.chat_history is not None:
-        st.session_state.chat_history.extend([
-            HumanMessage(content=chat_message), 
-            AIMessage(content=answer)
-        ])
+        add_chat_history(chat_message, answer)
     
     # モック回答の構築
     mock_response = {
@@ -198,16 +349,13 @@ def get_mock_llm_response(chat_message):
         docs = get_hr_employee_documents(chat_message)
     else:
         # Retrieverから関連ドキュメントを取得
-        docs = st.session_state.retriever.invoke(chat_message)
+        docs = invoke_retriever(st.session_state.retriever, chat_message)
     
     # より詳細なモック回答を生成
     answer = generate_detailed_mock_answer(chat_message, docs)
     
     # 会話履歴に追加
-    st.session_state.chat_history.extend([
-        HumanMessage(content=chat_message), 
-        AIMessage(content=answer)
-    ])
+    add_chat_history(chat_message, answer)
     
     # モック回答の構築
     mock_response = {
@@ -237,7 +385,7 @@ def get_hr_employee_documents(chat_message):
             return get_csv_documents_directly()
         
         # まず通常のベクトル検索を実行
-        docs = st.session_state.retriever.invoke(chat_message)
+        docs = invoke_retriever(st.session_state.retriever, chat_message)
         
         # 社員名簿が含まれているかチェック
         csv_found = any('社員名簿.csv' in doc.metadata.get('source', '') for doc in docs)
@@ -254,7 +402,8 @@ def get_hr_employee_documents(chat_message):
                 
                 for keyword in hr_keywords:
                     keyword_docs = st.session_state.vectorstore.similarity_search(keyword, k=5)
-                    all_docs.extend(keyword_docs)
+                    # 親子チャンクの場合、検索した子チャンクを親チャンクに置き換える
+                    all_docs.extend(get_parent_documents(keyword_docs, st.session_state.get("parent_store")))
                 
                 # 重複除去
                 unique_docs = []
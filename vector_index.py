@@ -0,0 +1,296 @@
+"""
+このファイルは、NumPyの行列演算だけで類似度検索を行う、プロセス内の軽量ベクターストアを定義したファイルです。
+Chromaと同じ「similarity_search」「as_retriever」のインターフェースで利用できます。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+from uuid import uuid4
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from document_store import DocumentStore
+
+
+############################################################
+# クラス定義
+############################################################
+
+class NumpyVectorStore(VectorStore):
+    """
+    埋め込みベクトルを1つの連続したfloat32行列で保持し、内積で類似度を計算するベクターストア
+    - ベクトルは単位ベクトルに正規化して保持するため、内積がそのままコサイン類似度になる
+    - テキストとメタデータはチャンクストアに保持し、行番号をチャンクの番号として参照する
+    - 検索前の絞り込みは、チャンクストアのメタデータの配列で行う
+    """
+
+    def __init__(self, embedding: Embeddings):
+        """
+        Args:
+            embedding: 埋め込みモデル
+        """
+        self._embedding = embedding
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._ids: List[str] = []
+        # 行ごとのテキストとメタデータ（「from_store」で作成した場合は、他のRetrieverと共有する）
+        self._store = DocumentStore()
+        self._shared_store = False
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @property
+    def chunk_store(self) -> DocumentStore:
+        return self._store
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """
+        テキストを埋め込んでベクターストアに追加
+
+        Args:
+            texts: 追加するテキスト
+            metadatas: テキストごとのメタデータ
+            ids: テキストごとのID（省略時は自動採番）
+
+        Returns:
+            追加したテキストのIDのリスト
+        """
+        # 共有のチャンクストアに追加すると、他のRetrieverの行番号とずれるため追加できない
+        if self._shared_store:
+            raise RuntimeError("Cannot add texts to a vector store sharing its chunk store; rebuild it with from_store")
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [uuid4().hex for _ in texts]
+
+        vectors = self._normalize(np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+        self.add_vectors(vectors, texts, metadatas, ids)
+        return ids
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        """
+        埋め込み済みのベクトルをベクターストアに追加
+
+        Args:
+            vectors: 正規化済みのベクトル（件数×次元数の行列）
+            texts: ベクトルごとのテキスト（Noneの場合は、チャンクストアに追加済み）
+            metadatas: ベクトルごとのメタデータ
+            ids: ベクトルごとのID
+        """
+        # 追加のたびに1つの連続した行列にまとめ直す（検索時の行列演算を速くするため）
+        if len(self) == 0:
+            self._matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        else:
+            self._matrix = np.ascontiguousarray(np.vstack([self._matrix, vectors]), dtype=np.float32)
+
+        self._ids.extend(ids)
+        if texts is not None:
+            self._store.add(texts, metadatas)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        """
+        クエリと類似度の高いドキュメントを取得
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            filter: メタデータによる絞り込み条件（Chromaと同じ書式）
+
+        Returns:
+            類似度の高い順のドキュメントのリスト
+        """
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        クエリと類似度の高いドキュメントを、コサイン類似度と合わせて取得
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            filter: メタデータによる絞り込み条件
+
+        Returns:
+            （ドキュメント, コサイン類似度）のリスト
+        """
+        query_vector = np.asarray(self._embedding.embed_query(query), dtype=np.float32)
+        return self.similarity_search_with_score_by_vector(query_vector, k=k, filter=filter)
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k=k, filter=filter)]
+
+    async def asimilarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """
+        クエリと類似度の高いドキュメントを、コサイン類似度と合わせて非同期で取得
+        （類似度の計算・上位k件の選択は、共有のイベントループを止めないよう別のスレッドで行う）
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            filter: メタデータによる絞り込み条件
+
+        Returns:
+            （ドキュメント, コサイン類似度）のリスト
+        """
+        query_vector = np.asarray(await self._embedding.aembed_query(query), dtype=np.float32)
+        return await asyncio.to_thread(self.similarity_search_with_score_by_vector, query_vector, k=k, filter=filter)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """
+        ベクトルと類似度の高いドキュメントを、コサイン類似度と合わせて取得
+
+        Args:
+            embedding: 検索ベクトル
+            k: 取得件数
+            filter: メタデータによる絞り込み条件
+
+        Returns:
+            （ドキュメント, コサイン類似度）のリスト
+        """
+        if len(self) == 0:
+            return []
+
+        query_vector = self._normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+
+        # 絞り込み条件がある場合、先に対象の行番号を求め、その行のみで類似度を計算する
+        candidates = self._store.filter_ids(filter) if filter else None
+        if candidates is not None and len(candidates) == 0:
+            return []
+
+        indices, scores = self._search(query_vector, k, candidates)
+        return [(self._to_document(i), float(score)) for i, score in zip(indices, scores)]
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        id_set = set(ids)
+        return [self._to_document(i) for i, doc_id in enumerate(self._ids) if doc_id in id_set]
+
+    def memory_usage(self):
+        """
+        検索用に保持している配列のメモリ使用量
+
+        Returns:
+            行列とチャンクストアの配列のバイト数の辞書
+        """
+        return {"vectors": int(self._matrix.nbytes), **self._store.memory_usage()}
+
+    @classmethod
+    def from_store(cls, store: DocumentStore, embedding: Embeddings, **kwargs: Any) -> "NumpyVectorStore":
+        """
+        チャンクストアのチャンクを埋め込んだベクターストアの作成（チャンクストアはコピーせずに共有する）
+
+        Args:
+            store: チャンクストア
+            embedding: 埋め込みモデル
+
+        Returns:
+            ベクターストア
+        """
+        vectorstore = cls(embedding=embedding, **kwargs)
+        vectorstore._store = store
+        vectorstore._shared_store = True
+        if len(store) == 0:
+            return vectorstore
+        vectors = vectorstore._normalize(np.asarray(embedding.embed_documents(store.texts()), dtype=np.float32))
+        vectorstore.add_vectors(vectors, None, None, [uuid4().hex for _ in range(len(store))])
+        return vectorstore
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # コサイン類似度（-1〜1）を0〜1の関連度に変換
+        return lambda score: (score + 1.0) / 2.0
+
+    def _search(self, query_vector, k, candidates):
+        """
+        類似度の計算と上位k件の選択
+
+        Args:
+            query_vector: 正規化済みの検索ベクトル
+            k: 取得件数
+            candidates: 検索対象の行番号の配列（Noneの場合は全件）
+
+        Returns:
+            類似度の高い順の行番号と類似度
+        """
+        matrix = self._matrix if candidates is None else self._matrix[candidates]
+        scores = matrix @ query_vector
+
+        top = top_k_indices(scores, k)
+        indices = top if candidates is None else candidates[top]
+        return indices, scores[top]
+
+    def _to_document(self, index):
+        # 検索結果の上位k件に入ったものだけ、チャンクストアからDocumentオブジェクトを作成
+        return self._store.document(index, id=self._ids[index])
+
+    @staticmethod
+    def _normalize(vectors):
+        # 単位ベクトルに正規化（正規化済みの埋め込みモデルでも誤差を吸収するため常に実行）
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+############################################################
+# 関数定義
+############################################################
+
+def top_k_indices(scores, k):
+    """
+    スコアの高い上位k件の位置を、スコアの高い順に取得
+    （全件のソートは行わず、「argpartition」で上位k件を選んでからその中だけを並べ替える）
+
+    Args:
+        scores: スコアの配列
+        k: 取得件数
+
+    Returns:
+        上位k件の位置の配列
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
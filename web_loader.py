@@ -0,0 +1,240 @@
+"""
+このファイルは、RAGの参照先となるWebページを並行して取得し、ディスク上のキャッシュと合わせて読み込む機能を定義したファイルです。
+- 接続数の上限付きで全URLを同時に取得し、URLごとにタイムアウトを設定する（1つのサイトが遅くても起動全体を止めない）
+- 取得した内容はキャッシュに保存し、次回はETag・Last-Modifiedで更新の有無を確認する（更新がなければ本文を再取得しない）
+- 取得に失敗した場合は、キャッシュ済みの古い内容があればそれを使う
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_web_documents(urls, cache_dir=ct.WEB_CACHE_DIR_PATH, timeout=ct.WEB_LOAD_TIMEOUT_SECONDS,
+                       max_connections=ct.WEB_LOAD_MAX_CONNECTIONS):
+    """
+    Webページの読み込み（同期処理から呼び出す用）
+
+    Args:
+        urls: 読み込み対象のWebページのURLのリスト
+        cache_dir: キャッシュの保存先フォルダ
+        timeout: 1つのURLあたりのタイムアウト（秒）
+        max_connections: 同時に接続する最大数
+
+    Returns:
+        読み込んだドキュメントのリスト（取得できず、キャッシュもないURLは含めない）
+    """
+    coroutine = fetch_web_documents(urls, WebPageCache(cache_dir), timeout, max_connections)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # イベントループの実行中に呼び出された場合は、別スレッドの新しいイベントループで実行
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def fetch_web_documents(urls, cache, timeout=ct.WEB_LOAD_TIMEOUT_SECONDS,
+                              max_connections=ct.WEB_LOAD_MAX_CONNECTIONS):
+    """
+    Webページの並行取得
+
+    Args:
+        urls: 読み込み対象のWebページのURLのリスト
+        cache: Webページのキャッシュ
+        timeout: 1つのURLあたりのタイムアウト（秒）
+        max_connections: 同時に接続する最大数
+
+    Returns:
+        読み込んだドキュメントのリスト（URLの順）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    headers = {"User-Agent": os.environ.get("USER_AGENT", ct.WEB_LOAD_USER_AGENT)}
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        results = await asyncio.gather(*[
+            fetch_web_page(session, url, cache, aiohttp.ClientTimeout(total=timeout)) for url in urls
+        ])
+
+    docs = []
+    statuses = {}
+    for url, (status, entry) in zip(urls, results):
+        statuses[status] = statuses.get(status, 0) + 1
+        if entry is not None:
+            docs.append(build_document(url, entry["body"]))
+    logger.info({"web_sources": statuses})
+    return docs
+
+
+async def fetch_web_page(session, url, cache, timeout):
+    """
+    1つのWebページの取得（キャッシュがある場合は更新の有無を確認）
+
+    Args:
+        session: HTTPセッション
+        url: WebページのURL
+        cache: Webページのキャッシュ
+        timeout: タイムアウトの設定
+
+    Returns:
+        取得結果の種類（「fetched」: 取得、「revalidated」: 更新なし、「stale」: 取得失敗のため古いキャッシュを使用、
+        「failed」: 取得失敗）と、キャッシュの内容（取得失敗でキャッシュもない場合はNone）の組
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    cached = cache.get(url)
+
+    # キャッシュ済みの場合は、前回の取得時の識別子を送り、更新されていなければ本文を受け取らない
+    request_headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        async with session.get(url, headers=request_headers, timeout=timeout) as response:
+            if response.status == 304 and cached is not None:
+                cache.touch(url, cached)
+                return "revalidated", cached
+            response.raise_for_status()
+            body = (await response.read()).decode(response.get_encoding(), errors="replace")
+            entry = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "body": body,
+            }
+    # 通信エラーに加え、未知の文字コードや本文の読み込み中のエラーも取得失敗として扱い、古いキャッシュで補う
+    except (aiohttp.ClientError, asyncio.TimeoutError, LookupError, UnicodeDecodeError, OSError) as e:
+        if cached is not None:
+            logger.warning({"web_source": url, "status": "stale", "error": repr(e)})
+            return "stale", cached
+        logger.warning({"web_source": url, "status": "failed", "error": repr(e)})
+        return "failed", None
+
+    cache.put(url, entry)
+    return "fetched", entry
+
+
+def build_document(url, html):
+    """
+    HTMLからドキュメントを作成（WebBaseLoaderと同じ本文・メタデータの形式）
+
+    Args:
+        url: WebページのURL
+        html: HTML
+
+    Returns:
+        ドキュメント
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html_tag := soup.find("html"):
+        metadata["language"] = html_tag.get("lang", "No language found.")
+    return Document(page_content=soup.get_text(), metadata=metadata)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class WebPageCache:
+    """
+    取得したWebページを、URLごとに1つのJSONファイルとして保存するキャッシュ
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir: キャッシュの保存先フォルダ
+        """
+        self.cache_dir = cache_dir
+
+    def get(self, url):
+        """
+        キャッシュ済みの内容の取得
+
+        Args:
+            url: WebページのURL
+
+        Returns:
+            本文・ETag・Last-Modified・取得日時の辞書（未キャッシュ、または読み込めない場合はNone）
+        """
+        try:
+            with open(self._get_path(url), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, entry):
+        """
+        取得した内容の保存
+
+        Args:
+            url: WebページのURL
+            entry: 本文・ETag・Last-Modifiedの辞書
+        """
+        entry["fetched_at"] = time.time()
+        entry["validated_at"] = entry["fetched_at"]
+        self._write(url, entry)
+
+    def touch(self, url, entry):
+        """
+        更新がないことを確認した日時の記録
+
+        Args:
+            url: WebページのURL
+            entry: キャッシュ済みの内容
+        """
+        entry["validated_at"] = time.time()
+        self._write(url, entry)
+
+    def _get_path(self, url):
+        """
+        URLに対応するキャッシュファイルのパスの取得
+
+        Args:
+            url: WebページのURL
+
+        Returns:
+            キャッシュファイルのパス
+        """
+        return os.path.join(self.cache_dir, f"{hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()}.json")
+
+    def _write(self, url, entry):
+        """
+        キャッシュファイルの書き込み
+        （他のプロセスが書き込み途中のファイルを読まないよう、一時ファイルに書き出してから置き換える）
+
+        Args:
+            url: WebページのURL
+            entry: 保存する内容
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._get_path(url)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)